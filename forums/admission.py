@@ -0,0 +1,177 @@
+"""
+Adaptive limits on how many requests a worker handles at once.
+
+When the database slows down, requests keep arriving while earlier ones wait for connections, so every request takes
+longer and longer until they all time out. Instead, each worker starts at most `limit` requests at once and adapts the
+limit to how quickly it answers (AIMD): the limit grows slowly while GET requests are answered within the target
+latency, and is cut by a fixed factor when they are not. Requests beyond the limit wait in a short queue, and those
+that can't be started within the queue timeout are turned away with 503 right away, which clients and load balancers
+can retry, rather than waiting behind everyone else.
+
+Requests have one of three priorities:
+ - critical: moderator actions. They are never turned away, but count towards the limit.
+ - write: posts and other forms. They may use the whole limit and are started before waiting reads.
+ - read: page views and downloads. They may only use `read_share` of the limit, so they are turned away first.
+
+Static files and health checks aren't limited.
+"""
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from forums.config import ConcurrencyConfig
+from forums.routes.auth import extract_from_cookie
+
+CRITICAL = 0
+WRITE = 1
+READ = 2
+
+_EXEMPT_PATHS = re.compile(r'/(?:static|healthz)(?:/.*)?')
+# The routes only moderators may use. Moderators are also recognized by their session, see AdmissionMiddleware.
+_MODERATOR_PATHS = re.compile(r'/new_category|/categories/(?:create|\d+/(?:edit|delete))')
+
+
+class ConcurrencyLimiter:
+    def __init__(self, conf: ConcurrencyConfig):
+        self.conf = conf
+        self.limit = float(min(max(conf.initial_limit, conf.min_limit), conf.max_limit))
+        # requests started and not yet finished
+        self.inflight = 0
+        # requests turned away
+        self.shed = 0
+        # usernames of the moderators seen by this worker, kept up to date by forums.routes.auth.current_user. Title
+        # suggestions use it too, to answer without loading the user.
+        self.moderators: Set[str] = set()
+        self._queues: Dict[int, Deque[asyncio.Future]] = {WRITE: deque(), READ: deque()}
+        self._last_decrease = 0.0
+
+    def _capacity(self, priority: int) -> float:
+        return self.limit if priority == WRITE else self.limit * self.conf.read_share
+
+    def _can_start(self, priority: int) -> bool:
+        # requests don't overtake those waiting with the same or a higher priority
+        if self._queues[WRITE] or (priority == READ and self._queues[READ]):
+            return False
+        return self.inflight < self._capacity(priority)
+
+    async def acquire(self, priority: int) -> bool:
+        """
+        Waits until a request of `priority` may start. Returns False if it should be turned away instead. Every
+        successful call must be followed by a call to release().
+        """
+        if priority == CRITICAL or self._can_start(priority):
+            self.inflight += 1
+            return True
+
+        queue = self._queues[priority]
+        if len(queue) >= self.conf.max_queue or self.conf.queue_timeout <= 0:
+            self.shed += 1
+            return False
+
+        fut = asyncio.get_running_loop().create_future()
+        queue.append(fut)
+        try:
+            async with asyncio.timeout(self.conf.queue_timeout):
+                await fut
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # started just as the wait ended
+                if isinstance(e, TimeoutError):
+                    return True
+                self.release(None)
+                raise
+            if fut in queue:
+                queue.remove(fut)
+            if isinstance(e, TimeoutError):
+                self.shed += 1
+                return False
+            raise
+        return True
+
+    def release(self, latency: Optional[float]):
+        """
+        Ends a request, adapting the limit to its `latency` (the time to the start of its response) if it is known.
+        """
+        self.inflight -= 1
+        if latency is not None:
+            self._adapt(latency)
+
+        for priority in (WRITE, READ):
+            queue = self._queues[priority]
+            while queue and self.inflight < self._capacity(priority):
+                fut = queue.popleft()
+                if not fut.done():
+                    self.inflight += 1
+                    fut.set_result(None)
+            if queue:
+                # reads don't start while writes are waiting
+                break
+
+    def _adapt(self, latency: float):
+        conf = self.conf
+        if latency > conf.target_latency:
+            # once per interval, so that a burst of slow requests counts as one signal
+            now = time.monotonic()
+            if now - self._last_decrease >= conf.target_latency:
+                self.limit = max(float(conf.min_limit), self.limit * conf.backoff)
+                self._last_decrease = now
+        elif self.inflight * 2 >= self.limit:
+            # only grow a limit that is being used, otherwise it drifts up to max_limit while the worker is idle
+            self.limit = min(float(conf.max_limit), self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {'limit': round(self.limit, 1), 'inflight': self.inflight, 'shed': self.shed,
+                'waiting': {'write': len(self._queues[WRITE]), 'read': len(self._queues[READ])}}
+
+
+class AdmissionMiddleware:
+    """
+    Starts requests as `limiter` allows and answers those it turns away with 503.
+    """
+
+    def __init__(self, app: ASGIApp, limiter: ConcurrencyLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    def priority(self, scope: Scope) -> int:
+        if _MODERATOR_PATHS.fullmatch(scope['path']):
+            return CRITICAL
+        # moderators act through the same routes as authors, so they are recognized by their session cookie; looking
+        # them up in the database would defeat the purpose
+        if self.limiter.moderators and extract_from_cookie(Request(scope))[0] in self.limiter.moderators:
+            return CRITICAL
+        return READ if scope['method'] in ('GET', 'HEAD') else WRITE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not self.limiter.conf.enabled or _EXEMPT_PATHS.fullmatch(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        if not await self.limiter.acquire(self.priority(scope)):
+            await PlainTextResponse('The server is busy, try again shortly.',
+                                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    headers={'Retry-After': '1', 'Cache-Control': 'no-store'})(scope, receive, send)
+            return
+
+        start = time.monotonic()
+        latency = None
+        # the time to receive a request body depends on the client's connection, so only GET requests are timed
+        timed = scope['method'] in ('GET', 'HEAD')
+
+        async def timing_send(message: Message):
+            nonlocal latency
+            if timed and message['type'] == 'http.response.start':
+                latency = time.monotonic() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timing_send)
+        finally:
+            self.limiter.release(latency)
@@ -0,0 +1,219 @@
+"""
+Fingerprinted, precompressed static assets.
+
+`python -m forums.assets OUT_DIR` copies every file in the static directory into OUT_DIR under a name containing a
+hash of its contents (style.css becomes style.0123456789ab.css), writes gzip and, if the brotli package is installed,
+brotli compressed copies of the files worth compressing, and records all of it in OUT_DIR/manifest.json.
+
+Because a hashed name always refers to the same bytes, browsers may cache it forever. Templates call
+asset_url('style.css') to get the URL of the current version.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from mimetypes import guess_type
+from typing import Dict, Optional, Set, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from starlette.types import Scope
+
+from forums.config import AssetConfig
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+URL_PREFIX = '/static/'
+
+# Preferred first
+_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def accepted_encodings(header: Optional[str]) -> Set[str]:
+    """
+    The content codings an Accept-Encoding header allows, ignoring those with a q-value of zero.
+    """
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, *params = (p.strip() for p in item.split(';'))
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+class AssetManifest:
+    """
+    Maps logical asset names (paths relative to the static directory) to the URLs they are served from.
+
+    An empty manifest maps every name to its unhashed URL, which is what is used when no asset build is configured.
+    """
+
+    def __init__(self, files: Optional[Dict[str, dict]] = None):
+        self.files = files or {}
+        # served path -> encodings available for it
+        self.encodings: Dict[str, Tuple[str, ...]] = {f['path']: tuple(f['encodings']) for f in self.files.values()}
+
+    @classmethod
+    def load(cls, build_dir: str) -> 'AssetManifest':
+        with open(os.path.join(build_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return cls(json.load(f)['files'])
+
+    def url(self, name: str) -> str:
+        if (entry := self.files.get(name)) is not None:
+            return URL_PREFIX + entry['path']
+        return URL_PREFIX + name
+
+    def is_fingerprinted(self, path: str) -> bool:
+        return path in self.encodings
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Serves an asset build. Fingerprinted files are sent with immutable cache headers, and as their brotli or gzip
+    compressed copy when the client accepts it. Unhashed copies are kept so that old links keep working, but are
+    revalidated like any other static file.
+    """
+
+    def __init__(self, directory: str, manifest: AssetManifest):
+        super().__init__(directory=directory)
+        self.manifest = manifest
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        path = path.replace(os.sep, '/')
+        available = self.manifest.encodings.get(path, ())
+        response = None
+
+        if available and scope['method'] in ('GET', 'HEAD'):
+            request_headers = Headers(scope=scope)
+            accepted = accepted_encodings(request_headers.get('accept-encoding'))
+
+            for encoding in _SUFFIXES:
+                if encoding not in available or encoding not in accepted:
+                    continue
+                full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + _SUFFIXES[encoding])
+                if stat_result is None:
+                    continue
+
+                response = FileResponse(full_path, stat_result=stat_result,
+                                        media_type=guess_type(path)[0] or 'text/plain',
+                                        headers={'Content-Encoding': encoding})
+                if self.is_not_modified(response.headers, request_headers):
+                    response = NotModifiedResponse(response.headers)
+                break
+
+        if response is None:
+            response = await super().get_response(path, scope)
+
+        if available:
+            response.headers['Vary'] = 'Accept-Encoding'
+        if self.manifest.is_fingerprinted(path):
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+
+def create_static_files(conf: AssetConfig) -> Tuple[StaticFiles, AssetManifest]:
+    """
+    Returns the app serving /static and the manifest templates resolve asset names with: the asset build if one is
+    configured, or else the plain static directory.
+    """
+    if conf.build_dir is None:
+        return StaticFiles(directory=conf.directory), AssetManifest()
+
+    manifest = AssetManifest.load(conf.build_dir)
+    return PrecompressedStaticFiles(conf.build_dir, manifest), manifest
+
+
+def _is_compressible(name: str) -> bool:
+    media_type = guess_type(name)[0] or ''
+    return media_type.startswith(_COMPRESSIBLE_TYPES)
+
+
+def _write_if_smaller(path: str, data: bytes, original_size: int) -> bool:
+    if len(data) >= original_size:
+        return False
+    with open(path, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def build(source_dir: str, out_dir: str) -> Dict[str, dict]:
+    """
+    Writes the fingerprinted and compressed copies of every file in source_dir into out_dir, along with the manifest.
+    Returns the manifest entries.
+    """
+    files = {}
+
+    for root, _, names in os.walk(source_dir):
+        for name in sorted(names):
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, source_dir).replace(os.sep, '/')
+            with open(src, 'rb') as f:
+                data = f.read()
+
+            stem, ext = os.path.splitext(rel)
+            hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+            dest = os.path.join(out_dir, *hashed.split('/'))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(src, dest)
+            shutil.copyfile(src, os.path.join(out_dir, *rel.split('/')))
+
+            encodings = []
+            if _is_compressible(name):
+                if brotli is not None and _write_if_smaller(dest + _SUFFIXES['br'],
+                                                            brotli.compress(data, quality=11), len(data)):
+                    encodings.append('br')
+                # mtime=0 keeps builds of the same input byte for byte identical
+                if _write_if_smaller(dest + _SUFFIXES['gzip'], gzip.compress(data, compresslevel=9, mtime=0),
+                                     len(data)):
+                    encodings.append('gzip')
+
+            files[rel] = {'path': hashed, 'encodings': encodings}
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump({'files': files}, f, indent=2, sort_keys=True)
+
+    return files
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m forums.assets',
+                                     description='Builds fingerprinted, precompressed copies of the static assets.')
+    parser.add_argument('--source', default=AssetConfig().directory, help='the static directory')
+    parser.add_argument('out_dir', help='where to write the build; set assets.build_dir to it')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    files = build(args.source, args.out_dir)
+    for name, entry in sorted(files.items()):
+        logging.info('%s -> %s %s', name, entry['path'], ' '.join(entry['encodings']))
+    if brotli is None:
+        logging.warning('the brotli package is not installed, so only gzip copies were written')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
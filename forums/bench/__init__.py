@@ -0,0 +1,120 @@
+import gc
+import sys
+import time
+import tracemalloc
+from typing import Callable, Optional, List, Any, Iterator
+
+from pydantic import BaseModel
+
+# Each timed repeat runs the benchmark for at least this long
+MIN_REPEAT_TIME_NS = 200_000_000
+# Number of timed repeats. The fastest one is reported as ns/op.
+DEFAULT_REPEATS = 5
+# Number of calls made under tracemalloc when measuring allocations
+ALLOC_SAMPLE_OPS = 64
+
+
+class BenchResult(BaseModel):
+    """
+    The outcome of running a single Benchmark.
+    """
+    name: str
+    # Number of calls per timed repeat
+    ops: int
+    # Fastest and median time per call across repeats
+    ns_per_op: float
+    median_ns_per_op: float
+    # Highest amount of memory held at once during a single call (transient allocations)
+    peak_bytes_per_op: float
+    # Memory blocks still allocated after a call. Anything other than ~0 suggests a leak or a growing cache.
+    retained_blocks_per_op: float
+    # Size of what one call produces, for benchmarks where that matters (e.g. compressed bytes)
+    output_bytes: Optional[int] = None
+
+
+class Benchmark:
+    """
+    A named zero-argument callable to be timed. Fixtures should be built before constructing the Benchmark so that
+    their cost stays out of the measured loop.
+    """
+
+    def __init__(self, name: str, func: Callable[[], Any], output_bytes: Optional[int] = None):
+        self.name = name
+        self.func = func
+        self.output_bytes = output_bytes
+
+
+def _time_loop(fn: Callable[[], Any], ops: int) -> int:
+    start = time.perf_counter_ns()
+    for _ in range(ops):
+        fn()
+    return time.perf_counter_ns() - start
+
+
+def _calibrate(fn: Callable[[], Any]) -> int:
+    """
+    Finds a number of calls that takes at least MIN_REPEAT_TIME_NS, in the same manner as timeit.autorange.
+    """
+    ops = 1
+    while True:
+        if _time_loop(fn, ops) >= MIN_REPEAT_TIME_NS:
+            return ops
+        ops *= 2
+
+
+def _measure_allocs(fn: Callable[[], Any]) -> tuple[float, float]:
+    # warm up caches (regex, jinja, pydantic validators) so they aren't attributed to the function
+    fn()
+
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(ALLOC_SAMPLE_OPS):
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            fn()
+            _, op_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, op_peak - base)
+    finally:
+        tracemalloc.stop()
+
+    gc.collect()
+    before = sys.getallocatedblocks()
+    for _ in range(ALLOC_SAMPLE_OPS):
+        fn()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - before) / ALLOC_SAMPLE_OPS
+
+    return float(peak), retained
+
+
+def run(bench: Benchmark, repeats: int = DEFAULT_REPEATS) -> BenchResult:
+    """
+    Runs a benchmark and returns its timing and allocation figures.
+
+    The GC is disabled while timing so that collections triggered by unrelated garbage don't add noise.
+    """
+    fn = bench.func
+    peak, retained = _measure_allocs(fn)
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        ops = _calibrate(fn)
+        samples = sorted(_time_loop(fn, ops) / ops for _ in range(repeats))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return BenchResult(name=bench.name, ops=ops, ns_per_op=samples[0], median_ns_per_op=samples[len(samples) // 2],
+                       peak_bytes_per_op=peak, retained_blocks_per_op=retained, output_bytes=bench.output_bytes)
+
+
+def run_all(benches: List[Benchmark], name_filter: Optional[str] = None,
+            repeats: int = DEFAULT_REPEATS) -> Iterator[BenchResult]:
+    """
+    Runs each benchmark whose name contains `name_filter`, yielding results as they complete.
+    """
+    for b in benches:
+        if name_filter is None or name_filter in b.name:
+            yield run(b, repeats=repeats)
@@ -0,0 +1,34 @@
+import argparse
+import json
+import sys
+
+from forums.bench import run_all, DEFAULT_REPEATS
+from forums.bench.hotpaths import all_benchmarks
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m forums.bench',
+                                     description='Microbenchmarks for per-request hot paths. Does not need MySQL.')
+    parser.add_argument('-k', dest='name_filter', default=None,
+                        help='only run benchmarks whose name contains this string')
+    parser.add_argument('-r', '--repeats', type=int, default=DEFAULT_REPEATS, help='number of timed repeats')
+    parser.add_argument('--json', action='store_true', help='emit results as JSON lines')
+    args = parser.parse_args()
+
+    if not args.json:
+        print(f'{"benchmark":<40} {"ns/op":>12} {"median":>12} {"peak B/op":>11} {"retained/op":>12} {"out B":>9}')
+
+    for res in run_all(all_benchmarks(), name_filter=args.name_filter, repeats=args.repeats):
+        if args.json:
+            print(json.dumps(res.model_dump()))
+        else:
+            out = f'{res.output_bytes:,}' if res.output_bytes is not None else ''
+            print(f'{res.name:<40} {res.ns_per_op:>12,.0f} {res.median_ns_per_op:>12,.0f} '
+                  f'{res.peak_bytes_per_op:>11,.0f} {res.retained_blocks_per_op:>12.2f} {out:>9}')
+        sys.stdout.flush()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
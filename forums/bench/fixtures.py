@@ -0,0 +1,210 @@
+"""
+Stable inputs for the microbenchmarks. Everything here is deterministic (fixed seed, fixed clock values) so that
+numbers are comparable between runs and between commits.
+"""
+import os
+import random
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+from typing import Tuple, List
+
+from starlette.requests import Request
+
+from forums.cache import CSRF_PLACEHOLDER
+from forums.config import LoginConfig, StorageConfig
+from forums.db.categories import Category
+from forums.db.post_attachment import PostAttachment
+from forums.db.posts import PostWithAuthor
+from forums.db.topic_attachment import TopicAttachment
+from forums.db.topics import Topic, TopicWithAuthor
+from forums.db.users import User, IS_USER_MODERATOR
+from forums.models import UserAPI
+
+SEED = 0x0D1A
+SECRET = 'benchmark-secret-not-for-production-use'
+# A fixed point in time so that generated rows and cookies don't vary between runs
+EPOCH = datetime(2024, 5, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'templates')
+
+# Mirrors the paging constants in the routes
+ITEMS_PER_PAGE = 20
+MAX_CONTENT_LEN = 4000
+
+_WORDS = ('forum', 'reply', 'topic', 'omaha', 'campus', 'exam', 'project', 'schedule', 'library', 'parking',
+          'question', 'answer', 'thanks', 'anyone', 'know', 'where', 'when', 'the', 'a', 'is', 'to', 'of')
+
+
+def login_config() -> LoginConfig:
+    return LoginConfig(secret=SECRET, cookie_domain='forums.example.edu')
+
+
+def storage_config() -> StorageConfig:
+    return StorageConfig()
+
+
+def _text(rng: random.Random, length: int) -> str:
+    out = []
+    size = 0
+    while size < length:
+        w = rng.choice(_WORDS)
+        out.append(w)
+        size += len(w) + 1
+    return ' '.join(out)[:length]
+
+
+def make_request(cookies: dict | None = None) -> Request:
+    """
+    Builds a bare Request whose app.state carries just enough configuration for the auth helpers.
+    """
+    app = SimpleNamespace(state=SimpleNamespace(cfg=SimpleNamespace(login=login_config(),
+                                                                   storage=storage_config())))
+    headers = []
+    if cookies:
+        headers.append((b'cookie', '; '.join(f'{k}={v}' for k, v in cookies.items()).encode('latin-1')))
+
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers, 'query_string': b'',
+                    'app': app})
+
+
+def user(moderator: bool = False) -> User:
+    return User(user_id=42, display_name='Jane Doe', username='jdoe',
+                pw_hash='$argon2id$v=19$m=65536,t=3,p=4$c2FsdHNhbHRzYWx0$aGFzaGhhc2hoYXNoaGFzaA',
+                flags=IS_USER_MODERATOR if moderator else 0)
+
+
+def user_row() -> tuple:
+    u = user()
+    return u.user_id, u.username, u.pw_hash, u.display_name, u.flags
+
+
+def category_row() -> tuple:
+    return 7, 'General Discussion', 'Talk about anything', None
+
+
+def topic_row() -> tuple:
+    rng = random.Random(SEED)
+    return 1001, 7, 42, _text(rng, 80), _text(rng, MAX_CONTENT_LEN), EPOCH, 0
+
+
+def topic_author_row() -> tuple:
+    rng = random.Random(SEED)
+    return (1001, 7, 42, _text(rng, 80), _text(rng, 400), EPOCH, 0, 42, 'jdoe', 'Jane Doe', 0, 'General Discussion',
+            12, EPOCH + timedelta(hours=3))
+
+
+def post_author_row() -> tuple:
+    rng = random.Random(SEED)
+    return 5001, 1001, 42, _text(rng, MAX_CONTENT_LEN), EPOCH, 0, 42, 'Jane Doe', 'jdoe', 0
+
+
+def _topics_with_author(rng: random.Random, n: int) -> Tuple[TopicWithAuthor, ...]:
+    return tuple(TopicWithAuthor(topic_id=1000 + i, parent_cat=7,
+                                 author=UserAPI(user_id=100 + i, username=f'user{i}', display_name=f'User {i}'),
+                                 title=_text(rng, rng.randint(10, 100)), content=_text(rng, 200),
+                                 created_at=EPOCH + timedelta(minutes=i), num_replies=rng.randint(0, 500),
+                                 most_recent_reply=EPOCH + timedelta(hours=i)) for i in range(n))
+
+
+def cat_listing_contexts() -> Tuple[dict, dict]:
+    """
+    Contexts for the cached listing fragments of a category page: a few pins and a full page of topics.
+    """
+    rng = random.Random(SEED)
+    topics = {
+        'category_id': 7,
+        'topics': _topics_with_author(rng, ITEMS_PER_PAGE),
+        'current_page': 3,
+        'total_pages': 12,
+    }
+    return {'pins': _topics_with_author(rng, 3)}, topics
+
+
+def cat_index_context(moderator: bool = False) -> dict:
+    """
+    Context for the category page around its listing fragments, which are added by the caller.
+    """
+    rng = random.Random(SEED + 1)
+    cat = Category(id=7, cat_name='General Discussion', cat_desc='Talk about anything', parent_cat=3)
+    children = tuple((Category(id=20 + i, cat_name=f'Sub {i}', cat_desc=_text(rng, 60), parent_cat=7),
+                      rng.randint(0, 100)) for i in range(4))
+
+    return {
+        'category': cat,
+        'children': children,
+        'total_results': 12 * ITEMS_PER_PAGE - 5,
+        'user': user(moderator),
+        'bread': [(3, 'Campus'), (7, 'General Discussion')],
+        'csrf_token': 'x' * 220,
+    }
+
+
+def _topic() -> Topic:
+    rng = random.Random(SEED)
+    return Topic(topic_id=1001, parent_cat=7, author_id=42, title=_text(rng, 80),
+                 content=_text(rng, MAX_CONTENT_LEN), created_at=EPOCH, flags=0)
+
+
+def topic_replies_context(moderator: bool = False) -> dict:
+    """
+    Context for the cached reply list of a topic: a full page of maximum length replies, some of which have
+    attachments.
+    """
+    rng = random.Random(SEED + 2)
+    posts: List[PostWithAuthor] = [
+        PostWithAuthor(post_id=5000 + i, topic_id=1001,
+                       author=UserAPI(user_id=100 + i, username=f'user{i}', display_name=f'User {i}'),
+                       content=_text(rng, MAX_CONTENT_LEN), created_at=EPOCH + timedelta(minutes=i), flags=0)
+        for i in range(ITEMS_PER_PAGE)
+    ]
+    p_attachments = {
+        p.post_id: tuple(PostAttachment(id=9000 + p.post_id * 2 + j, post=p.post_id, filename=f'photo_{j}.jpg',
+                                        author=p.author.user_id, createdAt=EPOCH) for j in range(2))
+        for p in posts[::4]
+    }
+
+    return {
+        'topic': _topic(),
+        'posts': tuple(posts),
+        'p_attachments': p_attachments,
+        'current_page': 2,
+        'is_moderator': moderator,
+        'csrf_token': CSRF_PLACEHOLDER,
+    }
+
+
+def topic_context(moderator: bool = False) -> dict:
+    """
+    Context for the topic page around its reply list, which is added by the caller (see replies_page()).
+    """
+    return {
+        'user': user(moderator),
+        'author': UserAPI(user_id=42, username='jdoe', display_name='Jane Doe'),
+        'topic': _topic(),
+        'category': Category(id=7, cat_name='General Discussion', cat_desc='Talk about anything', parent_cat=3),
+        'current_page': 2,
+        'base_url': '/topic/1001/',
+        'csrf_token': 'x' * 220,
+        'bread': [(3, 'Campus'), (7, 'General Discussion')],
+        't_attachments': (TopicAttachment(id=1, thread=1001, filename='syllabus.txt', author=42, createdAt=EPOCH),),
+    }
+
+
+def replies_page(html: str) -> dict:
+    """
+    What load_replies() returns to the topic page for the given reply list.
+    """
+    return {'html': html, 'total_results': 5 * ITEMS_PER_PAGE - 3, 'total_pages': 5}
+
+
+# Inputs for escape_filename, a mix of benign and hostile names
+FILENAMES = (
+    'holiday photo.JPG',
+    '../../etc/passwd',
+    '  ..Résumé – final (2).docx  ',
+    'ｆｕｌｌｗｉｄｔｈ.png',
+    'a' * 90 + '.tar.gz',
+)
+
+USERNAMES = ('jdoe', 'a_very_long_username_with_underscores_1234', 'bad name!')
+DISPLAY_NAMES = ('Jane Doe', 'Zoë Ångström', 'x' * 70)
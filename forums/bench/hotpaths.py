@@ -0,0 +1,153 @@
+from datetime import timedelta
+from typing import List
+
+from jinja2 import Environment
+from markupsafe import Markup
+
+from forums.bench import Benchmark
+from forums.bench import fixtures
+from forums.compression import brotli, brotli_compressor, gzip_compressor
+from forums.config import TemplateConfig, ThumbnailConfig
+from forums.db.categories import _maybe_row_to_category
+from forums.db.posts import _maybe_row_to_post_author
+from forums.db.topics import _maybe_row_to_topic, _maybe_row_to_topic_author
+from forums.db.users import _maybe_row_to_user
+from forums.ioutil import escape_filename
+from forums.routes.auth import _create_cookie, _create_login_jwt, _decode_login_jwt, generate_csrf_token, \
+    csrf_verify, is_valid_username, is_valid_display_name
+from forums.routes.categories import _name_is_valid, _desc_is_valid
+from forums.templates import create_templates
+from forums.thumbnails import thumbnail_types
+
+
+def _auth_benchmarks() -> List[Benchmark]:
+    conf = fixtures.login_config()
+    exp = fixtures.EPOCH + timedelta(days=3650)
+    jwt = _create_login_jwt(conf.secret, 'jdoe', exp)
+
+    anon_req = fixtures.make_request()
+    authed_req = fixtures.make_request({conf.cookie_name: jwt})
+    anon_token = generate_csrf_token(anon_req)
+    authed_token = generate_csrf_token(authed_req)
+
+    return [
+        Benchmark('auth.create_cookie', lambda: _create_cookie(conf, jwt, exp)),
+        Benchmark('auth.create_login_jwt', lambda: _create_login_jwt(conf.secret, 'jdoe', exp)),
+        Benchmark('auth.decode_login_jwt', lambda: _decode_login_jwt(conf.secret, jwt)),
+        Benchmark('csrf.generate_anonymous', lambda: generate_csrf_token(anon_req)),
+        Benchmark('csrf.generate_authenticated', lambda: generate_csrf_token(authed_req)),
+        Benchmark('csrf.verify_anonymous', lambda: csrf_verify(anon_req, anon_token)),
+        Benchmark('csrf.verify_authenticated', lambda: csrf_verify(authed_req, authed_token)),
+    ]
+
+
+def _escape_all():
+    for name in fixtures.FILENAMES:
+        try:
+            escape_filename(name)
+        except ValueError:
+            pass
+
+
+def _validator_benchmarks() -> List[Benchmark]:
+    def usernames():
+        for n in fixtures.USERNAMES:
+            is_valid_username(n)
+
+    def display_names():
+        for n in fixtures.DISPLAY_NAMES:
+            is_valid_display_name(n)
+
+    def category_fields():
+        for n in fixtures.DISPLAY_NAMES:
+            _name_is_valid(n)
+            _desc_is_valid(n)
+
+    return [
+        Benchmark('ioutil.escape_filename[x5]', _escape_all),
+        Benchmark('validate.username[x3]', usernames),
+        Benchmark('validate.display_name[x3]', display_names),
+        Benchmark('validate.category_fields[x3]', category_fields),
+    ]
+
+
+def _mapper_benchmarks() -> List[Benchmark]:
+    user_row = fixtures.user_row()
+    cat_row = fixtures.category_row()
+    topic_row = fixtures.topic_row()
+    topic_author_row = fixtures.topic_author_row()
+    post_author_row = fixtures.post_author_row()
+
+    return [
+        Benchmark('rows.user', lambda: _maybe_row_to_user(user_row)),
+        Benchmark('rows.category', lambda: _maybe_row_to_category(cat_row)),
+        Benchmark('rows.topic', lambda: _maybe_row_to_topic(topic_row)),
+        Benchmark('rows.topic_author', lambda: _maybe_row_to_topic_author(topic_author_row)),
+        Benchmark('rows.post_author', lambda: _maybe_row_to_post_author(post_author_row)),
+    ]
+
+
+def _template_env() -> Environment:
+    # the environment pages are rendered with in production, with the same globals
+    conf = TemplateConfig(directory=fixtures.TEMPLATE_DIR, production=True)
+    return create_templates(conf, thumbnail_types=thumbnail_types(ThumbnailConfig())).env
+
+
+def _template_benchmarks() -> List[Benchmark]:
+    env = _template_env()
+    benches = []
+
+    # fragments are rendered on a cache miss, pages on every request
+    pins_ctx, topics_ctx = fixtures.cat_listing_contexts()
+    pins_tpl, topics_tpl = env.get_template('_cat_pins.html'), env.get_template('_cat_topics.html')
+    benches.append(Benchmark('render._cat_pins.html', lambda: pins_tpl.render(pins_ctx)))
+    benches.append(Benchmark('render._cat_topics.html', lambda: topics_tpl.render(topics_ctx)))
+    listing = {'pins_html': Markup(pins_tpl.render(pins_ctx)), 'topics_html': Markup(topics_tpl.render(topics_ctx))}
+
+    replies_tpl = env.get_template('_topic_replies.html')
+
+    for moderator in (False, True):
+        role = 'moderator' if moderator else 'user'
+
+        replies_ctx = fixtures.topic_replies_context(moderator)
+        benches.append(Benchmark(f'render._topic_replies.html[{role}]',
+                                 lambda ctx=replies_ctx: replies_tpl.render(ctx)))
+
+        replies = fixtures.replies_page(Markup(replies_tpl.render(replies_ctx)))
+        for name, ctx in (('topic.html', {**fixtures.topic_context(moderator),
+                                          'load_replies': lambda replies=replies: replies}),
+                          ('cat_index.html', {**fixtures.cat_index_context(moderator), **listing})):
+            tpl = env.get_template(name)
+            benches.append(Benchmark(f'render.{name}[{role}]', lambda tpl=tpl, ctx=ctx: tpl.render(ctx)))
+
+    return benches
+
+
+def _compression_benchmarks() -> List[Benchmark]:
+    # a full topic page, the largest page the forum serves
+    env = _template_env()
+    replies = fixtures.replies_page(Markup(env.get_template('_topic_replies.html').render(
+        fixtures.topic_replies_context())))
+    page = env.get_template('topic.html').render({**fixtures.topic_context(),
+                                                  'load_replies': lambda: replies}).encode('utf-8')
+
+    def once(make_compressor):
+        compress, _, finish = make_compressor()
+        return compress(page) + finish()
+
+    benches = [Benchmark('compress.none', lambda: page, output_bytes=len(page))]
+    for level in (1, 6, 9):
+        benches.append(Benchmark(f'compress.gzip[{level}]', lambda level=level: once(lambda: gzip_compressor(level)),
+                                 output_bytes=len(once(lambda: gzip_compressor(level)))))
+    if brotli is not None:
+        for quality in (1, 5, 11):
+            benches.append(Benchmark(f'compress.brotli[{quality}]',
+                                     lambda quality=quality: once(lambda: brotli_compressor(quality)),
+                                     output_bytes=len(once(lambda: brotli_compressor(quality)))))
+
+    return benches
+
+
+def all_benchmarks() -> List[Benchmark]:
+    return _auth_benchmarks() + _validator_benchmarks() + _mapper_benchmarks() + _template_benchmarks() + \
+        _compression_benchmarks()
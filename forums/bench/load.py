@@ -0,0 +1,130 @@
+"""
+HTTP load harness: `python -m forums.bench.load URL PATH [PATH ...]`.
+
+Logs in (if credentials are given), then keeps `--concurrency` requests in flight against the given paths for
+`--duration` seconds and reports throughput and latency percentiles. Run it from another machine, or at least with
+the server pinned to other cores, so that the harness doesn't compete with the workers it measures.
+"""
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import sys
+import time
+from typing import List, Optional
+
+import httpx
+from pydantic import BaseModel
+
+_CSRF_FIELD = re.compile(r'name="csrf_token" value="([^"]+)"')
+
+
+class LoadResult(BaseModel):
+    requests: int
+    errors: int
+    seconds: float
+    requests_per_second: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+async def _login(client: httpx.AsyncClient, username: str, password: str, cookie_name: str) -> str:
+    """
+    Logs in through the login form and returns the session cookie. The cookie is sent by hand afterward because it
+    is usually marked Secure, which the client would refuse to send over plain HTTP.
+    """
+    page = await client.get('/login')
+    token = _CSRF_FIELD.search(page.text).group(1)
+    r = await client.post('/auth/login', data={'username': username, 'password': password, 'csrf_token': token})
+    if cookie_name not in r.cookies:
+        raise RuntimeError(f'login failed: {r.status_code} {r.headers.get("location")}')
+    return f'{cookie_name}={r.cookies[cookie_name]}'
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def run(base_url: str, paths: List[str], concurrency: int, duration: float, warmup: float,
+              username: Optional[str] = None, password: Optional[str] = None,
+              cookie_name: str = 'auth') -> LoadResult:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30, follow_redirects=False,
+                                 headers={'Accept-Encoding': 'gzip'}) as client:
+        if username is not None:
+            client.headers['Cookie'] = await _login(client, username, password, cookie_name)
+
+        latencies: List[float] = []
+        errors = 0
+        recording = False
+
+        async def user(n: int):
+            nonlocal errors
+            i = n
+            while True:
+                path = paths[i % len(paths)]
+                i += 1
+                start = time.perf_counter()
+                try:
+                    r = await client.get(path)
+                    ok = r.status_code in (200, 304)
+                except httpx.HTTPError:
+                    ok = False
+                if recording:
+                    if ok:
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        errors += 1
+
+        tasks = [asyncio.create_task(user(n)) for n in range(concurrency)]
+        try:
+            await asyncio.sleep(warmup)
+            recording = True
+            started = time.perf_counter()
+            await asyncio.sleep(duration)
+            recording = False
+            elapsed = time.perf_counter() - started
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    return LoadResult(requests=len(ms), errors=errors, seconds=elapsed, requests_per_second=len(ms) / elapsed,
+                      p50_ms=statistics.median(ms) if ms else 0.0, p90_ms=_percentile(ms, 0.9),
+                      p99_ms=_percentile(ms, 0.99), max_ms=ms[-1] if ms else 0.0)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m forums.bench.load', description='HTTP load harness.')
+    parser.add_argument('url', help='base URL of the server, e.g. http://127.0.0.1:8080')
+    parser.add_argument('paths', nargs='+', help='paths to request, in rotation')
+    parser.add_argument('-c', '--concurrency', type=int, default=32, help='requests kept in flight')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds to measure for')
+    parser.add_argument('-w', '--warmup', type=float, default=5, help='seconds to run before measuring')
+    parser.add_argument('-u', '--username', help='log in as this user first')
+    parser.add_argument('-p', '--password', help='password for --username')
+    parser.add_argument('--cookie-name', default='auth', help='login.cookie_name of the server')
+    parser.add_argument('--json', action='store_true', help='emit the result as JSON')
+    args = parser.parse_args()
+
+    res = asyncio.run(run(args.url, args.paths, args.concurrency, args.duration, args.warmup,
+                          args.username, args.password, args.cookie_name))
+
+    if args.json:
+        print(json.dumps(res.model_dump()))
+    else:
+        print(f'{res.requests} requests ({res.errors} errors) in {res.seconds:.1f} s: '
+              f'{res.requests_per_second:,.0f} req/s, p50 {res.p50_ms:.1f} ms, p90 {res.p90_ms:.1f} ms, '
+              f'p99 {res.p99_ms:.1f} ms, max {res.max_ms:.1f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
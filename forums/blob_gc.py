@@ -0,0 +1,224 @@
+"""
+Blob store garbage collector: `python -m forums.blob_gc`.
+
+Compares the files of the blob store with the attachmentBlobs table, then:
+ - deletes blob files, along with their thumbnails, that no row refers to. These are left behind when a transaction
+   fails after its file was put in place, or when the job that should have deleted a file was lost.
+ - deletes staged uploads abandoned by a worker that crashed while storing them.
+ - reports rows whose file is missing, which can't be repaired automatically.
+
+Both sides are read in hash order and merge-joined: the files one shard directory at a time, the rows in batches. Memory
+use therefore doesn't grow with the size of the store. Files younger than the grace period are left alone, and every
+deletion re-checks the row under a lock first, so the collector can run against a live server. `--rate` limits how
+many entries it examines per second.
+
+Attachments stored under their filenames are not covered; move them into the blob store with
+`python -m forums.migrate_attachments` first.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+import time
+from typing import AsyncIterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from forums.blocking import spawn_blocking
+from forums.config import load_config
+from forums.db.blobs import BlobRepository
+from forums.db.utils import create_tool_pool
+from forums.ioutil import blob_path, remove_blob
+
+# Rows loaded per query
+_BATCH_SIZE = 1000
+_SHARD = re.compile(r'[0-9a-f]{2}')
+_SHA256 = re.compile(r'[0-9a-f]{64}')
+
+
+class GCResult(BaseModel):
+    # blobs with a file (or at least a thumbnail) in the store
+    files: int = 0
+    # rows of attachmentBlobs
+    rows: int = 0
+    # files no row refers to
+    orphans: int = 0
+    # orphans left alone because they are younger than the grace period
+    young: int = 0
+    # orphans deleted
+    removed: int = 0
+    # rows whose file is missing
+    missing: int = 0
+    # abandoned staged uploads (deleted unless in a dry run)
+    stale_staged: int = 0
+
+
+def _list_shards(directory: str) -> List[str]:
+    try:
+        return sorted(e.name for e in os.scandir(directory) if e.is_dir(follow_symlinks=False) and
+                      _SHARD.fullmatch(e.name))
+    except FileNotFoundError:
+        return []
+
+
+def _scan_shard(directory: str) -> List[Tuple[str, Optional[float]]]:
+    """
+    Lists the blobs in a leaf directory of the store in order, each with the modification time of its file, or None
+    if only thumbnails made from it are left.
+    """
+    found = {}
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        sha256, _, suffix = entry.name.partition('.')
+        if not _SHA256.fullmatch(sha256):
+            continue
+        if suffix:
+            found.setdefault(sha256, None)
+        else:
+            try:
+                found[sha256] = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                pass
+    return sorted(found.items())
+
+
+async def _blob_files(blobs_dir: str) -> AsyncIterator[Tuple[str, Optional[float]]]:
+    for first in await spawn_blocking(_list_shards, blobs_dir):
+        for second in await spawn_blocking(_list_shards, os.path.join(blobs_dir, first)):
+            for item in await spawn_blocking(_scan_shard, os.path.join(blobs_dir, first, second)):
+                yield item
+
+
+async def _blob_rows(repo: BlobRepository) -> AsyncIterator[str]:
+    after = ''
+    while hashes := await repo.get_hashes_after(after, _BATCH_SIZE):
+        for sha256 in hashes:
+            yield sha256
+        after = hashes[-1]
+
+
+def _clean_staging(staging_dir: str, cutoff: float, dry_run: bool) -> int:
+    stale = 0
+    try:
+        entries = list(os.scandir(staging_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if not entry.is_file(follow_symlinks=False) or entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                continue
+            if not dry_run:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            continue
+        stale += 1
+    return stale
+
+
+class _Throttle:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.count = 0
+
+    async def tick(self):
+        self.count += 1
+        if self.rate > 0:
+            ahead = self.start + self.count / self.rate - time.monotonic()
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+
+async def collect(storage_path: str, repo: BlobRepository, grace: float, rate: float = 0,
+                  dry_run: bool = False) -> GCResult:
+    """
+    Deletes the orphaned files of the blob store under `storage_path` that are older than `grace` seconds, examining
+    at most `rate` entries per second (if positive). With `dry_run`, only reports what it finds.
+    """
+    result = GCResult()
+    throttle = _Throttle(rate)
+    blobs_dir = os.path.join(storage_path, 'attachments', 'blobs')
+    cutoff = time.time() - grace
+
+    async def remove(sha256: str):
+        await remove_blob(storage_path, sha256)
+
+    async def orphan(sha256: str, mtime: Optional[float]):
+        result.orphans += 1
+        # only thumbnails left means the blob itself is gone, however recently
+        if mtime is not None and mtime >= cutoff:
+            result.young += 1
+            return
+        logging.info('%s blob %s', 'orphaned' if dry_run else 'removing', sha256)
+        if not dry_run and await repo.remove_if_unreferenced(sha256, remove):
+            result.removed += 1
+
+    async def missing(sha256: str):
+        # it may have been uploaded since its shard was listed
+        if not await spawn_blocking(os.path.exists, blob_path(storage_path, sha256)):
+            result.missing += 1
+            logging.warning('the file of blob %s is missing', sha256)
+
+    files = _blob_files(blobs_dir)
+    rows = _blob_rows(repo)
+    file = await anext(files, None)
+    row = await anext(rows, None)
+    while file is not None or row is not None:
+        if row is None or (file is not None and file[0] < row):
+            result.files += 1
+            await orphan(*file)
+            file = await anext(files, None)
+        elif file is None or row < file[0]:
+            result.rows += 1
+            await missing(row)
+            row = await anext(rows, None)
+        else:
+            result.files += 1
+            result.rows += 1
+            file = await anext(files, None)
+            row = await anext(rows, None)
+        await throttle.tick()
+
+    result.stale_staged = await spawn_blocking(_clean_staging, os.path.join(blobs_dir, 'tmp'), cutoff, dry_run)
+    return result
+
+
+async def _run(args: argparse.Namespace) -> GCResult:
+    cfg = load_config()
+    if cfg.backend != 'mysql':
+        raise SystemExit('the memory backend keeps no attachments between runs')
+
+    pool = await create_tool_pool(cfg.db, 2)
+    try:
+        return await collect(cfg.storage.path, BlobRepository(pool), args.grace, args.rate, args.dry_run)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m forums.blob_gc',
+                                     description='Deletes files of the blob store that no attachment refers to.')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only report what would be deleted')
+    parser.add_argument('--grace', type=float, default=24 * 3600,
+                        help='files younger than this many seconds are left alone')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='entries examined per second at most, 0 for no limit')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    res = asyncio.run(_run(args))
+    logging.info('examined %d files and %d rows in %.1f s: %d orphans (%d too young, %d removed), %d missing files, '
+                 '%d stale staged uploads', res.files, res.rows, time.perf_counter() - start, res.orphans, res.young,
+                 res.removed, res.missing, res.stale_staged)
+    return 1 if res.missing else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Limits on the size of request bodies.
+"""
+import logging
+import re
+
+from starlette import status
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from forums.config import RequestConfig
+
+# The routes that take file uploads: new topics, replies and added attachments
+_UPLOAD_PATHS = re.compile(r'/topic/(?:\d+/(?:reply|add_attachment))?')
+
+
+class _BodyTooLarge(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail='Request body is too large.')
+
+
+class BodyLimitMiddleware:
+    """
+    Rejects requests whose body is larger than the limit of their route with 413: `max_upload_size` for routes that
+    take file uploads, and `conf.max_form_size` for everything else.
+
+    A request that declares a larger Content-Length is rejected before its body is read. Otherwise the bytes are
+    counted as they arrive, which also covers chunked bodies that have no Content-Length, and reading stops once the
+    limit is passed. What a request can make the application buffer or spool to disk is therefore bounded by its
+    route's limit.
+    """
+
+    def __init__(self, app: ASGIApp, conf: RequestConfig, max_upload_size: int):
+        self.app = app
+        self.conf = conf
+        self.max_upload_size = max_upload_size
+
+    def limit_for(self, path: str) -> int:
+        return self.max_upload_size if _UPLOAD_PATHS.fullmatch(path) else self.conf.max_form_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limit_for(scope['path'])
+        if (length := Headers(scope=scope).get('content-length')) is not None:
+            if not length.isdigit():
+                await PlainTextResponse('Invalid Content-Length header.',
+                                        status_code=status.HTTP_400_BAD_REQUEST)(scope, receive, send)
+                return
+            if int(length) > limit:
+                await PlainTextResponse('Request body is too large.',
+                                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)(scope, receive, send)
+                return
+
+        received = 0
+        started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # an HTTPException, so that FastAPI passes it on rather than calling it a malformed body
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message: Message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge as e:
+            if started:
+                logging.warning('request body of %s exceeded %d bytes after the response started', scope['path'],
+                                limit)
+                return
+            await PlainTextResponse(e.detail, status_code=e.status_code)(scope, receive, send)
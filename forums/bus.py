@@ -0,0 +1,140 @@
+"""
+Keeps the in-process caches of several workers consistent.
+
+Every Caches.invalidate() call is also published to the cacheInvalidations table. Each worker polls that table and
+applies what the other workers published, so a write becomes visible everywhere within the poll interval. The ids of
+the invalidations also serve as the versions of the tags (see forums.cache.VersionTable), so that every worker gives a
+page the same ETag.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Hashable, Iterable, List, Set, Tuple
+
+from forums.cache import Caches
+from forums.db.invalidations import InvalidationRepository
+
+# Rows fetched per poll
+_BATCH_SIZE = 1000
+# Auto increment ids can become visible out of order when inserts commit out of order. A missing id is waited for
+# this long before it is assumed to belong to an insert that was rolled back.
+_GAP_TIMEOUT = 5.0
+# How often old invalidations are deleted
+_PRUNE_INTERVAL = 60.0
+
+
+def encode_tag(tag: Tuple[Hashable, ...]) -> str:
+    return ':'.join(str(part) for part in tag)
+
+
+def decode_tag(value: str) -> Tuple[Hashable, ...]:
+    return tuple(int(part) if part.isdigit() else part for part in value.split(':'))
+
+
+class InvalidationBus:
+    def __init__(self, caches: Caches, repo: InvalidationRepository, poll_interval: float, retention: int):
+        self._caches = caches
+        self._repo = repo
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # identifies this process, so that it can skip its own invalidations
+        self.origin = caches.versions.epoch
+
+        self._outgoing: List[str] = []
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+        # every invalidation with an id up to and including the floor has been applied
+        self._floor = 0
+        # ids above the floor that have been applied
+        self._applied: Set[int] = set()
+        # ids above the floor that have not been seen yet -> when to stop waiting for them
+        self._gaps: Dict[int, float] = {}
+
+    async def start(self):
+        # this worker's caches are empty, so nothing published before now matters
+        self._floor = await self._repo.get_latest_id()
+        self._caches.versions.share(self._floor)
+        self._caches.bus = self
+        self._tasks = [asyncio.create_task(self._publish_loop()), asyncio.create_task(self._poll_loop())]
+
+    async def stop(self):
+        self._caches.bus = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        try:
+            await self._flush()
+        except Exception as e:
+            logging.error('failed to publish %d cache invalidations on shutdown', len(self._outgoing), exc_info=e)
+
+    def publish(self, tags: Iterable[Tuple[Hashable, ...]]):
+        """
+        Queues `tags` to be sent to the other workers. The write is sent right away by a background task.
+        """
+        self._outgoing.extend(encode_tag(tag) for tag in tags)
+        self._wake.set()
+
+    async def _flush(self):
+        if not self._outgoing:
+            return
+        batch, self._outgoing = self._outgoing, []
+        try:
+            await self._repo.put_invalidations(self.origin, batch)
+        except BaseException:
+            self._outgoing[:0] = batch
+            raise
+
+    async def _publish_loop(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                logging.error('failed to publish cache invalidations, will retry', exc_info=e)
+                await asyncio.sleep(self.poll_interval)
+                self._wake.set()
+
+    async def poll(self):
+        """
+        Applies the invalidations published by other workers since the last poll.
+        """
+        for row_id, origin, tag in await self._repo.get_invalidations_after(self._floor, _BATCH_SIZE):
+            if row_id in self._applied:
+                continue
+            self._applied.add(row_id)
+            self._gaps.pop(row_id, None)
+            self._caches.apply_published(row_id, decode_tag(tag), origin == self.origin)
+
+        self._advance(time.monotonic())
+
+    def _advance(self, now: float):
+        top = max(self._applied, default=self._floor)
+        for missing in range(self._floor + 1, top):
+            if missing not in self._applied:
+                self._gaps.setdefault(missing, now + _GAP_TIMEOUT)
+
+        while True:
+            nxt = self._floor + 1
+            if nxt in self._applied:
+                self._applied.discard(nxt)
+            elif self._gaps.get(nxt, float('inf')) <= now:
+                del self._gaps[nxt]
+            else:
+                break
+            self._floor = nxt
+
+    async def _poll_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+
+                if time.monotonic() - last_prune >= _PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    await self._repo.delete_older_than(self.retention)
+            except Exception as e:
+                logging.error('failed to poll for cache invalidations', exc_info=e)
@@ -0,0 +1,367 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple, Set
+
+from markupsafe import escape
+from pydantic import BaseModel
+
+from forums.db.topics import Topic
+from forums.suggest import TitleIndex
+
+
+class _Entry:
+    __slots__ = ('value', 'fresh_until', 'stale_until', 'tags', 'refresh')
+
+    def __init__(self, value: Any, fresh_until: float, stale_until: float, tags: Tuple[Hashable, ...]):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.tags = tags
+        # the background task recomputing this entry, if one is running
+        self.refresh: Optional[asyncio.Task] = None
+
+
+class FragmentCache:
+    """
+    An in-process cache for rendered page fragments (or anything else that is expensive to compute and shared
+    between users).
+
+    Each entry has a key and a set of tags. Entries are fresh for `ttl` seconds. After that, they are served stale
+    for up to `stale_ttl` more seconds while a single background task recomputes them. Calling invalidate() with a
+    tag drops every entry carrying it immediately, so a write is visible on the next page load. Concurrent misses
+    for the same key are coalesced so that only one of them does the work.
+
+    The cache holds at most `max_entries` entries and evicts the least recently used one when full.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        # misses currently being computed, so concurrent requests can wait on them instead of recomputing
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        # bumped whenever a tag is invalidated; a computation that started before a bump must not be stored
+        self._generations: Dict[Hashable, int] = {}
+        # tag -> keys of the entries carrying it
+        self._tagged: Dict[Hashable, Set[Hashable]] = defaultdict(set)
+
+    def _snapshot(self, tags: Tuple[Hashable, ...]) -> Tuple[int, ...]:
+        return tuple(self._generations.get(t, 0) for t in tags)
+
+    def _store(self, key: Hashable, tags: Tuple[Hashable, ...], generations: Tuple[int, ...], value: Any):
+        if self._snapshot(tags) != generations:
+            # invalidated while we were computing it
+            return
+
+        self._remove(key)
+        now = time.monotonic()
+        self._entries[key] = _Entry(value, now + self.ttl, now + self.ttl + self.stale_ttl, tags)
+        for tag in tags:
+            self._tagged[tag].add(key)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable):
+        if (entry := self._entries.pop(key, None)) is None:
+            return
+        for tag in entry.tags:
+            keys = self._tagged[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tagged[tag]
+
+    async def _compute(self, key: Hashable, tags: Tuple[Hashable, ...], render: Callable[[], Awaitable[Any]]) -> Any:
+        generations = self._snapshot(tags)
+        value = await render()
+        self._store(key, tags, generations, value)
+        return value
+
+    async def _refresh(self, key: Hashable, entry: _Entry, render: Callable[[], Awaitable[Any]]):
+        try:
+            await self._compute(key, entry.tags, render)
+        except Exception as e:
+            # keep serving the stale value until it expires
+            logging.error('failed to refresh cached fragment %r', key, exc_info=e)
+        finally:
+            entry.refresh = None
+
+    async def get_or_render(self, key: Hashable, tags: Iterable[Hashable],
+                            render: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the cached value for `key`, calling `render` to compute it when needed.
+        """
+        tags = tuple(tags)
+        now = time.monotonic()
+
+        if (entry := self._entries.get(key)) is not None:
+            if now < entry.fresh_until:
+                self._entries.move_to_end(key)
+                return entry.value
+
+            if now < entry.stale_until:
+                self._entries.move_to_end(key)
+                if entry.refresh is None:
+                    entry.refresh = asyncio.create_task(self._refresh(key, entry, render))
+                return entry.value
+
+            self._remove(key)
+
+        while (pending := self._pending.get(key)) is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # the request computing it was cancelled, e.g. because its client went away; take over
+
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[key] = fut
+        try:
+            value = await self._compute(key, tags, render)
+            fut.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # mark the exception as retrieved in case nobody else was waiting
+            fut.exception()
+            raise
+        finally:
+            del self._pending[key]
+
+    def invalidate(self, tag: Hashable):
+        """
+        Drops all entries carrying `tag`.
+        """
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+        for key in list(self._tagged.get(tag, ())):
+            self._remove(key)
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        for tag in list(self._tagged):
+            self.invalidate(tag)
+        self._entries.clear()
+
+
+def category_tag(cat_id: int) -> Tuple[str, int]:
+    """
+    Tag for a category page: its topic listings and the topic counts of its subcategories. Invalidate it when a
+    topic in the category or in one of its children, or a reply to one, changes.
+    """
+    return 'category', cat_id
+
+
+def title_tag(topic_id: int) -> Tuple[str, int]:
+    """
+    Tag for the title and visibility of a topic in the title index. Only the bus carries it, see Caches.put_title.
+    """
+    return 'title', topic_id
+
+
+def topic_tag(topic_id: int) -> Tuple[str, int]:
+    """
+    Tag for a topic page. Invalidate it when the topic, its replies or their attachments change.
+    """
+    return 'topic', topic_id
+
+
+# Tag for cached search results. Results show topics with their reply counts, authors and categories, so every write
+# reported to Caches drops them.
+SEARCH_TAG = ('search',)
+
+
+# Tag for the category tree itself. Every page showing a breadcrumb depends on it, so invalidate it when any category
+# is created, renamed, moved or deleted.
+CATEGORY_TREE_TAG = ('categories',)
+
+
+class VersionTable:
+    """
+    Counts the writes made to each tag so that a page can be given a validator without rendering it.
+
+    On its own, a table counts in process memory, so it gets a random epoch that is part of each stamp: a restarted
+    (or different) process never produces a stamp that an older page was given. Once shared (see share()), versions
+    are the ids of the invalidations published to the bus instead, so every worker gives the same page the same stamp
+    and a revalidation can be answered by any of them.
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(6).hex()
+        self._prefix = self.epoch
+        self._versions: Dict[Hashable, str] = {}
+        self._shared = False
+        # the version of tags not written to since the table was shared
+        self._base = '0'
+        # tag -> writes made by this process that haven't been read back from the bus yet, and the unique version
+        # standing in for them until they are
+        self._pending: Dict[Hashable, Tuple[int, str]] = {}
+        self._local = 0
+
+    def share(self, latest_id: int):
+        """
+        Switches to the versions shared through the bus, starting after the invalidation with the id `latest_id`.
+        """
+        self._prefix = 's'
+        self._shared = True
+        # every write to a tag without a later invalidation has an id up to latest_id
+        self._base = str(latest_id)
+        self._versions.clear()
+        self._pending.clear()
+
+    def _provisional(self) -> str:
+        self._local += 1
+        return f'{self.epoch}-{self._local}'
+
+    def bump(self, tag: Hashable):
+        """
+        Records a write to `tag` made by this process.
+        """
+        if not self._shared:
+            self._versions[tag] = str(int(self._versions.get(tag, '0')) + 1)
+            return
+        # its id isn't known until the bus reads it back, so until then the tag gets a version no other process uses
+        count, _ = self._pending.get(tag, (0, ''))
+        self._pending[tag] = (count + 1, self._provisional())
+
+    def published(self, tag: Hashable, row_id: int, local: bool):
+        """
+        Records the invalidation of `tag` with the id `row_id` read from the bus, which this process published if
+        `local`.
+        """
+        self._versions[tag] = str(max(row_id, int(self._versions.get(tag, self._base))))
+        if (pending := self._pending.get(tag)) is None:
+            return
+        if not local:
+            # the stand-in must change too
+            self._pending[tag] = (pending[0], self._provisional())
+        elif pending[0] > 1:
+            self._pending[tag] = (pending[0] - 1, pending[1])
+        else:
+            del self._pending[tag]
+
+    def _version(self, tag: Hashable) -> str:
+        if (pending := self._pending.get(tag)) is not None:
+            return pending[1]
+        return self._versions.get(tag, self._base)
+
+    def stamp(self, *tags: Hashable) -> str:
+        """
+        Returns a string that changes whenever any of `tags` is bumped.
+        """
+        return '.'.join((self._prefix, *(self._version(t) for t in tags)))
+
+
+class Caches:
+    """
+    The in-process caches of a worker, and the single place writes are reported to.
+    """
+
+    def __init__(self, fragments: FragmentCache, versions: VersionTable, search: FragmentCache, titles: TitleIndex):
+        self.fragments = fragments
+        self.versions = versions
+        # SearchHits by (query, whether hidden topics are included), all tagged SEARCH_TAG
+        self.search = search
+        # the titles of all topics, for suggestions
+        self.titles = titles
+        # forums.bus.InvalidationBus forwarding invalidations to the other workers, if there are any
+        self.bus = None
+
+    def _drop(self, *tags: Hashable):
+        for tag in tags:
+            self.fragments.invalidate(tag)
+        if tags:
+            self.search.invalidate(SEARCH_TAG)
+
+    def apply(self, *tags: Hashable):
+        """
+        Drops the fragments carrying `tags` and bumps their versions, in this worker only.
+        """
+        self._drop(*tags)
+        for tag in tags:
+            self.versions.bump(tag)
+
+    def apply_published(self, row_id: int, tag: Hashable, local: bool):
+        """
+        Applies an invalidation read from the bus, which this worker published itself if `local`.
+        """
+        if tag[0] == 'title':
+            # the worker that wrote the topic has updated its own index already
+            if not local:
+                self.titles.stale(tag[1])
+            return
+        if not local:
+            self._drop(tag)
+        self.versions.published(tag, row_id, local)
+
+    def put_title(self, topic: Topic):
+        """
+        Records the title and visibility of a topic that was created or changed, in this worker right away and in every
+        other worker shortly after.
+        """
+        self.titles.put(topic)
+        if self.bus is not None:
+            self.bus.publish((title_tag(topic.topic_id),))
+
+    def invalidate(self, *tags: Hashable):
+        """
+        Records a write affecting `tags`, in this worker right away and in every other worker shortly after.
+        """
+        self.apply(*tags)
+        if self.bus is not None:
+            self.bus.publish(tags)
+
+
+class CategoryListing(BaseModel):
+    """
+    The cached, viewer independent part of a category page.
+    """
+    total_results: int
+    pins_html: str
+    topics_html: str
+    # the listed topics, most recently active first
+    topic_ids: Tuple[int, ...] = ()
+
+
+class ReplyListing(BaseModel):
+    """
+    The cached, viewer independent part of a topic page: its html, split wherever the viewer's CSRF token belongs.
+    """
+    total_results: int
+    html_parts: Tuple[str, ...]
+
+    @classmethod
+    def from_html(cls, total_results: int, html: str) -> 'ReplyListing':
+        """
+        Splits `html`, rendered with CSRF_PLACEHOLDER as the CSRF token, where the token belongs.
+        """
+        return cls(total_results=total_results, html_parts=tuple(html.split(CSRF_PLACEHOLDER)))
+
+    def html(self, csrf_token: str) -> str:
+        """
+        The html with the viewer's `csrf_token` put in place.
+        """
+        return str(escape(csrf_token)).join(self.html_parts)
+
+
+class SearchHits(BaseModel):
+    """
+    The cached result of a search: the ids of its first results, in order, and how many results there are in all.
+    """
+    total_results: int
+    topic_ids: Tuple[int, ...]
+
+
+# Rendered into cached fragments in place of the per-user CSRF token, see ReplyListing. It is random and never sent to
+# anyone, so that no user can write it into a post and have every viewer's token shown there.
+CSRF_PLACEHOLDER = f'@@csrf-{os.urandom(16).hex()}@@'
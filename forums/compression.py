@@ -0,0 +1,138 @@
+"""
+Compression of response bodies on the fly.
+"""
+import zlib
+from typing import Callable, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from forums.assets import accepted_encodings
+from forums.config import CompressionConfig
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Statuses whose body (if any) must be left alone
+_SKIP_STATUSES = (204, 206, 304)
+
+
+def gzip_compressor(level: int) -> Tuple[Callable[[bytes], bytes], Callable[[], bytes], Callable[[], bytes]]:
+    """
+    Returns (compress, flush, finish) for a gzip stream. flush() emits everything compressed so far, so that the
+    client can decode it without waiting for the rest of the stream.
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+
+def brotli_compressor(quality: int) -> Tuple[Callable[[bytes], bytes], Callable[[], bytes], Callable[[], bytes]]:
+    """
+    Returns (compress, flush, finish) for a brotli stream. See gzip_compressor.
+    """
+    c = brotli.Compressor(quality=quality)
+    return c.process, c.flush, c.finish
+
+
+class CompressionMiddleware:
+    """
+    Compresses response bodies with brotli (if the brotli package is installed) or gzip, whichever the client
+    prefers to accept.
+
+    Only bodies of the configured content types and at least `minimum_size` bytes are compressed. Responses that
+    are already encoded, downloads (Content-Disposition: attachment) and partial responses pass through untouched.
+    Streaming responses are compressed chunk by chunk, and every chunk is flushed so that streaming still works.
+    """
+
+    def __init__(self, app: ASGIApp, conf: CompressionConfig):
+        self.app = app
+        self.conf = conf
+
+    def _choose(self, scope: Scope) -> Optional[str]:
+        accepted = accepted_encodings(Headers(scope=scope).get('accept-encoding'))
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not self.conf.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self._choose(scope)
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.conf))
+
+
+class _CompressingSend:
+    def __init__(self, send: Send, encoding: Optional[str], conf: CompressionConfig):
+        self.send = send
+        self.encoding = encoding
+        self.conf = conf
+        self.start: Optional[Message] = None
+        # None until the first body message decides what to do
+        self.compress: Optional[Tuple[Callable[[bytes], bytes], Callable[[], bytes], Callable[[], bytes]]] = None
+        self.passthrough = False
+
+    def _eligible(self, headers: MutableHeaders) -> bool:
+        if self.start['status'] in _SKIP_STATUSES or 'content-encoding' in headers or 'content-range' in headers:
+            return False
+        if headers.get('content-disposition', '').lower().startswith('attachment'):
+            return False
+        media_type = headers.get('content-type', '').split(';', 1)[0].strip().lower()
+        return media_type in self.conf.content_types
+
+    def _new_compressor(self):
+        if self.encoding == 'br':
+            return brotli_compressor(self.conf.brotli_quality)
+        return gzip_compressor(self.conf.gzip_level)
+
+    def _mark_encoded(self, headers: MutableHeaders):
+        headers['Content-Encoding'] = self.encoding
+        # a strong validator would claim the compressed bytes equal the uncompressed ones
+        if (etag := headers.get('etag')) is not None and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag
+
+    async def __call__(self, message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            self.start = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if self.compress is None:
+            headers = MutableHeaders(raw=self.start['headers'])
+            eligible = self._eligible(headers)
+            if eligible:
+                headers.add_vary_header('Accept-Encoding')
+
+            if not eligible or self.encoding is None or (not more_body and len(body) < self.conf.minimum_size):
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+
+            self.compress = self._new_compressor()
+            self._mark_encoded(headers)
+            if not more_body:
+                compress, _, finish = self.compress
+                data = compress(body) + finish()
+                headers['Content-Length'] = str(len(data))
+                await self.send(self.start)
+                await self.send({'type': 'http.response.body', 'body': data, 'more_body': False})
+                return
+
+            # streaming: the final length is unknown
+            del headers['Content-Length']
+            await self.send(self.start)
+
+        compress, flush, finish = self.compress
+        data = compress(body) + (flush() if more_body else finish())
+        await self.send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
@@ -0,0 +1,59 @@
+"""
+Helpers for answering conditional requests (If-None-Match) without doing the work of building the response.
+"""
+import hashlib
+import time
+from typing import Dict
+
+from fastapi import Request
+from starlette import status
+from starlette.responses import Response
+
+from forums.db.users import User
+from forums.routes.auth import extract_from_cookie
+
+# Pages are personalised (and carry CSRF tokens), so shared caches must not store them, and browsers must revalidate
+# them on every load. Revalidation is cheap thanks to the ETag.
+PAGE_CACHE_CONTROL = 'private, no-cache'
+
+# CSRF tokens embedded in a page are valid for 24 hours. Rolling the ETag over twice as often guarantees that a
+# revalidated page never carries a token older than half its lifetime.
+_CSRF_BUCKET_SECONDS = 12 * 60 * 60
+
+
+def page_etag(req: Request, user: User, version: str) -> str:
+    """
+    Builds the weak ETag of a page from the version of the data it shows and everything about the viewer that
+    changes its rendering: their role and their login session (which their CSRF tokens are bound to).
+    """
+    _, csrf_secret = extract_from_cookie(req)
+    session = hashlib.blake2b(f'{user.user_id}:{csrf_secret}'.encode('utf-8'), digest_size=8).hexdigest()
+    bucket = int(time.time()) // _CSRF_BUCKET_SECONDS
+
+    return f'W/"{version}-{user.flags}-{session}-{bucket}"'
+
+
+def _opaque(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches(req: Request, etag: str) -> bool:
+    """
+    Whether the request's If-None-Match header matches `etag`, using the weak comparison of RFC 9110 section 8.8.3.2.
+    """
+    if (header := req.headers.get('if-none-match')) is None:
+        return False
+    if header.strip() == '*':
+        return True
+
+    tag = _opaque(etag)
+    return any(_opaque(candidate) == tag for candidate in header.split(','))
+
+
+def page_headers(etag: str) -> Dict[str, str]:
+    return {'ETag': etag, 'Cache-Control': PAGE_CACHE_CONTROL}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=page_headers(etag))
@@ -32,8 +32,184 @@ class StorageConfig(BaseModel):
     path: str = Field(default='uploads')
     allow_av_types: List[str] = Field(default=['image/png', 'image/jpeg', 'image/webp', 'image/avif'])
     allow_attach_types: List[str] = Field(default=['image/*', 'audio/*', 'video/*', 'text/*'])
-    # note: this is a global limit
+    # The largest request body accepted by the routes that take file uploads, i.e. for all files of one request
+    # together. Other routes are limited by request.max_form_size.
     max_file_size: int = Field(default=1024 * 1024 * 20, ge=0)
+    # How many files of one request are copied into storage at the same time
+    upload_concurrency: int = Field(default=4, gt=0)
+    # How attachment downloads are sent once the permission check has passed. "direct" streams the file from the
+    # application. "x-accel-redirect" (nginx) and "x-sendfile" (Apache, lighttpd) only send a header naming the file
+    # and leave the transfer, including Range requests, to the fronting web server.
+    send_mode: str = Field(default='direct', pattern='^(direct|x-accel-redirect|x-sendfile)$')
+    # With x-accel-redirect, the internal nginx location that serves the contents of `path`
+    accel_redirect_prefix: str = Field(default='/_attachments/')
+
+
+class RequestConfig(BaseModel):
+    # The largest request body accepted by routes that don't take file uploads (logins, posts without attachments,
+    # moderation forms), in bytes
+    max_form_size: int = Field(default=64 * 1024, gt=0)
+    # How long a search may take before it is abandoned, its database queries are killed and the user is asked to try
+    # again, in seconds. A search is also abandoned when its client disconnects. 0 for no limit.
+    search_deadline: float = Field(default=10, ge=0)
+
+
+class RateLimitRule(BaseModel):
+    # The sustained number of requests allowed per minute. 0 turns the limit off.
+    per_minute: float = Field(ge=0)
+    # How many requests may be made at once after a quiet period
+    burst: int = Field(ge=1)
+
+
+class RateLimitConfig(BaseModel):
+    # Whether the expensive routes below are rate limited. Limits are kept by each worker process, so with several
+    # workers a client can make up to `server.workers` times as many requests.
+    enabled: bool = Field(default=True)
+    # The number of clients each limit remembers. The least recently seen are forgotten first, which lets them start
+    # over with a full burst.
+    max_keys: int = Field(default=10000, gt=0)
+    # Login attempts per client IP address. Clients are identified by the address uvicorn reports, which takes
+    # X-Forwarded-For into account only for proxies listed in its --forwarded-allow-ips.
+    login: RateLimitRule = Field(default=RateLimitRule(per_minute=10, burst=10))
+    # Login attempts per username, from any address, against password guessing spread over many addresses
+    login_username: RateLimitRule = Field(default=RateLimitRule(per_minute=5, burst=10))
+    # Registrations per client IP address
+    registration: RateLimitRule = Field(default=RateLimitRule(per_minute=2, burst=5))
+    # Searches per user
+    search: RateLimitRule = Field(default=RateLimitRule(per_minute=30, burst=10))
+    # New topics, replies and added attachments per user
+    post: RateLimitRule = Field(default=RateLimitRule(per_minute=10, burst=10))
+
+
+class ConcurrencyConfig(BaseModel):
+    # Whether each worker limits how many requests it handles at once, adapting the limit to the observed latency,
+    # and turns away the requests that can't be started in time with 503
+    enabled: bool = Field(default=True)
+    # The limit each worker starts with
+    initial_limit: int = Field(default=32, ge=1)
+    # The bounds of the limit
+    min_limit: int = Field(default=4, ge=1)
+    max_limit: int = Field(default=256, ge=1)
+    # The time to the start of the response of a GET request above which the worker counts as overloaded, in seconds.
+    # The limit grows by about one per round of requests answered faster, and shrinks by `backoff` at most once per
+    # this interval while requests are answered slower.
+    target_latency: float = Field(default=0.25, gt=0)
+    backoff: float = Field(default=0.9, gt=0, lt=1)
+    # The share of the limit that page views may use; the rest is kept for posts and other forms
+    read_share: float = Field(default=0.75, gt=0, le=1)
+    # How long a request may wait for a free slot before it is turned away, in seconds
+    queue_timeout: float = Field(default=0.5, ge=0)
+    # How many requests of each priority may wait at once. Further requests are turned away right away.
+    max_queue: int = Field(default=64, ge=0)
+
+
+class JobConfig(BaseModel):
+    # How often each worker looks for due jobs when it has none. Jobs queued by a worker are started by it right away.
+    poll_interval: float = Field(default=1.0, gt=0)
+    # How long a claimed job may run before other workers assume its worker died and run it again
+    lease: float = Field(default=300, gt=0)
+    # How often a job is attempted before it is given up on
+    max_attempts: int = Field(default=5, ge=1)
+    # The delay before the first retry of a failed job, doubled for every further retry, in seconds
+    retry_delay: float = Field(default=10, gt=0)
+    # The longest delay between retries, in seconds
+    max_retry_delay: float = Field(default=3600, gt=0)
+    # How long jobs that were given up on are kept for inspection, in seconds
+    failed_retention: int = Field(default=7 * 24 * 3600, ge=0)
+
+
+class ThumbnailConfig(BaseModel):
+    # Whether image attachments are shown as thumbnails. Requires the Pillow package; without it, image attachments
+    # are shown as links like any other attachment.
+    enabled: bool = Field(default=True)
+    # The longest side of a thumbnail, in pixels
+    size: int = Field(default=320, ge=16, le=2048)
+    # The format thumbnails are stored and sent in. AVIF files are smaller, but much slower to encode.
+    format: str = Field(default='webp', pattern='^(webp|avif)$')
+    # Encoder quality, from 1 (smallest) to 100 (best)
+    quality: int = Field(default=75, ge=1, le=100)
+    # Worker processes each server process uses to render thumbnails
+    workers: int = Field(default=1, ge=1)
+
+
+class CacheConfig(BaseModel):
+    # How long rendered topic listings and reply lists are served before being recomputed
+    fragment_ttl: float = Field(default=30, ge=0)
+    # How much longer an expired fragment may be served while a single request recomputes it in the background
+    fragment_stale_ttl: float = Field(default=300, ge=0)
+    # The maximum number of rendered fragments kept in memory
+    fragment_max_entries: int = Field(default=2048, gt=0)
+    # How long the results of a search are reused. Any write to a topic or a reply drops all of them, so this only
+    # bounds how long a worker keeps the results of queries nobody repeats.
+    search_ttl: float = Field(default=300, ge=0)
+    # The maximum number of searches whose results are kept in memory
+    search_max_entries: int = Field(default=1024, gt=0)
+    # How many results of each search are kept, i.e. the first pages. Later pages are queried every time.
+    search_max_results: int = Field(default=1000, gt=0)
+    # How often each worker applies the invalidations published by other workers (MySQL backend only). This bounds
+    # how long one worker can serve cached data made stale by a write handled by another.
+    invalidation_poll_interval: float = Field(default=0.5, gt=0)
+    # How long published invalidations are kept in the database, in seconds
+    invalidation_retention: int = Field(default=3600, ge=60)
+    # How many of the most recently active topics each worker renders into the fragment cache at startup
+    warm_topics: int = Field(default=50, ge=0)
+
+
+class TemplateConfig(BaseModel):
+    # The directory containing the page templates
+    directory: str = Field(default='templates')
+    # In production mode templates are not checked for changes after they are first loaded, so edits require a
+    # restart.
+    production: bool = Field(default=False)
+    # Where compiled templates are stored in production mode. Workers share it, so templates are compiled once
+    # rather than by every worker. Run `python -m forums.templates DIR` at build time to fill it ahead of time.
+    bytecode_cache_dir: Optional[str] = Field(default=None)
+    # Send large pages (topics) while they are rendered, so that the top of the page arrives before the replies
+    # have been loaded. The status of a streamed page can't change once rendering starts, so an error while rendering
+    # cuts the page short instead of showing an error page.
+    stream_pages: bool = Field(default=True)
+
+
+class AssetConfig(BaseModel):
+    # The directory holding the static assets served under /static
+    directory: str = Field(default='static')
+    # The output of `python -m forums.assets DIR`. When set, /static serves fingerprinted, precompressed assets from
+    # it instead of `directory`, and the build must be rerun whenever the assets change.
+    build_dir: Optional[str] = Field(default=None)
+
+
+class CompressionConfig(BaseModel):
+    # Whether responses are compressed by the application. Turn this off if a fronting web server compresses them.
+    enabled: bool = Field(default=True)
+    # Responses smaller than this many bytes are sent as is
+    minimum_size: int = Field(default=1024, ge=0)
+    # zlib level (1 to 9) used for gzip. Higher levels save bandwidth at the cost of CPU time.
+    gzip_level: int = Field(default=6, ge=1, le=9)
+    # brotli quality (0 to 11), used when the brotli package is installed and the client accepts it
+    brotli_quality: int = Field(default=5, ge=0, le=11)
+    # Only these content types are compressed. Images, audio and video are already compressed.
+    content_types: List[str] = Field(default=['text/html', 'text/css', 'text/plain', 'text/javascript',
+                                              'application/javascript', 'application/json', 'image/svg+xml'])
+
+
+class ServerConfig(BaseModel):
+    # How many worker processes `python -m forums.launcher` runs. One per CPU core is a good starting point.
+    workers: int = Field(default=1, ge=1)
+    # The total number of MySQL connections all workers together may open. Each worker's pool gets an equal share,
+    # unless db.maxsize is set. Keep it below the server's max_connections.
+    db_connection_budget: int = Field(default=32, ge=1)
+    # The event loop to use: "auto" picks uvloop if it is installed
+    loop: str = Field(default='auto', pattern='^(auto|asyncio|uvloop)$')
+    # The HTTP parser to use: "auto" picks httptools if it is installed
+    http: str = Field(default='auto', pattern='^(auto|h11|httptools)$')
+    # Connections waiting to be accepted before the OS starts refusing them
+    backlog: int = Field(default=2048, gt=0)
+    # How long workers may spend finishing in-flight requests after SIGTERM, in seconds
+    graceful_timeout: int = Field(default=30, ge=0)
+    # MySQL connections each worker opens and checks at startup, before it accepts requests (at most its pool size)
+    warm_connections: int = Field(default=4, ge=0)
+    # How long a worker may spend filling its caches at startup before it starts accepting requests anyway
+    warmup_timeout: float = Field(default=30, gt=0)
 
 
 class Config(BaseModel):
@@ -41,6 +217,10 @@ class Config(BaseModel):
     listen_ip: str = Field(default='127.0.0.1')
     # The port to listen on.
     listen_port: int = Field(default=8080, gt=0, le=65565)
+    # Which storage backend the repositories use. "mysql" is the real database. "memory" keeps everything in
+    # process memory and loses it on exit; it exists so that the web, template and auth layers can be tested and
+    # benchmarked without a database server.
+    backend: str = Field(default='mysql', pattern='^(mysql|memory)$')
     # The database configuration. This attributes are passed to
     # aiomysql's connect. See https://aiomysql.readthedocs.io/en/stable/connection.html#connection
     db: dict = Field(default_factory=dict)
@@ -48,6 +228,32 @@ class Config(BaseModel):
     login: LoginConfig
     # configuration for attachments and avatar image uploads
     storage: StorageConfig
+    # configuration for limits on requests
+    request: RequestConfig = Field(default_factory=RequestConfig)
+    # configuration for rate limits on expensive routes
+    rate_limits: RateLimitConfig = Field(default_factory=RateLimitConfig)
+    # configuration for adaptive concurrency limits and load shedding
+    concurrency: ConcurrencyConfig = Field(default_factory=ConcurrencyConfig)
+    # configuration for the background job queue
+    jobs: JobConfig = Field(default_factory=JobConfig)
+    # configuration for thumbnails of image attachments
+    thumbnails: ThumbnailConfig = Field(default_factory=ThumbnailConfig)
+    # configuration for in-process caches
+    cache: CacheConfig = Field(default_factory=CacheConfig)
+    # configuration for page templates
+    templates: TemplateConfig = Field(default_factory=TemplateConfig)
+    # configuration for static assets
+    assets: AssetConfig = Field(default_factory=AssetConfig)
+    # configuration for response compression
+    compression: CompressionConfig = Field(default_factory=CompressionConfig)
+    # configuration for the production launcher
+    server: ServerConfig = Field(default_factory=ServerConfig)
+
+    def db_pool_size(self) -> int:
+        """
+        The size of each worker's connection pool: an equal share of the connection budget.
+        """
+        return max(1, self.server.db_connection_budget // self.server.workers)
 
 
 def load_config() -> Config:
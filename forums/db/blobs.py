@@ -0,0 +1,82 @@
+from typing import Awaitable, Callable, Sequence, Tuple
+
+from aiomysql import Connection, Pool
+from pydantic import BaseModel, Field
+
+from forums.db.utils import transaction
+
+
+class Blob(BaseModel):
+    """
+    The contents of one or more attachments, identified by their SHA-256.
+    """
+    sha256: str = Field(min_length=64, max_length=64)
+    size: int
+    mime_type: str = Field(max_length=128)
+
+
+class BlobRepository:
+    """
+    The attachmentBlobs table. Blob rows only change together with the attachment rows referencing them, so the
+    attachment repositories use the "friend" functions below inside their own transactions.
+
+    The file of a blob is only put in place or removed while the blob's row is locked. An upload and the deletion of
+    the last other reference to the same contents therefore can't interleave and leave a row without a file.
+    """
+
+    def __init__(self, db: Pool):
+        self.__db = db
+
+    async def get_hashes_after(self, after: str, limit: int) -> Tuple[str, ...]:
+        """
+        Returns the hashes of up to `limit` blobs that sort after `after`, in order.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT sha256 FROM attachmentBlobs WHERE sha256 > %s ORDER BY sha256 LIMIT %s;',
+                                  (after, limit))
+                return tuple(row[0] for row in await cur.fetchall())
+
+    async def remove_if_unreferenced(self, sha256: str, remove: Callable[[str], Awaitable[None]]) -> bool:
+        """
+        Calls `remove` to delete the file of the blob `sha256`, unless the blob exists (again). Returns whether it
+        was called.
+
+        This is how files of blobs are removed after the transaction that dropped their last reference. Looking for
+        the missing row locks the gap it would be in (at the default REPEATABLE READ isolation level), so an upload
+        of the same contents waits until `remove` is done rather than losing its file to it.
+        """
+        async with self.__db.acquire() as conn, transaction(conn):
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT refCount FROM attachmentBlobs WHERE sha256 = %s FOR UPDATE;', (sha256, ))
+                if await cur.fetchone() is not None:
+                    return False
+            await remove(sha256)
+            return True
+
+    @classmethod
+    async def _add_references(cls, conn: Connection, blobs: Sequence[Blob]) -> None:
+        """
+        Counts one new reference to each of `blobs`, adding the blobs that are new. Call it before inserting the rows
+        referencing the blobs, which the foreign keys require, and move the files of the blobs into place only after
+        both, so that the files only need to be cleaned up if that fails itself.
+        """
+        # lock the rows in a consistent order, so that two uploads sharing blobs can't deadlock
+        blobs = sorted(blobs, key=lambda b: b.sha256)
+        async with conn.cursor() as cur:
+            await cur.executemany('INSERT INTO attachmentBlobs (sha256, size, mimeType, refCount) '
+                                  'VALUES (%s, %s, %s, 1) ON DUPLICATE KEY UPDATE refCount = refCount + 1;',
+                                  [(b.sha256, b.size, b.mime_type) for b in blobs])
+
+    @classmethod
+    async def _drop_reference(cls, conn: Connection, sha256: str, remove: Callable[[str], Awaitable[None]]) -> None:
+        """
+        Removes a reference to the blob `sha256`. If it was the last one, calls `remove` to delete its file and
+        deletes the blob.
+        """
+        async with conn.cursor() as cur:
+            await cur.execute('UPDATE attachmentBlobs SET refCount = refCount - 1 WHERE sha256 = %s;', (sha256, ))
+            await cur.execute('SELECT refCount FROM attachmentBlobs WHERE sha256 = %s;', (sha256, ))
+            if (row := await cur.fetchone()) is not None and row[0] == 0:
+                await remove(sha256)
+                await cur.execute('DELETE FROM attachmentBlobs WHERE sha256 = %s;', (sha256, ))
@@ -0,0 +1,52 @@
+from typing import Iterable, Tuple
+
+from aiomysql import Pool
+
+# (id, origin, tag)
+_ROW = Tuple[int, str, str]
+
+
+class InvalidationRepository:
+    """
+    The cacheInvalidations table, through which workers tell each other which cached data a write made stale.
+    """
+
+    def __init__(self, db: Pool):
+        self.__db = db
+
+    async def put_invalidations(self, origin: str, tags: Iterable[str]) -> None:
+        """
+        Records that the worker `origin` invalidated each of `tags`.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany('INSERT INTO cacheInvalidations (origin, tag) VALUES (%s, %s);',
+                                      [(origin, tag) for tag in tags])
+
+    async def get_latest_id(self) -> int:
+        """
+        Returns the id of the newest invalidation, or 0 if there are none.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT COALESCE(MAX(id), 0) FROM cacheInvalidations;')
+                return (await cur.fetchone())[0]
+
+    async def get_invalidations_after(self, after_id: int, limit: int) -> Tuple[_ROW, ...]:
+        """
+        Returns up to `limit` invalidations with an id greater than `after_id`, oldest first.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT id, origin, tag FROM cacheInvalidations WHERE id > %s ORDER BY id LIMIT %s;',
+                                  (after_id, limit))
+                return tuple(await cur.fetchall())
+
+    async def delete_older_than(self, seconds: int) -> int:
+        """
+        Deletes invalidations recorded more than `seconds` ago and returns how many were deleted.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                return await cur.execute('DELETE FROM cacheInvalidations '
+                                         'WHERE createdAt < NOW() - INTERVAL %s SECOND LIMIT 10000;', (seconds, ))
@@ -0,0 +1,130 @@
+import json
+from datetime import datetime
+from typing import Any, Optional, Tuple
+
+from aiomysql import Pool
+from pydantic import BaseModel, Field
+
+from forums.db.utils import transaction
+
+# lastError is cut to this many characters
+MAX_ERROR_LENGTH = 2000
+
+
+class Job(BaseModel):
+    id: Optional[int] = Field(default=None)
+    kind: str = Field(max_length=64)
+    payload: dict
+    # how often the job has been claimed, including the current attempt
+    attempts: int = Field(default=0)
+    run_at: Optional[datetime] = Field(default=None)
+    last_error: Optional[str] = Field(default=None)
+
+
+class JobBacklog(BaseModel):
+    kind: str
+    # jobs due to run now
+    ready: int
+    # jobs waiting for a retry or a later start, and jobs being run
+    scheduled: int
+    # jobs that ran out of attempts
+    failed: int
+    # when the oldest job still to run was created
+    oldest: Optional[datetime]
+
+
+def _maybe_row_to_job(row: Any) -> Optional[Job]:
+    if row is None:
+        return None
+
+    return Job(id=row[0], kind=row[1], payload=json.loads(row[2]), attempts=row[3], run_at=row[4], last_error=row[5])
+
+
+class JobRepository:
+    """
+    The jobs table, the queue of work deferred by request handlers. See forums.jobs.
+    """
+
+    def __init__(self, db: Pool):
+        self.__db = db
+
+    async def put_job(self, job: Job, delay: float = 0) -> int:
+        """
+        Queues a job to run `delay` seconds from now.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('INSERT INTO jobs (kind, payload, runAt) '
+                                  'VALUES (%s, %s, NOW(3) + INTERVAL %s MICROSECOND);',
+                                  (job.kind, json.dumps(job.payload), int(delay * 1e6)))
+                job.id = cur.lastrowid
+                return job.id
+
+    async def claim_jobs(self, kind: str, limit: int, lease: float) -> Tuple[Job, ...]:
+        """
+        Claims up to `limit` jobs of `kind` that are due, oldest first, and counts an attempt for each. A claimed job
+        becomes due again after `lease` seconds, unless it is completed or rescheduled first, so that the jobs of a
+        worker that died are picked up by the others.
+
+        Jobs claimed by other workers at the same time are skipped rather than waited for.
+        """
+        async with self.__db.acquire() as conn, transaction(conn):
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT id, kind, payload, attempts, runAt, lastError FROM jobs '
+                                  'WHERE kind = %s AND failedAt IS NULL AND runAt <= NOW(3) '
+                                  'ORDER BY runAt LIMIT %s FOR UPDATE SKIP LOCKED;', (kind, limit))
+                jobs = tuple(_maybe_row_to_job(row) for row in await cur.fetchall())
+                if jobs:
+                    await cur.execute('UPDATE jobs SET attempts = attempts + 1, '
+                                      'runAt = NOW(3) + INTERVAL %s MICROSECOND WHERE id IN %s;',
+                                      (int(lease * 1e6), [job.id for job in jobs]))
+                for job in jobs:
+                    job.attempts += 1
+                return jobs
+
+    async def complete_job(self, job_id: int) -> None:
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('DELETE FROM jobs WHERE id = %s;', (job_id, ))
+
+    async def retry_job(self, job_id: int, delay: float, error: str) -> None:
+        """
+        Schedules another attempt at a job that failed, `delay` seconds from now.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('UPDATE jobs SET runAt = NOW(3) + INTERVAL %s MICROSECOND, lastError = %s '
+                                  'WHERE id = %s;', (int(delay * 1e6), error[:MAX_ERROR_LENGTH], job_id))
+
+    async def fail_job(self, job_id: int, error: str) -> None:
+        """
+        Gives up on a job. It is kept, but never run again.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('UPDATE jobs SET failedAt = NOW(), lastError = %s WHERE id = %s;',
+                                  (error[:MAX_ERROR_LENGTH], job_id))
+
+    async def get_backlog(self) -> Tuple[JobBacklog, ...]:
+        """
+        Counts the jobs of each kind.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT kind, '
+                                  'COALESCE(SUM(failedAt IS NULL AND runAt <= NOW(3)), 0), '
+                                  'COALESCE(SUM(failedAt IS NULL AND runAt > NOW(3)), 0), '
+                                  'COALESCE(SUM(failedAt IS NOT NULL), 0), '
+                                  'MIN(IF(failedAt IS NULL, createdAt, NULL)) '
+                                  'FROM jobs GROUP BY kind ORDER BY kind;')
+                return tuple(JobBacklog(kind=row[0], ready=row[1], scheduled=row[2], failed=row[3], oldest=row[4])
+                             for row in await cur.fetchall())
+
+    async def delete_failed_older_than(self, seconds: int) -> int:
+        """
+        Deletes jobs that failed more than `seconds` ago and returns how many were deleted.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                return await cur.execute('DELETE FROM jobs WHERE failedAt < NOW() - INTERVAL %s SECOND LIMIT 10000;',
+                                         (seconds, ))
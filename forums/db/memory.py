@@ -0,0 +1,750 @@
+import asyncio
+from bisect import insort, bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Optional, AsyncGenerator, Tuple, Dict, Set, List, Callable, Awaitable, Sequence
+
+from pymysql import IntegrityError
+
+from forums.db.blobs import Blob
+from forums.db.jobs import Job, JobBacklog, MAX_ERROR_LENGTH
+from forums.db.categories import Category
+from forums.db.post_attachment import PostAttachment
+from forums.db.posts import Post, PostWithAuthor
+from forums.db.topic_attachment import TopicAttachment
+from forums.db.topics import Topic, TopicWithAuthor
+from forums.db.users import User
+from forums.models import UserAPI
+
+# MySQL error codes, used so that callers which catch IntegrityError behave the same with either backend
+_ER_DUP_ENTRY = 1062
+_ER_ROW_IS_REFERENCED = 1451
+_ER_NO_REFERENCED_ROW = 1452
+
+# (topic is pinned, hidden topics/posts are included)
+_ListingKind = Tuple[bool, bool]
+_LISTING_KINDS: Tuple[_ListingKind, ...] = ((False, False), (False, True), (True, False), (True, True))
+
+
+def _now() -> datetime:
+    # TIMESTAMP columns have a resolution of one second and aiomysql hands them back as naive datetimes
+    return datetime.now().replace(microsecond=0)
+
+
+def _fk_error(what: str) -> IntegrityError:
+    return IntegrityError(_ER_NO_REFERENCED_ROW, f'Cannot add or update a child row: {what} does not exist')
+
+
+class _Aggregate:
+    """
+    The reply count and most recent reply time of a topic, which is what COUNT(P.postID) and MAX(P.createdAt)
+    compute in the listing queries.
+    """
+    __slots__ = ('count', 'most_recent')
+
+    def __init__(self, count: int = 0, most_recent: Optional[datetime] = None):
+        self.count = count
+        self.most_recent = most_recent
+
+
+class _JobRow:
+    """
+    A row of the jobs table: the job and the columns Job doesn't carry.
+    """
+    __slots__ = ('job', 'created_at', 'failed_at')
+
+    def __init__(self, job: Job, created_at: datetime):
+        self.job = job
+        self.created_at = created_at
+        self.failed_at: Optional[datetime] = None
+
+
+class MemoryDatabase:
+    """
+    An in-process stand-in for the MySQL database. The memory repositories below operate on it in the same way that
+    the SQL repositories operate on an aiomysql Pool.
+
+    Rows are kept in dicts keyed by primary key. Secondary indexes are kept for each lookup the repositories make,
+    and the topic listings of each category are kept in sorted lists so that paging is a slice rather than a sort.
+    Nothing is persisted, so this is only useful for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, User] = {}
+        self.categories: Dict[int, Category] = {}
+        self.topics: Dict[int, Topic] = {}
+        self.posts: Dict[int, Post] = {}
+        self.topic_attachments: Dict[int, TopicAttachment] = {}
+        self.post_attachments: Dict[int, PostAttachment] = {}
+        self.blobs: Dict[str, Blob] = {}
+        self.jobs: Dict[int, _JobRow] = {}
+
+        self.user_by_name: Dict[str, int] = {}
+        self.children_of: Dict[Optional[int], Set[int]] = defaultdict(set)
+        self.topics_of_category: Dict[int, Set[int]] = defaultdict(set)
+        self.topics_of_author: Dict[int, Set[int]] = defaultdict(set)
+        # (createdAt, postID), kept sorted, which is the order replies are shown in
+        self.posts_of_topic: Dict[int, List[Tuple[datetime, int]]] = defaultdict(list)
+        self.attachments_of_topic: Dict[int, Set[int]] = defaultdict(set)
+        self.attachments_of_post: Dict[int, Set[int]] = defaultdict(set)
+        # sha256 -> number of attachments referencing the blob
+        self.blob_refs: Dict[str, int] = {}
+        # held while a blob's file is moved into or out of place, like the row lock the SQL repositories take
+        self.blob_lock = asyncio.Lock()
+
+        # (cat_id, pinned, include_hidden) -> sort keys of the topics in that listing, in display order
+        self.listings: Dict[Tuple[int, bool, bool], List[tuple]] = defaultdict(list)
+        # topic_id -> the listings it currently appears in and its key in each, so it can be removed again
+        self._listing_keys: Dict[int, Dict[Tuple[int, bool, bool], tuple]] = {}
+
+        self._auto_increment: Dict[str, int] = defaultdict(int)
+
+    async def add_blob_references(self, blobs: Sequence[Blob], place: Callable[[], Awaitable[None]]):
+        """
+        See BlobRepository._add_references. Must be called with blob_lock held.
+        """
+        await place()
+        for blob in blobs:
+            self.blobs.setdefault(blob.sha256, blob.model_copy())
+            self.blob_refs[blob.sha256] = self.blob_refs.get(blob.sha256, 0) + 1
+
+    async def drop_blob_reference(self, sha256: str, remove: Callable[[str], Awaitable[None]]):
+        """
+        See BlobRepository._drop_reference. Must be called with blob_lock held.
+        """
+        self.blob_refs[sha256] -= 1
+        if self.blob_refs[sha256] == 0:
+            await remove(sha256)
+            del self.blob_refs[sha256]
+            del self.blobs[sha256]
+
+    def next_id(self, table: str) -> int:
+        self._auto_increment[table] += 1
+        return self._auto_increment[table]
+
+    def aggregate(self, topic_id: int, include_hidden: bool) -> _Aggregate:
+        """
+        Computes the reply count and time of the last reply for a topic.
+        """
+        replies = self.posts_of_topic.get(topic_id, ())
+        if include_hidden:
+            return _Aggregate(len(replies), replies[-1][0] if replies else None)
+
+        agg = _Aggregate()
+        for created_at, post_id in replies:
+            if not self.posts[post_id].is_hidden():
+                agg.count += 1
+                agg.most_recent = created_at
+        return agg
+
+    @staticmethod
+    def _sort_key(topic: Topic, agg: _Aggregate) -> tuple:
+        # ORDER BY most_recent_repl DESC, topic_created DESC, topic_title; MySQL sorts NULLs last when descending
+        return (agg.most_recent is None, -agg.most_recent.timestamp() if agg.most_recent else 0.0,
+                -topic.created_at.timestamp(), topic.title.casefold(), topic.topic_id)
+
+    def reindex_topic(self, topic_id: int):
+        """
+        Moves a topic to its correct place in the category listings. Must be called whenever a topic or one of its
+        replies changes in a way that could affect its position.
+        """
+        for listing, key in self._listing_keys.pop(topic_id, {}).items():
+            keys = self.listings[listing]
+            del keys[bisect_left(keys, key)]
+
+        if (topic := self.topics.get(topic_id)) is None:
+            return
+
+        placed = {}
+        for pinned, include_hidden in _LISTING_KINDS:
+            if topic.is_pinned() != pinned or (topic.is_hidden() and not include_hidden):
+                continue
+            # the pinned listing counts hidden replies even for regular users
+            key = self._sort_key(topic, self.aggregate(topic_id, include_hidden or pinned))
+            listing = (topic.parent_cat, pinned, include_hidden)
+            insort(self.listings[listing], key)
+            placed[listing] = key
+        self._listing_keys[topic_id] = placed
+
+    def author_of(self, user_id: int) -> Optional[UserAPI]:
+        if (user := self.users.get(user_id)) is None:
+            return None
+        return UserAPI.from_user(user)
+
+    def topic_with_author(self, topic_id: int, include_hidden_replies: bool,
+                          with_cat_name: bool = False) -> Optional[TopicWithAuthor]:
+        topic = self.topics[topic_id]
+        if (author := self.author_of(topic.author_id)) is None:
+            # the SQL inner joins against the author
+            return None
+
+        agg = self.aggregate(topic_id, include_hidden_replies)
+        return TopicWithAuthor(topic_id=topic.topic_id, parent_cat=topic.parent_cat, author=author, title=topic.title,
+                               content=topic.content, created_at=topic.created_at, flags=topic.flags,
+                               num_replies=agg.count, most_recent_reply=agg.most_recent,
+                               parent_cat_name=self.categories[topic.parent_cat].cat_name if with_cat_name else None)
+
+
+class MemoryUserRepository:
+    """
+    UserRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_user_by_id(self, user_id: int) -> Optional[User]:
+        user = self.__db.users.get(user_id)
+        return user.model_copy() if user is not None else None
+
+    async def get_user_by_name(self, username: str) -> Optional[User]:
+        user_id = self.__db.user_by_name.get(username.casefold())
+        return await self.get_user_by_id(user_id) if user_id is not None else None
+
+    async def put_user(self, user: User) -> int:
+        db = self.__db
+        name_key = user.username.casefold()
+
+        if (owner := db.user_by_name.get(name_key)) is not None and owner != user.user_id:
+            raise IntegrityError(_ER_DUP_ENTRY, f"Duplicate entry '{user.username}' for key 'ck_user_name'")
+
+        if user.user_id is None:
+            user.user_id = db.next_id('loginTable')
+        elif (old := db.users.get(user.user_id)) is None:
+            raise KeyError(f'failed updating user {user.username}: there is no such user with user_id {user.user_id}')
+        else:
+            del db.user_by_name[old.username.casefold()]
+
+        db.users[user.user_id] = user.model_copy()
+        db.user_by_name[name_key] = user.user_id
+        return user.user_id
+
+
+class MemoryCategoryRepository:
+    """
+    CategoryRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_category_by_id(self, cat_id: int) -> Optional[Category]:
+        cat = self.__db.categories.get(cat_id)
+        return cat.model_copy() if cat is not None else None
+
+    async def get_all_categories(self) -> Tuple[Category, ...]:
+        return tuple(self.__db.categories[k].model_copy() for k in sorted(self.__db.categories))
+
+    async def get_subcategories_of_category(self, cat_id: Optional[int], include_hidden_in_cnt=True) -> AsyncGenerator[Tuple[Category, int], None]:
+        db = self.__db
+        counted = []
+        for child_id in db.children_of.get(cat_id, ()):
+            topics = db.topics_of_category.get(child_id, ())
+            if include_hidden_in_cnt:
+                count = len(topics)
+            else:
+                count = sum(1 for t in topics if not db.topics[t].is_hidden())
+                # the SQL filters on the outer joined topic table, which drops categories without visible topics
+                if count == 0:
+                    continue
+            counted.append((-count, child_id))
+
+        counted.sort()
+        for neg_count, child_id in counted:
+            yield db.categories[child_id].model_copy(), -neg_count
+
+    async def delete_category(self, cat_id: int) -> None:
+        assert cat_id is not None
+        db = self.__db
+
+        if (cat := db.categories.get(cat_id)) is None:
+            return
+        if db.children_of.get(cat_id) or db.topics_of_category.get(cat_id):
+            raise IntegrityError(_ER_ROW_IS_REFERENCED, 'Cannot delete or update a parent row: category is in use')
+
+        del db.categories[cat_id]
+        db.children_of[cat.parent_cat].discard(cat_id)
+
+    async def put_category(self, cat: Category) -> int:
+        db = self.__db
+        if cat.parent_cat is not None and cat.parent_cat not in db.categories:
+            raise _fk_error(f'category {cat.parent_cat}')
+
+        if cat.id is None:
+            cat.id = db.next_id('categories')
+        elif (old := db.categories.get(cat.id)) is None:
+            raise KeyError(f'failed to update category {cat.cat_name} (id = {cat.id}): no such category')
+        else:
+            db.children_of[old.parent_cat].discard(cat.id)
+
+        db.categories[cat.id] = cat.model_copy()
+        db.children_of[cat.parent_cat].add(cat.id)
+        return cat.id
+
+
+class MemoryTopicRepository:
+    """
+    TopicRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_topic_by_id(self, topic_id: int, include_hidden=False) -> Optional[Topic]:
+        topic = self.__db.topics.get(topic_id)
+        if topic is None or (topic.is_hidden() and not include_hidden):
+            return None
+        return topic.model_copy()
+
+    def _listing(self, category_id: int, pinned: bool, include_hidden: bool, start: int = 0,
+                 stop: Optional[int] = None) -> Tuple[TopicWithAuthor, ...]:
+        db = self.__db
+        keys = db.listings.get((category_id, pinned, include_hidden), ())[start:stop]
+        results = (db.topic_with_author(key[-1], include_hidden or pinned) for key in keys)
+        return tuple(t for t in results if t is not None)
+
+    async def get_pinned_topics(self, category_id: int, include_hidden=False) -> Tuple[TopicWithAuthor, ...]:
+        return self._listing(category_id, True, include_hidden)
+
+    async def generate_category_list_data(self, category_id: int, include_hidden=False, limit: int = 20,
+                                          skip: int = 0) -> \
+            Tuple[int, Tuple[TopicWithAuthor, ...]]:
+        total_results = len(self.__db.listings.get((category_id, False, include_hidden), ()))
+        return total_results, self._listing(category_id, False, include_hidden, skip, skip + limit)
+
+    async def get_topics_of_author(self, author_id: int, limit: int = 20, skip: int = 0, include_hidden=False) -> \
+            AsyncGenerator[Topic, None]:
+        db = self.__db
+        topics = [db.topics[t] for t in db.topics_of_author.get(author_id, ())]
+        topics = [t for t in topics if include_hidden or not t.is_hidden()]
+        topics.sort(key=lambda t: (t.created_at, t.topic_id), reverse=True)
+        for topic in topics[skip:skip + limit]:
+            yield topic.model_copy()
+
+    async def generate_search_result_data(self, query: str, limit: int = 20, skip: int = 0, include_hidden=False,
+                                          timeout: Optional[float] = None) -> \
+            Tuple[int, Tuple[TopicWithAuthor, ...]]:
+        db = self.__db
+        # LIKE under a case-insensitive collation
+        needle = query.casefold()
+        matches = [t for t in db.topics.values()
+                   if (include_hidden or not t.is_hidden())
+                   and (needle in t.title.casefold() or needle in t.content.casefold())]
+
+        # search results count hidden replies, like the pinned listing
+        keyed = sorted((db._sort_key(t, db.aggregate(t.topic_id, True)) for t in matches))
+        results = (db.topic_with_author(key[-1], True, with_cat_name=True) for key in keyed[skip:skip + limit])
+        return len(matches), tuple(t for t in results if t is not None)
+
+    async def get_search_result_ids(self, query: str, limit: int, include_hidden=False,
+                                    timeout: Optional[float] = None) -> Tuple[int, Tuple[int, ...]]:
+        db = self.__db
+        needle = query.casefold()
+        matches = [t for t in db.topics.values()
+                   if (include_hidden or not t.is_hidden())
+                   and (needle in t.title.casefold() or needle in t.content.casefold())]
+        keyed = sorted((db._sort_key(t, db.aggregate(t.topic_id, True)) for t in matches))
+        return len(matches), tuple(key[-1] for key in keyed[:limit])
+
+    async def get_search_results(self, topic_ids: Sequence[int], include_hidden=False) -> \
+            Tuple[TopicWithAuthor, ...]:
+        db = self.__db
+        results = (db.topic_with_author(topic_id, True, with_cat_name=True) for topic_id in topic_ids
+                   if topic_id in db.topics and (include_hidden or not db.topics[topic_id].is_hidden()))
+        return tuple(t for t in results if t is not None)
+
+    async def get_topic_titles(self, after_id: int, limit: int) -> Tuple[Tuple[int, str, int], ...]:
+        topics = self.__db.topics
+        return tuple((topic_id, topics[topic_id].title, topics[topic_id].flags)
+                     for topic_id in sorted(t for t in topics if t > after_id)[:limit])
+
+    async def delete_topic_by_id(self, topic_id: int) -> int:
+        db = self.__db
+        if (topic := db.topics.get(topic_id)) is None:
+            return 0
+
+        # like the foreign keys in MySQL, attachments prevent the deletion before anything is deleted
+        post_ids = [post_id for _, post_id in db.posts_of_topic.get(topic_id, ())]
+        if any(db.attachments_of_post.get(post_id) for post_id in post_ids):
+            raise IntegrityError(_ER_ROW_IS_REFERENCED, 'Cannot delete or update a parent row: post has attachments')
+        if db.attachments_of_topic.get(topic_id):
+            raise IntegrityError(_ER_ROW_IS_REFERENCED, 'Cannot delete or update a parent row: topic has attachments')
+
+        for post_id in post_ids:
+            del db.posts[post_id]
+        db.posts_of_topic.pop(topic_id, None)
+        rows = len(post_ids)
+
+        del db.topics[topic_id]
+        db.topics_of_category[topic.parent_cat].discard(topic_id)
+        db.topics_of_author[topic.author_id].discard(topic_id)
+        db.reindex_topic(topic_id)
+        return rows + 1
+
+    async def put_topic(self, topic: Topic, attachments: Sequence[Tuple[TopicAttachment, Blob]] = (),
+                        place: Optional[Callable[[], Awaitable[None]]] = None) -> int:
+        db = self.__db
+        if topic.parent_cat not in db.categories:
+            raise _fk_error(f'category {topic.parent_cat}')
+        if topic.author_id not in db.users:
+            raise _fk_error(f'user {topic.author_id}')
+
+        if topic.topic_id is None:
+            if attachments:
+                for attachment, _ in attachments:
+                    if attachment.author not in db.users:
+                        raise _fk_error(f'user {attachment.author}')
+                async with db.blob_lock:
+                    await db.add_blob_references([blob for _, blob in attachments], place)
+
+            topic.topic_id = db.next_id('threadsTable')
+            topic.created_at = _now()
+            for attachment, _ in attachments:
+                attachment.thread = topic.topic_id
+        elif (old := db.topics.get(topic.topic_id)) is None:
+            # UPDATE matches no rows
+            return topic.topic_id
+        else:
+            # createdAt deliberately excluded
+            topic.created_at = old.created_at
+            db.topics_of_category[old.parent_cat].discard(topic.topic_id)
+            db.topics_of_author[old.author_id].discard(topic.topic_id)
+
+        db.topics[topic.topic_id] = topic.model_copy()
+        db.topics_of_category[topic.parent_cat].add(topic.topic_id)
+        db.topics_of_author[topic.author_id].add(topic.topic_id)
+        db.reindex_topic(topic.topic_id)
+        # noinspection PyProtectedMember
+        MemoryTopicAttachmentRepository(db)._insert_attachments(attachments)
+        return topic.topic_id
+
+
+class MemoryPostRepository:
+    """
+    PostRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_post_by_id(self, post_id: int, include_hidden=False) -> Optional[Post]:
+        post = self.__db.posts.get(post_id)
+        if post is None or (post.is_hidden() and not include_hidden):
+            return None
+        return post.model_copy()
+
+    async def get_posts_of_topic(self, topic_id: int, limit: int = 20, skip: int = 0, include_hidden=False) -> \
+            Tuple[int, Tuple[PostWithAuthor, ...]]:
+        db = self.__db
+        posts = (db.posts[post_id] for _, post_id in db.posts_of_topic.get(topic_id, ()))
+        if not include_hidden:
+            posts = (p for p in posts if not p.is_hidden())
+
+        results = []
+        for post in posts:
+            if (author := db.author_of(post.author_id)) is None:
+                continue
+            results.append(PostWithAuthor(post_id=post.post_id, topic_id=post.topic_id, author=author,
+                                          content=post.content, created_at=post.created_at, flags=post.flags))
+
+        return len(results), tuple(results[skip:skip + limit])
+
+    async def put_post(self, post: Post, attachments: Sequence[Tuple[PostAttachment, Blob]] = (),
+                       place: Optional[Callable[[], Awaitable[None]]] = None) -> int:
+        db = self.__db
+        if post.topic_id not in db.topics:
+            raise _fk_error(f'topic {post.topic_id}')
+        if post.author_id not in db.users:
+            raise _fk_error(f'user {post.author_id}')
+
+        if post.post_id is None:
+            if attachments:
+                for attachment, _ in attachments:
+                    if attachment.author not in db.users:
+                        raise _fk_error(f'user {attachment.author}')
+                async with db.blob_lock:
+                    await db.add_blob_references([blob for _, blob in attachments], place)
+
+            post.post_id = db.next_id('postsTable')
+            for attachment, _ in attachments:
+                attachment.post = post.post_id
+            post.created_at = _now()
+            # the SQL inserts new posts with no flags set
+            post.flags = 0
+        elif (old := db.posts.get(post.post_id)) is None:
+            raise KeyError(f'failed updating topic {post.post_id}: no such topic')
+        else:
+            post.created_at = old.created_at
+            replies = db.posts_of_topic[old.topic_id]
+            del replies[bisect_left(replies, (old.created_at, old.post_id))]
+            if old.topic_id != post.topic_id:
+                db.reindex_topic(old.topic_id)
+
+        db.posts[post.post_id] = post.model_copy()
+        insort(db.posts_of_topic[post.topic_id], (post.created_at, post.post_id))
+        db.reindex_topic(post.topic_id)
+        # noinspection PyProtectedMember
+        MemoryPostAttachmentRepository(db)._insert_attachments(attachments)
+        return post.post_id
+
+
+class MemoryTopicAttachmentRepository:
+    """
+    TopicAttachmentRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_attachments_of_topic(self, topic_id: int) -> Tuple[TopicAttachment, ...]:
+        db = self.__db
+        return tuple(db.topic_attachments[a].model_copy() for a in sorted(db.attachments_of_topic.get(topic_id, ())))
+
+    async def get_attachment(self, attachment_id: int) -> Optional[TopicAttachment]:
+        atch = self.__db.topic_attachments.get(attachment_id)
+        return atch.model_copy() if atch is not None else None
+
+    async def get_legacy_attachments(self, after_id: int, limit: int) -> Tuple[TopicAttachment, ...]:
+        db = self.__db
+        legacy = sorted(a for a, atch in db.topic_attachments.items() if atch.sha256 is None and a > after_id)
+        return tuple(db.topic_attachments[a].model_copy() for a in legacy[:limit])
+
+    async def move_to_blob(self, attachment_id: int, blob: Blob, place: Callable[[], Awaitable[None]]) -> bool:
+        db = self.__db
+        async with db.blob_lock:
+            atch = db.topic_attachments.get(attachment_id)
+            if atch is None or atch.sha256 is not None:
+                return False
+            await db.add_blob_references([blob], place)
+            atch.sha256 = blob.sha256
+            atch.mime_type = blob.mime_type
+        return True
+
+    async def delete_attachment(self, attachment_id: int, remove: Callable[[str], Awaitable[None]]):
+        db = self.__db
+        async with db.blob_lock:
+            if (atch := db.topic_attachments.pop(attachment_id, None)) is not None:
+                db.attachments_of_topic[atch.thread].discard(attachment_id)
+                if atch.sha256 is not None:
+                    await db.drop_blob_reference(atch.sha256, remove)
+
+    def _insert_attachments(self, attachments: Sequence[Tuple[TopicAttachment, Blob]]):
+        db = self.__db
+        # like the foreign key in MySQL, the blobs must have been added first
+        for _, blob in attachments:
+            if blob.sha256 not in db.blobs:
+                raise _fk_error(f'blob {blob.sha256}')
+        for attachment, blob in attachments:
+            attachment.id = db.next_id('threadAttachments')
+            attachment.createdAt = _now()
+            attachment.sha256 = blob.sha256
+            attachment.mime_type = blob.mime_type
+            db.topic_attachments[attachment.id] = attachment.model_copy()
+            db.attachments_of_topic[attachment.thread].add(attachment.id)
+
+    async def put_attachments(self, attachments: Sequence[Tuple[TopicAttachment, Blob]],
+                              place: Callable[[], Awaitable[None]]):
+        db = self.__db
+        for attachment, _ in attachments:
+            if attachment.thread not in db.topics:
+                raise _fk_error(f'topic {attachment.thread}')
+            if attachment.author not in db.users:
+                raise _fk_error(f'user {attachment.author}')
+
+        async with db.blob_lock:
+            await db.add_blob_references([blob for _, blob in attachments], place)
+        self._insert_attachments(attachments)
+
+    async def put_attachment(self, attachment: TopicAttachment) -> int:
+        db = self.__db
+        if attachment.thread not in db.topics:
+            raise _fk_error(f'topic {attachment.thread}')
+        if attachment.author not in db.users:
+            raise _fk_error(f'user {attachment.author}')
+
+        if attachment.id is None:
+            attachment.id = db.next_id('threadAttachments')
+            attachment.createdAt = _now()
+        elif (old := db.topic_attachments.get(attachment.id)) is None:
+            raise KeyError(f'failed updating topic {attachment.id}: no such topic')
+        else:
+            attachment.createdAt = old.createdAt
+            db.attachments_of_topic[old.thread].discard(attachment.id)
+
+        db.topic_attachments[attachment.id] = attachment.model_copy()
+        db.attachments_of_topic[attachment.thread].add(attachment.id)
+        return attachment.id
+
+
+class MemoryPostAttachmentRepository:
+    """
+    PostAttachmentRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_attachments_of_post(self, post_id: int) -> Tuple[PostAttachment, ...]:
+        db = self.__db
+        return tuple(db.post_attachments[a].model_copy() for a in sorted(db.attachments_of_post.get(post_id, ())))
+
+    async def get_attachment(self, attachment_id: int) -> Optional[PostAttachment]:
+        atch = self.__db.post_attachments.get(attachment_id)
+        return atch.model_copy() if atch is not None else None
+
+    async def get_legacy_attachments(self, after_id: int, limit: int) -> Tuple[Tuple[PostAttachment, int], ...]:
+        db = self.__db
+        legacy = sorted(a for a, atch in db.post_attachments.items() if atch.sha256 is None and a > after_id)
+        return tuple((db.post_attachments[a].model_copy(), db.posts[db.post_attachments[a].post].topic_id)
+                     for a in legacy[:limit])
+
+    async def move_to_blob(self, attachment_id: int, blob: Blob, place: Callable[[], Awaitable[None]]) -> bool:
+        db = self.__db
+        async with db.blob_lock:
+            atch = db.post_attachments.get(attachment_id)
+            if atch is None or atch.sha256 is not None:
+                return False
+            await db.add_blob_references([blob], place)
+            atch.sha256 = blob.sha256
+            atch.mime_type = blob.mime_type
+        return True
+
+    async def delete_attachment(self, attachment_id: int, remove: Callable[[str], Awaitable[None]]):
+        db = self.__db
+        async with db.blob_lock:
+            if (atch := db.post_attachments.pop(attachment_id, None)) is not None:
+                db.attachments_of_post[atch.post].discard(attachment_id)
+                if atch.sha256 is not None:
+                    await db.drop_blob_reference(atch.sha256, remove)
+
+    def _insert_attachments(self, attachments: Sequence[Tuple[PostAttachment, Blob]]):
+        db = self.__db
+        # like the foreign key in MySQL, the blobs must have been added first
+        for _, blob in attachments:
+            if blob.sha256 not in db.blobs:
+                raise _fk_error(f'blob {blob.sha256}')
+        for attachment, blob in attachments:
+            attachment.id = db.next_id('postsAttachments')
+            attachment.createdAt = _now()
+            attachment.sha256 = blob.sha256
+            attachment.mime_type = blob.mime_type
+            db.post_attachments[attachment.id] = attachment.model_copy()
+            db.attachments_of_post[attachment.post].add(attachment.id)
+
+    async def put_attachments(self, attachments: Sequence[Tuple[PostAttachment, Blob]],
+                              place: Callable[[], Awaitable[None]]):
+        db = self.__db
+        for attachment, _ in attachments:
+            if attachment.post not in db.posts:
+                raise _fk_error(f'post {attachment.post}')
+            if attachment.author not in db.users:
+                raise _fk_error(f'user {attachment.author}')
+
+        async with db.blob_lock:
+            await db.add_blob_references([blob for _, blob in attachments], place)
+        self._insert_attachments(attachments)
+
+    async def put_attachment(self, attachment: PostAttachment) -> int:
+        db = self.__db
+        if attachment.post not in db.posts:
+            raise _fk_error(f'post {attachment.post}')
+        if attachment.author not in db.users:
+            raise _fk_error(f'user {attachment.author}')
+
+        if attachment.id is None:
+            attachment.id = db.next_id('postsAttachments')
+            attachment.createdAt = _now()
+        elif (old := db.post_attachments.get(attachment.id)) is None:
+            raise KeyError(f'failed updating post attachment {attachment.id}: no such attachment')
+        else:
+            attachment.createdAt = old.createdAt
+            db.attachments_of_post[old.post].discard(attachment.id)
+
+        db.post_attachments[attachment.id] = attachment.model_copy()
+        db.attachments_of_post[attachment.post].add(attachment.id)
+        return attachment.id
+
+
+class MemoryBlobRepository:
+    """
+    BlobRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def get_hashes_after(self, after: str, limit: int) -> Tuple[str, ...]:
+        return tuple(sorted(sha256 for sha256 in self.__db.blobs if sha256 > after)[:limit])
+
+    async def remove_if_unreferenced(self, sha256: str, remove: Callable[[str], Awaitable[None]]) -> bool:
+        db = self.__db
+        async with db.blob_lock:
+            if sha256 in db.blobs:
+                return False
+            await remove(sha256)
+            return True
+
+
+class MemoryJobRepository:
+    """
+    JobRepository backed by a MemoryDatabase.
+    """
+
+    def __init__(self, db: MemoryDatabase):
+        self.__db = db
+
+    async def put_job(self, job: Job, delay: float = 0) -> int:
+        db = self.__db
+        job.id = db.next_id('jobs')
+        job.attempts = 0
+        job.run_at = datetime.now() + timedelta(seconds=delay)
+        db.jobs[job.id] = _JobRow(job.model_copy(deep=True), _now())
+        return job.id
+
+    async def claim_jobs(self, kind: str, limit: int, lease: float) -> Tuple[Job, ...]:
+        now = datetime.now()
+        due = sorted((row.job for row in self.__db.jobs.values()
+                      if row.job.kind == kind and row.failed_at is None and row.job.run_at <= now),
+                     key=lambda job: job.run_at)[:limit]
+        for job in due:
+            job.attempts += 1
+            job.run_at = now + timedelta(seconds=lease)
+        return tuple(job.model_copy(deep=True) for job in due)
+
+    async def complete_job(self, job_id: int) -> None:
+        self.__db.jobs.pop(job_id, None)
+
+    async def retry_job(self, job_id: int, delay: float, error: str) -> None:
+        if (row := self.__db.jobs.get(job_id)) is not None:
+            row.job.run_at = datetime.now() + timedelta(seconds=delay)
+            row.job.last_error = error[:MAX_ERROR_LENGTH]
+
+    async def fail_job(self, job_id: int, error: str) -> None:
+        if (row := self.__db.jobs.get(job_id)) is not None:
+            row.failed_at = _now()
+            row.job.last_error = error[:MAX_ERROR_LENGTH]
+
+    async def get_backlog(self) -> Tuple[JobBacklog, ...]:
+        now = datetime.now()
+        backlog: Dict[str, JobBacklog] = {}
+        for row in self.__db.jobs.values():
+            entry = backlog.setdefault(row.job.kind, JobBacklog(kind=row.job.kind, ready=0, scheduled=0, failed=0,
+                                                                oldest=None))
+            if row.failed_at is not None:
+                entry.failed += 1
+                continue
+            if row.job.run_at <= now:
+                entry.ready += 1
+            else:
+                entry.scheduled += 1
+            if entry.oldest is None or row.created_at < entry.oldest:
+                entry.oldest = row.created_at
+        return tuple(backlog[kind] for kind in sorted(backlog))
+
+    async def delete_failed_older_than(self, seconds: int) -> int:
+        db = self.__db
+        cutoff = datetime.now() - timedelta(seconds=seconds)
+        old = [job_id for job_id, row in db.jobs.items() if row.failed_at is not None and row.failed_at < cutoff]
+        for job_id in old:
+            del db.jobs[job_id]
+        return len(old)
@@ -1,8 +1,12 @@
 from datetime import datetime
-from typing import Tuple, Optional, Any
+from typing import Tuple, Optional, Any, Callable, Awaitable, Sequence
 
+from aiomysql import Connection
 from pydantic import BaseModel, Field
 
+from forums.db.blobs import Blob, BlobRepository
+from forums.db.utils import transaction
+
 
 class PostAttachment(BaseModel):
     id: Optional[int] = Field(default=None)
@@ -10,13 +14,18 @@ class PostAttachment(BaseModel):
     filename: str = Field(max_length=128, min_length=0)
     author: int
     createdAt: Optional[datetime]
+    # the blob holding the contents, or None for attachments stored under their filename
+    sha256: Optional[str] = Field(default=None)
+    # the type of the blob's contents, or None for attachments stored under their filename
+    mime_type: Optional[str] = Field(default=None)
 
 
 def _maybe_row_to_post_attachment(row: Any) -> Optional[PostAttachment]:
     if row is None:
         return None
 
-    return PostAttachment(id=row[0], post=row[1], filename=row[2], author=row[3], createdAt=row[4])
+    return PostAttachment(id=row[0], post=row[1], filename=row[2], author=row[3], createdAt=row[4], sha256=row[5],
+                          mime_type=row[6])
 
 
 class PostAttachmentRepository:
@@ -24,7 +33,8 @@ class PostAttachmentRepository:
         self.__db = db
 
     async def get_attachments_of_post(self, post_id: int) -> Tuple[PostAttachment, ...]:
-        query = 'SELECT * FROM postsAttachments WHERE post = %s;'
+        query = 'SELECT A.*, B.mimeType FROM postsAttachments AS A ' \
+                'LEFT JOIN attachmentBlobs AS B ON A.sha256 = B.sha256 WHERE A.post = %s;'
 
         async with self.__db.acquire() as conn:
             async with conn.cursor() as cur:
@@ -34,13 +44,85 @@ class PostAttachmentRepository:
     async def get_attachment(self, attachment_id: int):
         async with self.__db.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute('SELECT * FROM postsAttachments WHERE id = %s;', (attachment_id, ))
+                await cur.execute('SELECT A.*, B.mimeType FROM postsAttachments AS A '
+                                  'LEFT JOIN attachmentBlobs AS B ON A.sha256 = B.sha256 WHERE A.id = %s;',
+                                  (attachment_id, ))
                 return _maybe_row_to_post_attachment(await cur.fetchone())
 
-    async def delete_attachment(self, attachment_id: int):
+    async def get_legacy_attachments(self, after_id: int, limit: int) -> Tuple[Tuple[PostAttachment, int], ...]:
+        """
+        Returns up to `limit` of the attachments stored under their filename rather than in a blob, in the order of
+        their ids, starting after `after_id`. Each comes with the id of the topic of its post, which is part of the
+        path of its file.
+        """
         async with self.__db.acquire() as conn:
             async with conn.cursor() as cur:
+                await cur.execute('SELECT A.*, NULL, P.threadID FROM postsAttachments AS A '
+                                  'INNER JOIN postsTable AS P ON P.postID = A.post '
+                                  'WHERE A.sha256 IS NULL AND A.id > %s ORDER BY A.id LIMIT %s;', (after_id, limit))
+                return tuple((_maybe_row_to_post_attachment(row), row[7]) for row in await cur.fetchall())
+
+    async def move_to_blob(self, attachment_id: int, blob: Blob, place: Callable[[], Awaitable[None]]) -> bool:
+        """
+        Makes an attachment stored under its filename refer to a blob with the same contents instead, in one
+        transaction. `place` is called to move the file of the blob into place before the transaction commits.
+
+        Returns False without calling `place` if the attachment has been deleted or moved already.
+        """
+        async with self.__db.acquire() as conn, transaction(conn):
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT sha256 FROM postsAttachments WHERE id = %s FOR UPDATE;', (attachment_id, ))
+                row = await cur.fetchone()
+                if row is None or row[0] is not None:
+                    return False
+            # noinspection PyProtectedMember
+            await BlobRepository._add_references(conn, [blob])
+            async with conn.cursor() as cur:
+                await cur.execute('UPDATE postsAttachments SET sha256 = %s WHERE id = %s;',
+                                  (blob.sha256, attachment_id))
+            await place()
+        return True
+
+    async def delete_attachment(self, attachment_id: int, remove: Callable[[str], Awaitable[None]]):
+        """
+        Deletes an attachment. If it was the last reference to its blob, `remove` is called with the blob's hash to
+        delete the blob's file.
+        """
+        async with self.__db.acquire() as conn, transaction(conn):
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT sha256 FROM postsAttachments WHERE id = %s FOR UPDATE;', (attachment_id, ))
+                row = await cur.fetchone()
                 await cur.execute('DELETE FROM postsAttachments WHERE id = %s;', (attachment_id, ))
+            if row is not None and row[0] is not None:
+                # noinspection PyProtectedMember
+                await BlobRepository._drop_reference(conn, row[0], remove)
+
+    @classmethod
+    async def _insert_attachments(cls, conn: Connection, attachments: Sequence[Tuple[PostAttachment, Blob]]):
+        """
+        Internal "friend" function used to insert new attachments as part of a transaction, after taking the references
+        to their blobs with BlobRepository._add_references. It doesn't fill in the ids of the attachments.
+        """
+        for attachment, blob in attachments:
+            attachment.sha256 = blob.sha256
+            attachment.mime_type = blob.mime_type
+        async with conn.cursor() as cur:
+            # createdAt set by default func
+            await cur.executemany(
+                'INSERT INTO postsAttachments (post, filename, author, sha256) VALUES (%s, %s, %s, %s);',
+                [(a.post, a.filename, a.author, a.sha256) for a, _ in attachments])
+
+    async def put_attachments(self, attachments: Sequence[Tuple[PostAttachment, Blob]],
+                              place: Callable[[], Awaitable[None]]):
+        """
+        Inserts new attachments together with references to their blobs, in one transaction. `place` is called to
+        move the files of the blobs into place before the transaction commits.
+        """
+        async with self.__db.acquire() as conn, transaction(conn):
+            # noinspection PyProtectedMember
+            await BlobRepository._add_references(conn, [blob for _, blob in attachments])
+            await self._insert_attachments(conn, attachments)
+            await place()
 
     async def put_attachment(self, attachment: PostAttachment) -> int:
         async with self.__db.acquire() as conn:
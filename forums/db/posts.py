@@ -1,10 +1,12 @@
 from datetime import datetime
-from typing import Optional, AsyncGenerator, Tuple
+from typing import Optional, AsyncGenerator, Tuple, Sequence, Callable, Awaitable
 
 from aiomysql import Pool, Connection
 from pydantic import BaseModel
 
-from forums.db.utils import mysql_date_to_python
+from forums.db.blobs import Blob, BlobRepository
+from forums.db.post_attachment import PostAttachment, PostAttachmentRepository
+from forums.db.utils import mysql_date_to_python, transaction
 from forums.models import UserAPI
 
 # Post flags
@@ -96,7 +98,30 @@ class PostRepository:
         async with conn.cursor() as cur:
             return await cur.execute('DELETE FROM postsTable WHERE threadID = %s;', topic_id)
 
-    async def put_post(self, post: Post) -> int:
+    async def put_post(self, post: Post, attachments: Sequence[Tuple[PostAttachment, Blob]] = (),
+                       place: Optional[Callable[[], Awaitable[None]]] = None) -> int:
+        """
+        Inserts or updates a post. A new post is inserted together with `attachments` (pairs of an attachment and its
+        blob) in one transaction, and `place` is called to move the files of the blobs into place before it commits.
+        """
+        if post.post_id is None and attachments:
+            async with self.__db.acquire() as conn, transaction(conn):
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        'INSERT INTO postsTable (threadID, userID, content, flags) VALUES (%s, %s, %s, %s);',
+                        (post.topic_id, post.author_id, post.content, 0))
+                    post_id = cur.lastrowid
+
+                for attachment, _ in attachments:
+                    attachment.post = post_id
+                # noinspection PyProtectedMember
+                await BlobRepository._add_references(conn, [blob for _, blob in attachments])
+                # noinspection PyProtectedMember
+                await PostAttachmentRepository._insert_attachments(conn, attachments)
+                await place()
+            post.post_id = post_id
+            return post.post_id
+
         async with self.__db.acquire() as conn:
             async with conn.cursor() as cur:
                 if post.post_id is None:
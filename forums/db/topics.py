@@ -1,11 +1,14 @@
 from datetime import datetime
-from typing import Optional, AsyncGenerator, Tuple, List, Any
+from typing import Optional, AsyncGenerator, Tuple, List, Any, Sequence, Callable, Awaitable
 
 from aiomysql import Pool
 from pydantic import BaseModel, Field
 
+from forums.db.blobs import Blob, BlobRepository
 from forums.db.posts import PostRepository, POST_IS_HIDDEN
-from forums.db.utils import mysql_date_to_python, mysql_escape_like
+from forums.db.topic_attachment import TopicAttachment, TopicAttachmentRepository
+from forums.db.utils import mysql_date_to_python, mysql_escape_like, transaction, execute_cancellable, \
+    max_execution_time
 from forums.models import UserAPI
 
 # Bitflags for Topic
@@ -102,6 +105,14 @@ def _maybe_row_to_topic_author(row: Optional[_JOIN_ROW]) -> Optional[TopicWithAu
     return TopicWithAuthor(**obj_dict)
 
 
+def _search_condition(include_hidden: bool) -> str:
+    """
+    The WHERE clause matching the topics a search finds, taking the LIKE pattern twice.
+    """
+    matches = "T.title LIKE %s ESCAPE '\\\\' OR T.content LIKE %s ESCAPE '\\\\'"
+    return f'WHERE {matches}' if include_hidden else f'WHERE ({matches}) AND (T.flags & {TOPIC_IS_HIDDEN}) = 0'
+
+
 class TopicRepository:
     """
     TopicRepository implements CRUD operations for Topics.
@@ -174,7 +185,7 @@ class TopicRepository:
                 PCQ AS (
                     SELECT TQ.*, COUNT(P.postID), MAX(P.createdAt) AS most_recent_repl FROM TQ LEFT OUTER JOIN postsTable AS P ON TQ.thr_id = P.threadID {p_cond} GROUP BY TQ.thr_id
                 )
-            SELECT * FROM PCQ
+            SELECT {max_execution_time(timeout)} * FROM PCQ
             ORDER BY PCQ.most_recent_repl DESC, PCQ.topic_created DESC, PCQ.topic_title LIMIT %s OFFSET %s;
         '''
 
@@ -210,15 +221,21 @@ class TopicRepository:
                 while row := await cur.fetchone():
                     yield _maybe_row_to_topic(row)  # is never None
 
-    async def generate_search_result_data(self, query: str, limit: int = 20, skip: int = 0, include_hidden=False) -> \
+    async def generate_search_result_data(self, query: str, limit: int = 20, skip: int = 0, include_hidden=False,
+                                          timeout: Optional[float] = None) -> \
     Tuple[int, Tuple[TopicWithAuthor, ...]]:
         """
         Returns a generator over all topics that contain the phrase in the query, sorted by the creation time.
         This will return up to `limit` topics with an offset of `skip` from the beginning of the sorted topic set.
+
+        The queries scan every topic, so MySQL aborts each of them after `timeout` seconds (if given), and they are
+        killed if the caller is cancelled.
+
+        :raises: TimeoutError if a query took longer than `timeout`
         """
         query = f'%{mysql_escape_like(query)}%'
 
-        where_clause = "WHERE T.title LIKE %s ESCAPE '\\\\' OR T.content LIKE %s ESCAPE '\\\\'" if include_hidden else f"WHERE (T.title LIKE %s ESCAPE '\\\\' OR T.content LIKE %s ESCAPE '\\\\') AND (T.flags & {TOPIC_IS_HIDDEN}) = 0"
+        where_clause = _search_condition(include_hidden)
         select_q = f'''
         WITH
                 TQ AS (
@@ -231,26 +248,93 @@ class TopicRepository:
                 PCQ AS (
                     SELECT TQ.*, COUNT(P.postID), MAX(P.createdAt) AS most_recent_repl FROM TQ LEFT OUTER JOIN postsTable AS P ON TQ.thr_id = P.threadID GROUP BY TQ.thr_id
                 )
-            SELECT * FROM PCQ
+            SELECT {max_execution_time(timeout)} * FROM PCQ
             ORDER BY PCQ.most_recent_repl DESC, PCQ.topic_created DESC, PCQ.topic_title LIMIT %s OFFSET %s;
         '''
 
-        count_q = f'SELECT COUNT(T.threadID) FROM threadsTable AS T JOIN loginTable AS U ON T.userID = U.id {where_clause};'
+        count_q = f'SELECT {max_execution_time(timeout)} COUNT(T.threadID) FROM threadsTable AS T JOIN loginTable AS U ON T.userID = U.id {where_clause};'
 
         async with self.__db.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    count_q,
-                    (query, query)
-                )
+                await execute_cancellable(self.__db, cur, count_q, (query, query))
                 total_results = (await cur.fetchone())[0]
 
-                await cur.execute(
-                    select_q,
-                    (query, query, limit, skip))
+                await execute_cancellable(self.__db, cur, select_q, (query, query, limit, skip))
 
                 return total_results, tuple(_maybe_row_to_topic_author(topic) for topic in await cur.fetchall())
 
+    async def get_search_result_ids(self, query: str, limit: int, include_hidden=False,
+                                    timeout: Optional[float] = None) -> Tuple[int, Tuple[int, ...]]:
+        """
+        Returns how many topics contain the phrase in the query, and the ids of the first `limit` of them, in the
+        order of generate_search_result_data(). Load the topics to show with get_search_results().
+
+        The count is only queried separately when there are more than `limit` results. Like
+        generate_search_result_data(), the queries are aborted after `timeout` seconds and killed if the caller is
+        cancelled.
+
+        :raises: TimeoutError if a query took longer than `timeout`
+        """
+        query = f'%{mysql_escape_like(query)}%'
+        where_clause = _search_condition(include_hidden)
+
+        ids_q = f'''
+            SELECT {max_execution_time(timeout)} T.threadID FROM threadsTable AS T
+            JOIN loginTable AS U ON T.userID = U.id
+            LEFT OUTER JOIN postsTable AS P ON T.threadID = P.threadID
+            {where_clause}
+            GROUP BY T.threadID
+            ORDER BY MAX(P.createdAt) DESC, T.createdAt DESC, T.title LIMIT %s;
+        '''
+
+        count_q = f'SELECT {max_execution_time(timeout)} COUNT(T.threadID) FROM threadsTable AS T JOIN loginTable AS U ON T.userID = U.id {where_clause};'
+
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                # one more than asked for tells whether there are more
+                await execute_cancellable(self.__db, cur, ids_q, (query, query, limit + 1))
+                ids = tuple(row[0] for row in await cur.fetchall())
+                if len(ids) <= limit:
+                    return len(ids), ids
+
+                await execute_cancellable(self.__db, cur, count_q, (query, query))
+                return (await cur.fetchone())[0], ids[:limit]
+
+    async def get_search_results(self, topic_ids: Sequence[int], include_hidden=False) -> \
+            Tuple[TopicWithAuthor, ...]:
+        """
+        Returns the topics with the given ids, in the given order, like generate_search_result_data() does. Topics
+        that no longer exist (or are now hidden, unless `include_hidden`) are left out.
+        """
+        if not topic_ids:
+            return ()
+
+        hidden_clause = '' if include_hidden else f'AND (T.flags & {TOPIC_IS_HIDDEN}) = 0'
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(f'''
+                    SELECT T.threadID, T.parent_cat, T.userID, T.title, T.content, T.createdAt, T.flags, U.id, U.MYUSER,
+                           U.display_name, U.flags, C.cat_name, COUNT(P.postID), MAX(P.createdAt)
+                    FROM threadsTable AS T
+                    JOIN loginTable AS U ON T.userID = U.id
+                    JOIN categories AS C ON C.id = T.parent_cat
+                    LEFT OUTER JOIN postsTable AS P ON T.threadID = P.threadID
+                    WHERE T.threadID IN %s {hidden_clause}
+                    GROUP BY T.threadID;
+                ''', (list(topic_ids), ))
+                found = {row[0]: _maybe_row_to_topic_author(row) for row in await cur.fetchall()}
+                return tuple(found[topic_id] for topic_id in topic_ids if topic_id in found)
+
+    async def get_topic_titles(self, after_id: int, limit: int) -> Tuple[Tuple[int, str, int], ...]:
+        """
+        Returns the id, title and flags of up to `limit` topics with an id above `after_id`, in order of id.
+        """
+        async with self.__db.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT threadID, title, flags FROM threadsTable WHERE threadID > %s '
+                                  'ORDER BY threadID LIMIT %s;', (after_id, limit))
+                return tuple((row[0], row[1], row[2]) for row in await cur.fetchall())
+
     async def delete_topic_by_id(self, topic_id: int) -> int:
         """
         Deletes the topic and all of its child posts from the db. Returns the number of rows affected.
@@ -264,14 +348,35 @@ class TopicRepository:
             async with conn.cursor() as cur:
                 return cur.execute('DELETE FROM threadsTable WHERE threadID = %s LIMIT 1;', topic_id) + rows
 
-    async def put_topic(self, topic: Topic) -> int:
+    async def put_topic(self, topic: Topic, attachments: Sequence[Tuple[TopicAttachment, Blob]] = (),
+                        place: Optional[Callable[[], Awaitable[None]]] = None) -> int:
         """
-        If the topic_id is None, this will insert the Topic into the database.
+        If the topic_id is None, this will insert the Topic into the database, together with `attachments` (pairs of
+        an attachment and its blob) in one transaction. `place` is called to move the files of the blobs into place
+        before the transaction commits.
 
         If the topic_id is not None, this will update the existing topic.
 
         Returns the topic_id of the affected item.
         """
+        if topic.topic_id is None and attachments:
+            async with self.__db.acquire() as conn, transaction(conn):
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        'INSERT INTO threadsTable (userID, title, content, flags, parent_cat) VALUES (%s, %s, %s, %s, %s);',
+                        (topic.author_id, topic.title, topic.content, topic.flags, topic.parent_cat))
+                    topic_id = cur.lastrowid
+
+                for attachment, _ in attachments:
+                    attachment.thread = topic_id
+                # noinspection PyProtectedMember
+                await BlobRepository._add_references(conn, [blob for _, blob in attachments])
+                # noinspection PyProtectedMember
+                await TopicAttachmentRepository._insert_attachments(conn, attachments)
+                await place()
+            topic.topic_id = topic_id
+            return topic.topic_id
+
         async with self.__db.acquire() as conn:
             async with conn.cursor() as cur:
                 if topic.topic_id is None:
@@ -2,7 +2,6 @@ from typing import Optional
 
 from aiomysql import Pool
 from pydantic import BaseModel
-from fastapi import Request
 from typing import Tuple
 
 
@@ -78,7 +77,3 @@ class UserRepository:
                     if num_rows < 1:
                         raise KeyError(f'failed updating user {user.username}: there is no such user with user_id {user.user_id}')
                     return user.user_id
-
-
-def get_user_repo(req: Request) -> UserRepository:
-    return UserRepository(req.app.state.db)
@@ -1,6 +1,13 @@
+import asyncio
+import logging
 import re
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
-from typing import Any
+from typing import Any, Optional
+
+import aiomysql
+from aiomysql import Connection, Cursor, Pool
+from pymysql import OperationalError
 
 __MYSQL_TS_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -14,4 +21,85 @@ __MYSQL_ESCAPE_LIKE_REGEX = re.compile(r'(?P<tok>[%\\_])', flags=re.RegexFlag.UN
 
 
 def mysql_escape_like(s: str) -> str:
-    return __MYSQL_ESCAPE_LIKE_REGEX.sub('\\$tok', s, count=0)
\ No newline at end of file
+    return __MYSQL_ESCAPE_LIKE_REGEX.sub('\\$tok', s, count=0)
+
+@asynccontextmanager
+async def transaction(conn: Connection):
+    """
+    Runs the statements executed on `conn` inside the block in a transaction, which is rolled back if the block
+    raises.
+    """
+    await conn.begin()
+    try:
+        yield conn
+    except BaseException:
+        await conn.rollback()
+        raise
+    await conn.commit()
+
+
+# The MySQL error of a statement that ran longer than its MAX_EXECUTION_TIME hint
+ER_QUERY_TIMEOUT = 3024
+# How long a cancelled statement may take to be killed before its connection is closed instead
+_KILL_TIMEOUT = 2.0
+
+
+def max_execution_time(timeout: Optional[float]) -> str:
+    """
+    The optimizer hint that makes MySQL abort a SELECT after `timeout` seconds, to put right after its SELECT keyword.
+    Only the outermost SELECT of a statement may carry it.
+    """
+    return f'/*+ MAX_EXECUTION_TIME({max(1, int(timeout * 1000))}) */' if timeout else ''
+
+
+async def _kill_query(pool: Pool, thread_id: int) -> bool:
+    try:
+        async with asyncio.timeout(_KILL_TIMEOUT):
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('KILL QUERY %s;', (thread_id, ))
+        return True
+    except Exception as e:
+        logging.warning('failed to kill the query of connection %d', thread_id, exc_info=e)
+        return False
+
+
+async def execute_cancellable(pool: Pool, cur: Cursor, query: str, args: Any = None) -> int:
+    """
+    Executes a statement that may run for long on `cur`, a cursor of a connection of `pool`. If the calling task is
+    cancelled meanwhile, e.g. because the deadline of its request passed (see forums.deadlines), the statement is
+    stopped on the server with KILL QUERY from another connection of `pool`, so that it doesn't keep running for
+    nobody. The statement's own connection then reads the resulting error and goes back to the pool ready for reuse;
+    if the statement couldn't be killed, the connection is closed instead.
+
+    :raises: TimeoutError if the statement was aborted by MySQL for exceeding its MAX_EXECUTION_TIME hint
+    """
+    conn = cur.connection
+    # shielded, so that cancelling the caller doesn't leave the statement's result half read on the connection
+    task = asyncio.ensure_future(cur.execute(query, args))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if not task.done():
+            if await _kill_query(pool, conn.thread_id()):
+                with suppress(Exception, asyncio.CancelledError):
+                    async with asyncio.timeout(_KILL_TIMEOUT):
+                        # it fails with "query execution was interrupted", which leaves the connection clean
+                        await task
+            if not task.done() or task.cancelled():
+                task.cancel()
+                conn.close()
+        raise
+    except OperationalError as e:
+        if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+            raise TimeoutError('the statement exceeded its maximum execution time') from e
+        raise
+
+
+async def create_tool_pool(db_conf: dict, maxsize: int) -> Pool:
+    """
+    Creates the connection pool of a command line tool, configured like the application's.
+    """
+    conf = {k: v for k, v in db_conf.items() if k != 'loop'}
+    conf.update(autocommit=True, charset='utf8mb4', maxsize=maxsize)
+    return await aiomysql.create_pool(**conf, loop=asyncio.get_running_loop())
@@ -0,0 +1,79 @@
+"""
+Deadlines for routes that can take long, such as searches.
+"""
+import asyncio
+import logging
+import re
+
+from starlette import status
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from forums.config import RequestConfig
+
+_SEARCH_PATH = re.compile(r'/search')
+
+
+class DeadlineMiddleware:
+    """
+    Cancels the handler of a request to a route with a deadline when the deadline passes, answering with 503, or when
+    the client disconnects. Cancelling the handler also kills the database statement it is waiting for, see
+    forums.db.utils.execute_cancellable, so abandoned requests don't keep holding connections. The handler raising
+    TimeoutError, e.g. because MySQL aborted a statement, is answered in the same way.
+
+    Only GET requests have deadlines: their client is watched for disconnecting by reading ahead of the handler,
+    which would mean buffering the body of any other request.
+    """
+
+    def __init__(self, app: ASGIApp, conf: RequestConfig):
+        self.app = app
+        self.conf = conf
+
+    def deadline_for(self, path: str) -> float:
+        return self.conf.search_deadline if _SEARCH_PATH.fullmatch(path) else 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD') or \
+                not (deadline := self.deadline_for(scope['path'])):
+            await self.app(scope, receive, send)
+            return
+
+        messages: asyncio.Queue[Message] = asyncio.Queue()
+        disconnected = False
+        started = False
+
+        async def watch(timeout: asyncio.Timeout):
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message['type'] == 'http.disconnect':
+                    disconnected = True
+                    # ends the request right away, just like a passed deadline
+                    if not timeout.expired():
+                        timeout.reschedule(asyncio.get_running_loop().time())
+                    return
+
+        async def tracking_send(message: Message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            async with asyncio.timeout(deadline) as timeout:
+                watcher = asyncio.create_task(watch(timeout))
+                try:
+                    await self.app(scope, messages.get, tracking_send)
+                finally:
+                    watcher.cancel()
+        except TimeoutError:
+            if disconnected:
+                logging.info('%s: the client disconnected, request cancelled', scope['path'])
+                return
+            logging.warning('%s: request cancelled after its deadline of %.1f s', scope['path'], deadline)
+            if started:
+                return
+            await PlainTextResponse('This took too long, try again later.',
+                                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    headers={'Retry-After': '10', 'Cache-Control': 'no-store'})(scope, receive, send)
@@ -0,0 +1,168 @@
+"""
+Sends attachment files once the route has checked that the user may see them.
+"""
+import os
+import stat
+from mimetypes import guess_type
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from aiofiles.os import stat as async_stat
+from fastapi import HTTPException, Request
+from starlette import status
+from starlette.responses import FileResponse, Response
+from starlette.types import Scope, Receive, Send
+
+from forums.conditional import etag_matches
+from forums.config import StorageConfig
+
+# An attachment URL names an attachment id, and ids are never reused, so the bytes behind a URL never change.
+# Attachments of hidden topics must not end up in shared caches.
+ATTACHMENT_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
+class _PartialFileResponse(FileResponse):
+    """
+    A FileResponse sending only the bytes in [start, end] of the file.
+    """
+
+    def __init__(self, path: str, start: int, end: int, stat_result: os.stat_result, **kwargs):
+        super().__init__(path, status_code=status.HTTP_206_PARTIAL_CONTENT, stat_result=stat_result, **kwargs)
+        self.start = start
+        self.end = end
+        self.headers['content-length'] = str(end - start + 1)
+        self.headers['content-range'] = f'bytes {start}-{end}/{stat_result.st_size}'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        remaining = self.end - self.start + 1
+        async with await anyio.open_file(self.path, mode='rb') as file:
+            await file.seek(self.start)
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    # truncated underneath us; the client will notice the short body
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+
+        if remaining > 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a Range header holding a single byte range into inclusive (start, end) offsets.
+
+    Returns None when the header should be ignored (it is malformed, uses another unit or asks for several ranges,
+    which we answer with the whole file as RFC 9110 allows).
+
+    :raises: ValueError if the range is well-formed but cannot be satisfied
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+
+    if not first:
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('unsatisfiable range')
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = int(last) if last else None
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        raise ValueError('unsatisfiable range')
+    if end is None:
+        end = size - 1
+
+    return start, min(end, size - 1)
+
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+async def send_attachment(req: Request, path: str, filename: str, key: str) -> Response:
+    """
+    Responds with the attachment stored at `path`, honouring If-None-Match and single byte Range requests.
+
+    `key` must uniquely identify the attachment (e.g. its kind and id). It becomes part of the strong ETag, together
+    with the file's size and modification time.
+
+    Depending on the storage configuration, the body is either streamed from here or left to the fronting web server
+    through X-Accel-Redirect or X-Sendfile, which then handles Range requests itself.
+    """
+    sconf: StorageConfig = req.app.state.cfg.storage
+
+    try:
+        st = await async_stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such attachment.')
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such attachment.')
+
+    etag = f'"{key}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    headers = {'ETag': etag, 'Cache-Control': ATTACHMENT_CACHE_CONTROL, 'Accept-Ranges': 'bytes'}
+
+    if etag_matches(req, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if sconf.send_mode != 'direct':
+        headers['Content-Disposition'] = _content_disposition(filename)
+        if sconf.send_mode == 'x-accel-redirect':
+            rel = os.path.relpath(path, sconf.path).replace(os.sep, '/')
+            headers['X-Accel-Redirect'] = sconf.accel_redirect_prefix.rstrip('/') + '/' + quote(rel)
+        else:
+            headers['X-Sendfile'] = os.path.abspath(path)
+        # guessed from the file name the same way FileResponse does it
+        return Response(headers=headers, media_type=guess_type(filename)[0] or 'text/plain')
+
+    range_header = req.headers.get('range')
+    # If-Range makes the Range conditional on the client still holding the current representation
+    if range_header is not None and (if_range := req.headers.get('if-range')) is not None and \
+            if_range.strip() != etag:
+        range_header = None
+
+    if range_header is not None:
+        try:
+            byte_range = _parse_range(range_header, st.st_size)
+        except ValueError:
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={**headers, 'Content-Range': f'bytes */{st.st_size}'})
+
+        if byte_range is not None:
+            return _PartialFileResponse(path, *byte_range, stat_result=st, filename=filename, headers=headers)
+
+    return FileResponse(path, filename=filename, headers=headers, stat_result=st)
+
+
+async def send_thumbnail(req: Request, path: str, media_type: str, key: str) -> Response:
+    """
+    Responds with the thumbnail stored at `path`, to be shown inline. `key` must uniquely identify the thumbnail;
+    since a thumbnail never changes once rendered, it is the whole ETag.
+    """
+    try:
+        st = await async_stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such thumbnail.')
+
+    headers = {'ETag': f'"{key}"', 'Cache-Control': ATTACHMENT_CACHE_CONTROL}
+    if etag_matches(req, headers['ETag']):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=st)
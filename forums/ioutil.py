@@ -1,15 +1,19 @@
+import asyncio
+import hashlib
 import re
+import tempfile
 import unicodedata
-from typing import Optional
+from typing import BinaryIO, List, Optional, Sequence, Tuple
 import os
-import aiofiles
 
 import filetype
 from fastapi import HTTPException, UploadFile
+from pydantic import BaseModel
 from starlette import status
 from starlette.requests import Request
 import logging
 
+from forums.blocking import spawn_blocking
 from forums.config import StorageConfig
 
 __REGEX_SP_DASH = re.compile(r'[-\s]+', flags=re.RegexFlag.UNICODE)
@@ -62,39 +66,205 @@ def escape_filename(filename: str) -> str:
     return filename
 
 
-__REGEX_REWRITE_FNAME = re.compile(r'^(.+)\.(\w{1,4})$', flags=re.UNICODE)
+# Bytes copied per read when storing an upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# filetype never looks further into a file than this
+_SNIFF_SIZE = 8192
 
 
-def _next_name(filename: str, i: int = 0):
-    if i == 0:
-        return filename
+class StoredUpload(BaseModel):
+    """
+    An upload copied into the staging directory of the blob store, waiting to be put in place by place_blobs.
+    """
+    path: str
+    size: int
+    sha256: str
+    # the type of the contents, as opposed to the type claimed by the client
+    mime_type: str
+
+
+def sniff_mime_type(head: bytes) -> str:
+    """
+    Guesses the type of a file from its first bytes. Anything filetype doesn't recognize is text/plain if it is valid
+    UTF-8, or application/octet-stream otherwise.
+    """
+    if (kind := filetype.guess(head)) is not None:
+        return kind.mime
+
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # a character cut in half by the end of the sample doesn't count
+        if e.start < len(head) - 3 or e.reason != 'unexpected end of data':
+            return 'application/octet-stream'
+    return 'text/plain'
+
+
+def blob_path(path: str, sha256: str) -> str:
+    """
+    Where the blob with the given hash is stored. Two levels of directories keep each of them small.
+    """
+    return os.path.join(path, 'attachments', 'blobs', sha256[:2], sha256[2:4], sha256)
+
+
+def thumbnail_path(path: str, sha256: str, size: int, fmt: str) -> str:
+    """
+    Where the thumbnail of the given size and format of a blob is stored: next to the blob.
+    """
+    return f'{blob_path(path, sha256)}.{size}.{fmt}'
+
+
+def legacy_attachment_path(path: str, topic_id: int, post_id: Optional[int], filename: str) -> str:
+    """
+    Where an attachment stored under its filename lives, from before attachments were kept in the blob store.
+    """
+    directory = os.path.join(path, 'attachments', str(topic_id))
+    if post_id is not None:
+        directory = os.path.join(directory, '.posts', str(post_id))
+    return os.path.join(directory, filename)
+
+
+def _stage_upload(src: BinaryIO, staging_dir: str) -> StoredUpload:
+    os.makedirs(staging_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=staging_dir)
+    hasher = hashlib.sha256()
+    size = 0
+    head = b''
+    buf = bytearray(UPLOAD_CHUNK_SIZE)
+    view = memoryview(buf)
 
-    if m := __REGEX_REWRITE_FNAME.match(filename):
-        return f'{m.groups()[0]}.{i}.{m.groups()[1]}'
-    else:
-        return f'{filename}.{i}'
+    try:
+        # readable by a web server serving attachments directly
+        os.fchmod(fd, 0o644)
+        src.seek(0)
+        while n := src.readinto(buf):
+            chunk = view[:n]
+            if len(head) < _SNIFF_SIZE:
+                head += chunk[:_SNIFF_SIZE - len(head)]
+            hasher.update(chunk)
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+            size += n
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
 
+    return StoredUpload(path=tmp_path, size=size, sha256=hasher.hexdigest(), mime_type=sniff_mime_type(head))
 
-MAX_OPEN_ATTEMPTS = 100
 
+async def stage_uploads(path: str, uploads: Sequence[UploadFile], concurrency: int) -> List[StoredUpload]:
+    """
+    Copies uploads into the staging directory of the blob store under `path`, `concurrency` at a time, and measures,
+    hashes and sniffs each of them on the way. If any of them fails, the others are discarded.
+
+    The uploads have already been spooled by the multipart parser, so each copy is a single pass in large chunks,
+    done by one blocking call on the thread pool rather than one executor round trip per chunk.
+    """
+    staging_dir = os.path.join(path, 'attachments', 'blobs', 'tmp')
+    sem = asyncio.Semaphore(concurrency)
+
+    async def stage(upload: UploadFile) -> StoredUpload:
+        async with sem:
+            return await spawn_blocking(_stage_upload, upload.file, staging_dir)
 
-async def create_next_file(path, topic: int, filename: str, post: Optional[int] = None):
-    base_path = os.path.join(path, 'attachments', str(topic))
-    if post is not None:
-        base_path = os.path.join(base_path, '.posts', str(post))
+    results = await asyncio.gather(*[stage(u) for u in uploads], return_exceptions=True)
+    staged = [r for r in results if isinstance(r, StoredUpload)]
+    if len(staged) < len(results):
+        await discard_uploads(staged)
+        raise next(r for r in results if isinstance(r, BaseException))
+    return staged
 
-    os.makedirs(base_path, exist_ok=True)
 
-    i = 0
-    while i < MAX_OPEN_ATTEMPTS:
+def _stage_file(file_path: str, staging_dir: str) -> StoredUpload:
+    with open(file_path, 'rb', buffering=0) as f:
+        return _stage_upload(f, staging_dir)
+
+
+async def stage_file(path: str, file_path: str) -> StoredUpload:
+    """
+    Copies a file into the staging directory of the blob store under `path`, like stage_uploads.
+    """
+    return await spawn_blocking(_stage_file, file_path, os.path.join(path, 'attachments', 'blobs', 'tmp'))
+
+
+def _place_blobs(uploads: Sequence[Tuple[str, str]]):
+    placed = []
+    try:
+        for tmp_path, final_path in uploads:
+            if os.path.exists(final_path):
+                # the same contents were uploaded before
+                os.unlink(tmp_path)
+                continue
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+            placed.append(final_path)
+    except BaseException:
+        for final_path in placed:
+            os.unlink(final_path)
+        raise
+
+
+async def place_blobs(path: str, uploads: Sequence[StoredUpload]):
+    """
+    Moves staged uploads to their places in the blob store, dropping those whose contents the store already holds.
+    If one of them can't be put in place, the ones that were are removed again.
+    """
+    await spawn_blocking(_place_blobs, [(u.path, blob_path(path, u.sha256)) for u in uploads])
+
+
+def _unlink_if_exists(file_path: str):
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def _unlink_all_if_exist(file_paths: Sequence[str]):
+    for file_path in file_paths:
+        _unlink_if_exists(file_path)
+
+
+async def discard_uploads(uploads: Sequence[StoredUpload]):
+    """
+    Deletes staged uploads that were not put in place.
+    """
+    await spawn_blocking(_unlink_all_if_exist, [u.path for u in uploads])
+
+
+def _remove_blob_files(file_path: str):
+    _unlink_if_exists(file_path)
+    # and the thumbnails made from it, whatever their size or format
+    directory, name = os.path.split(file_path)
+    try:
+        derived = [entry.path for entry in os.scandir(directory) if entry.name.startswith(name + '.')]
+    except FileNotFoundError:
+        return
+    _unlink_all_if_exist(derived)
+
+
+def _remove_legacy_file(root: str, file_path: str):
+    _unlink_if_exists(file_path)
+    # prune the directories of topics and posts that no longer hold any files
+    directory = os.path.dirname(file_path)
+    while directory != root and directory.startswith(root + os.sep):
         try:
-            # x maps to O_CREAT
-            fname = _next_name(filename, i)
-            fpath = os.path.join(base_path, fname)
-            fd = await aiofiles.open(fpath, 'xb')
-            return fd, fname, fpath
-        except FileExistsError:
-            pass
-        i += 1
-
-    raise Exception(f'could not find an unused filename after {MAX_OPEN_ATTEMPTS} attempts')
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+async def remove_legacy_file(path: str, file_path: str):
+    """
+    Deletes the file of an attachment stored under its filename, and the directories it leaves empty.
+    """
+    await spawn_blocking(_remove_legacy_file, os.path.join(path, 'attachments'), file_path)
+
+
+async def remove_blob(path: str, sha256: str):
+    """
+    Deletes the file of a blob, along with its thumbnails.
+    """
+    await spawn_blocking(_remove_blob_files, blob_path(path, sha256))
@@ -0,0 +1,50 @@
+"""
+The kinds of jobs request handlers defer to the job queue, and what each of them does.
+"""
+import os
+
+from fastapi import FastAPI
+
+from forums.db.blobs import BlobRepository
+from forums.db.jobs import JobRepository
+from forums.ioutil import remove_blob, remove_legacy_file
+from forums.jobs import JobQueue
+from forums.utils import repo_for
+
+# {'sha256': str}: deletes the file (and thumbnails) of a blob that lost its last reference, unless it was uploaded
+# again in the meantime
+REMOVE_BLOB = 'remove_blob'
+# {'path': str}: deletes the file of an attachment stored under its filename; the path is relative to storage.path
+REMOVE_LEGACY_FILE = 'remove_legacy_file'
+# {'sha256': str}: renders the thumbnail of an image blob
+RENDER_THUMBNAIL = 'render_thumbnail'
+
+
+def create_job_queue(app: FastAPI) -> JobQueue:
+    """
+    Creates the job queue of this worker, with a handler registered for every kind of job.
+    """
+    cfg = app.state.cfg
+    storage_path = cfg.storage.path
+    queue = JobQueue(repo_for(app, JobRepository), cfg.jobs)
+
+    async def remove_unreferenced_blob(payload: dict):
+        await repo_for(app, BlobRepository).remove_if_unreferenced(payload['sha256'],
+                                                                   lambda sha256: remove_blob(storage_path, sha256))
+
+    async def remove_file(payload: dict):
+        file_path = os.path.join(storage_path, payload['path'])
+        if not os.path.normpath(file_path).startswith(os.path.join(os.path.normpath(storage_path), 'attachments')
+                                                      + os.sep):
+            raise ValueError(f'refusing to delete {file_path}: not an attachment')
+        await remove_legacy_file(storage_path, file_path)
+
+    async def render_thumbnail(payload: dict):
+        # a blob that can't be rendered is logged and shown as a link, so there is nothing to retry
+        if (thumbnails := app.state.thumbnails) is not None:
+            await thumbnails.get(payload['sha256'])
+
+    queue.register(REMOVE_BLOB, remove_unreferenced_blob, concurrency=4)
+    queue.register(REMOVE_LEGACY_FILE, remove_file, concurrency=4)
+    queue.register(RENDER_THUMBNAIL, render_thumbnail, concurrency=cfg.thumbnails.workers)
+    return queue
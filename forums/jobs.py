@@ -0,0 +1,161 @@
+"""
+A persistent queue of work that request handlers defer rather than doing it while the client waits.
+
+Jobs are rows of the jobs table, so they survive restarts and are shared by all workers. Each worker runs a loop per
+kind of job that claims due jobs and runs them, at most the kind's concurrency at a time. A job that raises is retried
+with exponential backoff until it runs out of attempts, and a job whose worker died is run again once its lease
+expires, so handlers must be idempotent.
+"""
+import asyncio
+import logging
+import random
+from contextlib import suppress
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from forums.config import JobConfig
+from forums.db.jobs import Job, JobBacklog, JobRepository
+
+# Called with the payload of a job
+JobHandler = Callable[[dict], Awaitable[None]]
+
+# How often jobs that were given up on are pruned
+_PRUNE_INTERVAL = 600.0
+# How long stop() lets running jobs finish before cancelling them
+_STOP_TIMEOUT = 10.0
+
+
+class _Kind:
+    __slots__ = ('handler', 'concurrency', 'running', 'wake')
+
+    def __init__(self, handler: JobHandler, concurrency: int):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.running: Set[asyncio.Task] = set()
+        # set when a job of this kind is queued by this worker or one of its running jobs finishes
+        self.wake = asyncio.Event()
+
+
+class JobQueue:
+    def __init__(self, repo: JobRepository, conf: JobConfig):
+        self._repo = repo
+        self.conf = conf
+        self._kinds: Dict[str, _Kind] = {}
+        self._loops: List[asyncio.Task] = []
+
+    def register(self, kind: str, handler: JobHandler, concurrency: int = 1):
+        """
+        Makes this worker run jobs of `kind` with `handler`, at most `concurrency` at a time. Every worker must
+        register the same kinds before start().
+        """
+        self._kinds[kind] = _Kind(handler, concurrency)
+
+    async def enqueue(self, kind: str, payload: dict, delay: float = 0) -> int:
+        """
+        Queues a job of `kind` to run `delay` seconds from now and returns its id. `payload` must be serializable as
+        JSON.
+
+        :raises: KeyError if no handler is registered for `kind`
+        """
+        k = self._kinds[kind]
+        job_id = await self._repo.put_job(Job(kind=kind, payload=payload), delay)
+        if delay <= 0:
+            k.wake.set()
+        return job_id
+
+    async def backlog(self) -> Tuple[JobBacklog, ...]:
+        """
+        Counts the jobs of each kind, across all workers.
+        """
+        return await self._repo.get_backlog()
+
+    def running(self) -> Dict[str, int]:
+        """
+        The number of jobs of each kind this worker is running.
+        """
+        return {kind: len(k.running) for kind, k in self._kinds.items()}
+
+    async def start(self):
+        self._loops = [asyncio.create_task(self._claim_loop(kind, k)) for kind, k in self._kinds.items()]
+        self._loops.append(asyncio.create_task(self._prune_loop()))
+
+    async def stop(self):
+        """
+        Stops claiming jobs and waits a little for the running ones. Those that don't finish in time are cancelled
+        and run again by some worker once their lease expires.
+        """
+        for task in self._loops:
+            task.cancel()
+        await asyncio.gather(*self._loops, return_exceptions=True)
+
+        running = [task for k in self._kinds.values() for task in k.running]
+        if running:
+            _, pending = await asyncio.wait(running, timeout=_STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.conf.retry_delay * 2 ** (attempts - 1), self.conf.max_retry_delay)
+        # spread out the retries of jobs that failed together, e.g. while the database was unreachable
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _run(self, job: Job, k: _Kind):
+        try:
+            await k.handler(job.payload)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            try:
+                if job.attempts >= self.conf.max_attempts:
+                    logging.error('giving up on job %d (%s) after %d attempts', job.id, job.kind, job.attempts,
+                                  exc_info=e)
+                    await self._repo.fail_job(job.id, error)
+                else:
+                    delay = self._retry_delay(job.attempts)
+                    logging.warning('job %d (%s) failed, retrying in %.0f s: %s', job.id, job.kind, delay, error)
+                    await self._repo.retry_job(job.id, delay, error)
+            except Exception as e2:
+                # it is retried when its lease expires
+                logging.error('failed to reschedule job %d', job.id, exc_info=e2)
+            return
+
+        try:
+            await self._repo.complete_job(job.id)
+        except Exception as e:
+            # it runs again when its lease expires, which handlers must cope with anyway
+            logging.error('failed to complete job %d', job.id, exc_info=e)
+
+    def _finished(self, k: _Kind, task: asyncio.Task):
+        k.running.discard(task)
+        k.wake.set()
+
+    async def _claim_loop(self, kind: str, k: _Kind):
+        while True:
+            # cleared before claiming, so that a job queued meanwhile isn't missed
+            k.wake.clear()
+            free = k.concurrency - len(k.running)
+            claimed = ()
+            if free > 0:
+                try:
+                    claimed = await self._repo.claim_jobs(kind, free, self.conf.lease)
+                except Exception as e:
+                    logging.error('failed to claim %s jobs', kind, exc_info=e)
+
+            for job in claimed:
+                task = asyncio.create_task(self._run(job, k))
+                k.running.add(task)
+                task.add_done_callback(lambda t: self._finished(k, t))
+
+            if free > 0 and len(claimed) == free:
+                # there may be more
+                continue
+            with suppress(TimeoutError):
+                async with asyncio.timeout(self.conf.poll_interval):
+                    await k.wake.wait()
+
+    async def _prune_loop(self):
+        while True:
+            await asyncio.sleep(_PRUNE_INTERVAL)
+            try:
+                await self._repo.delete_failed_older_than(self.conf.failed_retention)
+            except Exception as e:
+                logging.error('failed to prune failed jobs', exc_info=e)
@@ -0,0 +1,123 @@
+"""
+Production launcher: `python -m forums.launcher`.
+
+Binds the listening socket once, then runs `server.workers` uvicorn worker processes that all accept connections from
+it. Workers that exit unexpectedly are restarted. On SIGTERM or SIGINT, every worker stops accepting connections and
+finishes the requests it is handling (for up to `server.graceful_timeout` seconds) before the launcher exits.
+"""
+import logging
+import signal
+import sys
+import threading
+import time
+from multiprocessing.context import SpawnProcess
+from typing import List
+
+import uvicorn
+from uvicorn._subprocess import get_subprocess
+
+from forums.config import Config, load_config
+
+# A worker exiting sooner than this after being started counts as failing to start
+_MIN_UPTIME = 5.0
+# Upper bound for the delay between restarts of a worker that keeps failing to start
+_MAX_RESTART_DELAY = 30.0
+
+
+class _Worker:
+    def __init__(self, config: uvicorn.Config, sockets: list):
+        self.config = config
+        self.sockets = sockets
+        self.process: SpawnProcess | None = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+
+    def start(self):
+        self.process = get_subprocess(self.config, target=uvicorn.Server(config=self.config).run,
+                                      sockets=self.sockets)
+        self.process.start()
+        self.started_at = time.monotonic()
+
+    def check(self, now: float):
+        """
+        Restarts the worker if it has exited, backing off if it keeps exiting right after starting.
+        """
+        if self.process is not None:
+            if self.process.is_alive():
+                return
+            uptime = now - self.started_at
+            logging.error('worker %d exited with code %s after %.1f s', self.process.pid, self.process.exitcode,
+                          uptime)
+            self.process = None
+            if uptime < _MIN_UPTIME:
+                self.restart_delay = min(max(self.restart_delay * 2, 0.5), _MAX_RESTART_DELAY)
+            else:
+                self.restart_delay = 0.0
+            self.restart_at = now + self.restart_delay
+
+        if now >= self.restart_at:
+            self.start()
+            logging.info('restarted worker as %d', self.process.pid)
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            # uvicorn drains on SIGTERM
+            self.process.terminate()
+
+    def join(self, timeout: float):
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.warning('worker %d did not stop in time, killing it', self.process.pid)
+            self.process.kill()
+            self.process.join()
+
+
+def uvicorn_config(cfg: Config) -> uvicorn.Config:
+    server = cfg.server
+    return uvicorn.Config('forums.main:app', host=cfg.listen_ip, port=cfg.listen_port, workers=server.workers,
+                          loop=server.loop, http=server.http, backlog=server.backlog,
+                          timeout_graceful_shutdown=server.graceful_timeout)
+
+
+def main() -> int:
+    cfg = load_config()
+    config = uvicorn_config(cfg)
+    config.configure_logging()
+
+    sock = config.bind_socket()
+    workers: List[_Worker] = [_Worker(config, [sock]) for _ in range(cfg.server.workers)]
+    should_exit = threading.Event()
+
+    def handle_exit(signum, _frame):
+        logging.info('received %s, draining workers', signal.Signals(signum).name)
+        should_exit.set()
+
+    signal.signal(signal.SIGTERM, handle_exit)
+    signal.signal(signal.SIGINT, handle_exit)
+
+    logging.info('starting %d workers (db pool size %s each)', len(workers), cfg.db.get('maxsize', cfg.db_pool_size()))
+    for w in workers:
+        w.start()
+
+    while not should_exit.wait(0.5):
+        now = time.monotonic()
+        for w in workers:
+            w.check(now)
+
+    for w in workers:
+        w.stop()
+    deadline = time.monotonic() + cfg.server.graceful_timeout + 5
+    for w in workers:
+        w.join(max(0.0, deadline - time.monotonic()))
+
+    sock.close()
+    logging.info('all workers stopped')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -3,18 +3,30 @@ import asyncio
 import logging
 
 import aiomysql
-from starlette import status
-from starlette.requests import Request
-from starlette.responses import Response
-from starlette.staticfiles import StaticFiles
-from starlette.templating import Jinja2Templates
 
+from forums.admission import AdmissionMiddleware, ConcurrencyLimiter
+from forums.assets import create_static_files
+from forums.body_limit import BodyLimitMiddleware
+from forums.bus import InvalidationBus
+from forums.compression import CompressionMiddleware
+from forums.cache import Caches, FragmentCache, VersionTable
 from forums.config import load_config
+from forums.deadlines import DeadlineMiddleware
+from forums.db.invalidations import InvalidationRepository
+from forums.db.memory import MemoryDatabase
+from forums.db.topics import TopicRepository
+from forums.job_handlers import create_job_queue
+from forums.ratelimit import RateLimits
 from fastapi import FastAPI, HTTPException
 import uvicorn
 from contextlib import asynccontextmanager, suppress
 
 from forums.routes import router
+from forums.suggest import TitleIndex
+from forums.templates import create_templates, create_streaming_env, precompile
+from forums.thumbnails import create_thumbnailer, thumbnail_types
+from forums.utils import repo_for
+from forums.warmup import warm_up
 
 
 @asynccontextmanager
@@ -25,9 +37,31 @@ async def lifespan(a: FastAPI):
 
     It is called automatically by FastAPI
     """
+    # compile every template now, which also fails startup if any of them are broken
+    count, elapsed = precompile(a.state.tpl.env)
+    if a.state.stream_env is not None:
+        elapsed += precompile(a.state.stream_env)[1]
+    logging.info('loaded %d templates in %.1f ms', count, elapsed * 1000)
+
+    a.state.thumbnails = create_thumbnailer(a.state.cfg.storage.path, a.state.cfg.thumbnails)
+
+    if a.state.cfg.backend == 'memory':
+        a.state.db = MemoryDatabase()
+        a.state.jobs = create_job_queue(a)
+        await a.state.jobs.start()
+        await warm_up(a)
+        yield
+        a.state.ready = False
+        await a.state.jobs.stop()
+        if a.state.thumbnails is not None:
+            await a.state.thumbnails.close()
+        return
+
     # force autocommit and charset
     a.state.cfg.db["autocommit"] = True
     a.state.cfg.db["charset"] = "utf8mb4"
+    # split the connection budget between the workers, unless the pool size is set explicitly
+    a.state.cfg.db.setdefault("maxsize", cfg.db_pool_size())
     # must not exist
     with suppress(KeyError):
         del a.state.cfg.db["loop"]
@@ -35,39 +69,58 @@ async def lifespan(a: FastAPI):
     # Create mysql connection pool
     a.state.db = await aiomysql.create_pool(**cfg.db, loop=asyncio.get_running_loop())
 
+    # share cache invalidations with the other workers
+    bus = InvalidationBus(a.state.caches, InvalidationRepository(a.state.db),
+                          poll_interval=cfg.cache.invalidation_poll_interval,
+                          retention=cfg.cache.invalidation_retention)
+    await bus.start()
+
+    a.state.jobs = create_job_queue(a)
+    await a.state.jobs.start()
+
+    # open connections and fill the caches before accepting requests
+    await warm_up(a)
+
     yield
 
+    a.state.ready = False
+    await a.state.jobs.stop()
+    if a.state.thumbnails is not None:
+        await a.state.thumbnails.close()
+    await bus.stop()
     a.state.db.close()
     await a.state.db.wait_closed()
 
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(router())
-app.mount('/static', StaticFiles(directory='static'), name='static')
 cfg = load_config()
 app.state.cfg = cfg
-app.state.tpl = Jinja2Templates(directory='templates')
-
-
-@app.middleware("http")
-async def limit_request_body_size(request: Request, call_next):
-    if request.method.upper() != 'POST':
-        return await call_next(request)
-
-    storage_conf = request.app.state.cfg.storage
-
-    try:
-        length = int(request.headers['Content-Length'])
-
-        if length > storage_conf.max_file_size:
-            return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, content='Request body is too large.')
-    except KeyError:
-        return Response(status_code=status.HTTP_411_LENGTH_REQUIRED, content='Please include the Content-Length'
-                                                                             ' header for file uploads.')
-    except ValueError:
-        return Response(status_code=status.HTTP_400_BAD_REQUEST, content='Please include the Content-Length'
-                                                                         ' header for file uploads.')
-    return await call_next(request)
+# set once the worker has warmed up, see forums.warmup
+app.state.ready = False
+# renders thumbnails of image attachments, created at startup; None if thumbnails are disabled or unavailable
+app.state.thumbnails = None
+# the queue of deferred work, created at startup, see forums.jobs
+app.state.jobs = None
+app.state.rate_limits = RateLimits(cfg.rate_limits)
+# the adaptive concurrency limit of this worker, see forums.admission
+app.state.admission = ConcurrencyLimiter(cfg.concurrency)
+static_files, assets = create_static_files(cfg.assets)
+app.mount('/static', static_files, name='static')
+thumbnailed = thumbnail_types(cfg.thumbnails)
+app.state.tpl = create_templates(cfg.templates, assets, thumbnailed)
+app.state.stream_env = create_streaming_env(cfg.templates, assets, thumbnailed) if cfg.templates.stream_pages else None
+app.state.caches = Caches(FragmentCache(ttl=cfg.cache.fragment_ttl, stale_ttl=cfg.cache.fragment_stale_ttl,
+                                        max_entries=cfg.cache.fragment_max_entries),
+                          VersionTable(),
+                          FragmentCache(ttl=cfg.cache.search_ttl, stale_ttl=0, max_entries=cfg.cache.search_max_entries),
+                          TitleIndex(lambda topic_id: repo_for(app, TopicRepository).get_topic_by_id(topic_id,
+                                                                                                     include_hidden=True)))
+app.add_middleware(DeadlineMiddleware, conf=cfg.request)
+app.add_middleware(CompressionMiddleware, conf=cfg.compression)
+app.add_middleware(BodyLimitMiddleware, conf=cfg.request, max_upload_size=cfg.storage.max_file_size)
+# outermost, so that requests that are turned away cost as little as possible
+app.add_middleware(AdmissionMiddleware, limiter=app.state.admission)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+"""
+Attachment migration: `python -m forums.migrate_attachments`.
+
+Moves attachments stored under their filename (in one directory per topic, and one per post below it) into the blob
+store, where each file is named after the hash of its contents and stored once. Attachments are moved one at a time,
+each in its own transaction, so the migration can run while the forum is up, and can be interrupted and rerun: it
+picks up the attachments that haven't been moved yet.
+
+A file is copied into the blob store and the attachment row pointed at the blob before the old file is deleted, so an
+attachment is never left without a file.
+
+The database must have the tables and columns of the blob store first: apply upgrade.sql to a database created before
+them.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from typing import Awaitable, Callable
+
+from pydantic import BaseModel
+
+from forums.config import load_config
+from forums.db.blobs import Blob
+from forums.db.post_attachment import PostAttachmentRepository
+from forums.db.topic_attachment import TopicAttachmentRepository
+from forums.db.utils import create_tool_pool
+from forums.ioutil import legacy_attachment_path, stage_file, place_blobs, discard_uploads, remove_legacy_file
+
+# Attachments loaded per query
+_BATCH_SIZE = 500
+
+
+class MigrationResult(BaseModel):
+    # attachments moved into the blob store (or that would be, in a dry run)
+    moved: int = 0
+    # attachments whose file doesn't exist
+    missing: int = 0
+    # attachments that could not be moved for another reason
+    failed: int = 0
+
+
+async def _move(storage_path: str, file_path: str,
+                move: Callable[[Blob, Callable[[], Awaitable[None]]], Awaitable[bool]], result: MigrationResult,
+                dry_run: bool):
+    try:
+        upload = await stage_file(storage_path, file_path)
+    except FileNotFoundError:
+        logging.warning('%s is missing', file_path)
+        result.missing += 1
+        return
+    except OSError as e:
+        logging.error('failed to read %s', file_path, exc_info=e)
+        result.failed += 1
+        return
+
+    try:
+        if dry_run:
+            result.moved += 1
+            return
+
+        blob = Blob(sha256=upload.sha256, size=upload.size, mime_type=upload.mime_type)
+        if not await move(blob, lambda: place_blobs(storage_path, [upload])):
+            # deleted or moved in the meantime
+            return
+        await remove_legacy_file(storage_path, file_path)
+        result.moved += 1
+    except Exception as e:
+        logging.error('failed to move %s', file_path, exc_info=e)
+        result.failed += 1
+    finally:
+        # nothing is left to discard once the upload has been put in place
+        await discard_uploads([upload])
+
+
+async def migrate(storage_path: str, topic_attach_repo: TopicAttachmentRepository,
+                  post_attach_repo: PostAttachmentRepository, concurrency: int = 4,
+                  dry_run: bool = False) -> MigrationResult:
+    """
+    Moves every attachment stored under its filename into the blob store, `concurrency` at a time. With `dry_run`,
+    the files are only read and hashed, and nothing is changed.
+    """
+    result = MigrationResult()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def move(file_path: str, mover):
+        async with sem:
+            await _move(storage_path, file_path, mover, result, dry_run)
+
+    after = 0
+    while attachments := await topic_attach_repo.get_legacy_attachments(after, _BATCH_SIZE):
+        await asyncio.gather(*[
+            move(legacy_attachment_path(storage_path, a.thread, None, a.filename),
+                 lambda blob, place, a=a: topic_attach_repo.move_to_blob(a.id, blob, place))
+            for a in attachments])
+        after = attachments[-1].id
+        logging.info('topic attachments: %s', result)
+
+    after = 0
+    while attachments := await post_attach_repo.get_legacy_attachments(after, _BATCH_SIZE):
+        await asyncio.gather(*[
+            move(legacy_attachment_path(storage_path, topic_id, a.post, a.filename),
+                 lambda blob, place, a=a: post_attach_repo.move_to_blob(a.id, blob, place))
+            for a, topic_id in attachments])
+        after = attachments[-1][0].id
+        logging.info('post attachments: %s', result)
+
+    return result
+
+
+async def _run(args: argparse.Namespace) -> MigrationResult:
+    cfg = load_config()
+    if cfg.backend != 'mysql':
+        raise SystemExit('the memory backend has no attachments to migrate')
+
+    pool = await create_tool_pool(cfg.db, args.concurrency + 1)
+    try:
+        return await migrate(cfg.storage.path, TopicAttachmentRepository(pool), PostAttachmentRepository(pool),
+                             args.concurrency, args.dry_run)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m forums.migrate_attachments',
+                                     description='Moves attachments stored under their filename into the blob store.')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='attachments moved at the same time')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only read the files, change nothing')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = asyncio.run(_run(args))
+    logging.info('%s %d attachments in %.1f s, %d missing, %d failed', 'would move' if args.dry_run else 'moved',
+                 result.moved, time.perf_counter() - start, result.missing, result.failed)
+    return 1 if result.failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Rate limits on routes that are expensive to serve, such as logins (Argon2), searches and posts.
+
+Each limit is a set of token buckets, one per client key (an IP address, a user or a username). A bucket holds up to
+`burst` tokens and gains `per_minute` of them every minute; a request takes one, and is rejected with 429 and a
+Retry-After header when there are none. A bucket is just its token count and when it was last updated, and the buckets
+of a limit are kept in least recently used order, so checking a request is O(1) and memory is bounded by `max_keys`.
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from starlette import status
+
+from forums.config import RateLimitConfig, RateLimitRule
+
+
+class RateLimiter:
+    """
+    The token buckets of one limit, keyed by client.
+    """
+
+    def __init__(self, rule: RateLimitRule, max_keys: int):
+        self.rate = rule.per_minute / 60
+        self.burst = rule.burst
+        self.max_keys = max_keys
+        # key -> (tokens, when they were counted), least recently used first
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """
+        Takes a token from the bucket of `key`. Returns 0 if there was one, otherwise how many seconds it takes until
+        there is.
+        """
+        if self.rate <= 0:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+
+        if (bucket := self._buckets.get(key)) is None:
+            tokens = float(self.burst)
+        else:
+            tokens = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            self._buckets.move_to_end(key)
+
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class RateLimits:
+    """
+    The limits of this worker, one per rule of the configuration.
+    """
+
+    def __init__(self, conf: RateLimitConfig):
+        self.enabled = conf.enabled
+        self._limiters: Dict[str, RateLimiter] = {name: RateLimiter(rule, conf.max_keys) for name, rule in conf
+                                                  if isinstance(rule, RateLimitRule)}
+
+    def check(self, rule: str, key: str):
+        """
+        Counts a request of the client `key` against the limit `rule`.
+
+        :raises: HTTPException (429) if the client is over the limit
+        """
+        if not self.enabled:
+            return
+        if wait := self._limiters[rule].acquire(key):
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                headers={'Retry-After': str(math.ceil(wait)), 'Cache-Control': 'no-store'},
+                                detail='Too many requests, try again later.')
+
+
+def get_rate_limits(req: Request) -> RateLimits:
+    return req.app.state.rate_limits
+
+
+def client_ip(req: Request) -> str:
+    return req.client.host if req.client else ''
+
+
+def limit_by_ip(rule: str) -> Callable[[Request], Awaitable[None]]:
+    """
+    A dependency that applies the limit `rule` to the address of the client, e.g.
+
+    @router.post('/my-route', dependencies=[Depends(limit_by_ip('login'))])
+    """
+
+    # a coroutine, so that FastAPI runs it on the event loop rather than in a thread
+    async def dependency(req: Request):
+        get_rate_limits(req).check(rule, client_ip(req))
+
+    return dependency
@@ -3,6 +3,7 @@ from forums.routes.auth import router as auth_router
 from .system import pages_router
 from .topic import topic_router
 from .categories import cat_router
+from .health import health_router
 
 
 def router() -> APIRouter:
@@ -12,5 +13,6 @@ def router() -> APIRouter:
     app_router.include_router(topic_router, prefix='/topic')
     app_router.include_router(auth_router, prefix='/auth')
     app_router.include_router(cat_router, prefix='/categories')
+    app_router.include_router(health_router, prefix='/healthz')
 
     return app_router
@@ -7,7 +7,7 @@ import re
 from contextlib import suppress
 from datetime import datetime, timezone, timedelta
 from hmac import compare_digest
-from typing import Optional, Tuple, Annotated, Sequence
+from typing import Optional, Tuple, Annotated, Sequence, Callable, Awaitable
 from urllib.parse import urlencode
 
 from argon2 import PasswordHasher
@@ -21,7 +21,9 @@ from starlette.responses import RedirectResponse
 
 from forums.blocking import spawn_blocking
 from forums.config import LoginConfig
-from forums.db.users import UserRepository, get_user_repo, User
+from forums.db.users import UserRepository, User
+from forums.ratelimit import get_rate_limits, limit_by_ip
+from forums.utils import get_user_repo
 
 router = APIRouter()
 
@@ -81,7 +83,11 @@ class RequestLogin(BaseModel):
     csrf_token: str
 
 
-@router.post('/login')
+async def _limit_login_username(req: Request, username: Annotated[str, Form()]):
+    get_rate_limits(req).check('login_username', username)
+
+
+@router.post('/login', dependencies=[Depends(limit_by_ip('login')), Depends(_limit_login_username)])
 async def login(req: Request, username: Annotated[str, Form()], password: Annotated[str, Form()],
                 csrf_token: Annotated[str, Form()],
                 user_repo: UserRepository = Depends(get_user_repo)) -> RedirectResponse:
@@ -129,6 +135,12 @@ async def current_user(req: Request, user_repo: UserRepository = Depends(get_use
     try:
         payload = _decode_login_jwt(login_conf.secret, req.cookies[login_conf.cookie_name])
         if user := await user_repo.get_user_by_name(payload.sub):
+            # requests of moderators are never shed under load, see forums.admission
+            moderators = req.app.state.admission.moderators
+            if user.is_moderator():
+                moderators.add(user.username)
+            else:
+                moderators.discard(user.username)
             return user
 
         # Still here?
@@ -143,6 +155,22 @@ async def current_user(req: Request, user_repo: UserRepository = Depends(get_use
                             detail='This route requires authentication.') from e
 
 
+def limit_by_user(rule: str) -> Callable[..., Awaitable[User]]:
+    """
+    A dependency that applies the rate limit `rule` to the current user and returns the user, e.g.
+
+    @router.post('/my-route')
+    async def my_route(user: User = Depends(limit_by_user('post'))):
+        pass
+    """
+
+    async def dependency(req: Request, user: User = Depends(current_user)) -> User:
+        get_rate_limits(req).check(rule, str(user.user_id))
+        return user
+
+    return dependency
+
+
 async def _assert_no_user(req: Request, user_repo: UserRepository = Depends(get_user_repo)):
     """
     Redirects the user to the index page if they have a valid login.
@@ -173,7 +201,7 @@ def whoami(user: User = Depends(current_user)) -> WhoAmIReply:
     return WhoAmIReply(user_id=user.user_id, username=user.username, display_name=user.display_name)
 
 
-@router.post('/register')
+@router.post('/register', dependencies=[Depends(limit_by_ip('registration'))])
 async def register(req: Request, first_name: Annotated[str, Form()], last_name: Annotated[str, Form()],
                    username: Annotated[str, Form()], password: Annotated[str, Form()],
                    csrf_token: Annotated[str, Form()],
@@ -308,7 +336,7 @@ def generate_csrf_token(req: Request) -> str:
 
     def x(csrf_token: str = Depends(generate_csrf_token))
     """
-    user, csrf_secret = _extract_from_cookie(req)
+    user, csrf_secret = extract_from_cookie(req)
     now = datetime.now(tz=timezone.utc)
 
     token = _CSRFToken(
@@ -329,7 +357,7 @@ def csrf_verify(req: Request, token: str):
     :raises: HTTPException if the token is not valid or could not be verified.
     :returns None:
     """
-    user, csrf_secret = _extract_from_cookie(req)
+    user, csrf_secret = extract_from_cookie(req)
 
     try:
         token = _CSRFToken(**decode(token, req.app.state.cfg.login.secret,
@@ -345,7 +373,11 @@ def csrf_verify(req: Request, token: str):
         raise HTTPException(status_code=403, detail="csrf token validation failed")
 
 
-def _extract_from_cookie(req: Request) -> Tuple[str | None, str | None]:
+def extract_from_cookie(req: Request) -> Tuple[str | None, str | None]:
+    """
+    Returns the username and CSRF secret of the login cookie of the request, or (None, None) if it has no valid one.
+    The user is not looked up, so the account may have been changed or deleted since the cookie was issued.
+    """
     login_conf = req.app.state.cfg.login
     with suppress(KeyError, InvalidTokenError):
         j = _decode_login_jwt(login_conf.secret, req.cookies[login_conf.cookie_name])
@@ -1,10 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, Form, Request
+from markupsafe import Markup
 from pydantic import Field, BaseModel
 from pymysql import IntegrityError
 from starlette import status
 from starlette.responses import RedirectResponse
 from starlette.templating import Jinja2Templates
 
+from forums.cache import Caches, CategoryListing, CATEGORY_TREE_TAG, category_tag
+from forums.conditional import page_etag, etag_matches, not_modified, page_headers
 from forums.db.categories import CategoryRepository, Category
 from forums.db.topics import TopicRepository
 from forums.db.users import User
@@ -16,7 +19,7 @@ import regex
 from urllib.parse import urlencode
 import logging
 
-from forums.utils import get_category_repo, get_topic_repo, async_collect, get_templates
+from forums.utils import get_category_repo, get_topic_repo, async_collect, get_templates, get_caches
 
 cat_router = APIRouter()
 TOPICS_PER_PAGE = 20
@@ -37,28 +40,55 @@ def _desc_is_valid(desc: str):
     return (0 < len(desc) <= CATEGORY_DESC_MAX_SIZE) and _CAT_BAD_CHARS.match(desc) is None
 
 
+async def cached_category_listing(caches: Caches, topic_repo: TopicRepository, tpl: Jinja2Templates, cat_id: int,
+                                  page: int, is_moderator: bool) -> CategoryListing:
+    """
+    Returns the topic listing shown on a page of a category, rendering it if it isn't cached. The listing is the same
+    for everyone with the same role, so it is shared between users.
+    """
+    async def render() -> CategoryListing:
+        (total_results, topics), pins = await gather(
+            topic_repo.generate_category_list_data(cat_id, include_hidden=is_moderator, limit=TOPICS_PER_PAGE,
+                                                   skip=(page - 1) * TOPICS_PER_PAGE),
+            topic_repo.get_pinned_topics(cat_id, include_hidden=is_moderator))
+
+        pins_html = tpl.get_template('_cat_pins.html').render({'pins': pins})
+        topics_html = tpl.get_template('_cat_topics.html').render({
+            'category_id': cat_id,
+            'topics': topics,
+            'current_page': page,
+            'total_pages': (total_results // TOPICS_PER_PAGE) + 1,
+        })
+        return CategoryListing(total_results=total_results, pins_html=pins_html, topics_html=topics_html,
+                               topic_ids=tuple(t.topic_id for t in topics))
+
+    return await caches.fragments.get_or_render(('category', cat_id, page, is_moderator), (category_tag(cat_id),),
+                                                render)
+
+
 @cat_router.get('/{cat_id}')
 async def category_index(req: Request, cat_id: int, page: int = 1, user: User = Depends(current_user),
                          cat_repo: CategoryRepository = Depends(get_category_repo),
                          topic_repo: TopicRepository = Depends(get_topic_repo),
                          tpl: Jinja2Templates = Depends(get_templates),
+                         caches: Caches = Depends(get_caches),
                          csrf_token: str = Depends(generate_csrf_token)):
     if page < 1:
         raise HTTPException(status_code=status.HTTP_303_SEE_OTHER,
                             detail='page number must be greater than 0', headers={'Location': '/'})
 
-    offset = (page - 1) * TOPICS_PER_PAGE
+    # answer revalidations from the version stamps alone, before loading anything
+    etag = page_etag(req, user, caches.versions.stamp(category_tag(cat_id), CATEGORY_TREE_TAG))
+    if etag_matches(req, etag):
+        return not_modified(etag)
+
+    is_moderator = user.is_moderator()
 
-    cat, (total_results, topics), subcat, pins = await gather(cat_repo.get_category_by_id(cat_id),
-                                                              topic_repo.generate_category_list_data(cat_id,
-                                                                                                     include_hidden=user.is_moderator(),
-                                                                                                     limit=TOPICS_PER_PAGE,
-                                                                                                     skip=offset),
-                                                              async_collect(
-                                                                  cat_repo.get_subcategories_of_category(cat_id,
-                                                                                                         include_hidden_in_cnt=user.is_moderator())),
-                                                              topic_repo.get_pinned_topics(cat_id,
-                                                                                           include_hidden=user.is_moderator()))
+    cat, subcat, listing = await gather(cat_repo.get_category_by_id(cat_id),
+                                        async_collect(
+                                            cat_repo.get_subcategories_of_category(cat_id,
+                                                                                   include_hidden_in_cnt=is_moderator)),
+                                        cached_category_listing(caches, topic_repo, tpl, cat_id, page, is_moderator))
 
     if cat is None:
         raise HTTPException(status_code=404, detail='No such category')
@@ -73,18 +103,16 @@ async def category_index(req: Request, cat_id: int, page: int = 1, user: User =
 
     ctx = {
         'category': cat,
-        'topics': topics,
         'children': subcat,
-        'current_page': page,
-        'total_pages': (total_results // TOPICS_PER_PAGE) + 1,
-        'total_results': total_results,
+        'total_results': listing.total_results,
         'user': user,
         'bread': bread,
-        'pins': pins,
+        'pins_html': Markup(listing.pins_html),
+        'topics_html': Markup(listing.topics_html),
         'csrf_token': csrf_token
     }
 
-    return tpl.TemplateResponse(req, name='cat_index.html', context=ctx)
+    return tpl.TemplateResponse(req, name='cat_index.html', context=ctx, headers=page_headers(etag))
 
 
 @cat_router.get('/{cat_id}/edit')
@@ -119,7 +147,8 @@ async def create_category(
         req: Request,
         name: Annotated[str, Form()], desc: Annotated[str, Form()], csrf_token: Annotated[str, Form()],
         parent: Annotated[int | None, Form()] = None, user: User = Depends(current_user),
-        cat_repo: CategoryRepository = Depends(get_category_repo)):
+        cat_repo: CategoryRepository = Depends(get_category_repo),
+        caches: Caches = Depends(get_caches)):
     eparams = {'child_of': str(parent)} if parent is not None else {}
 
     # check privs
@@ -165,6 +194,8 @@ async def create_category(
                                     **eparams
                                 }))
 
+    caches.invalidate(CATEGORY_TREE_TAG)
+
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/categories/{new_cat.id}')
 
 
@@ -174,7 +205,8 @@ async def delete_category(
         cat_id: int,
         csrf_token: str,
         user: User = Depends(current_user),
-        cat_repo: CategoryRepository = Depends(get_category_repo)):
+        cat_repo: CategoryRepository = Depends(get_category_repo),
+        caches: Caches = Depends(get_caches)):
     # check priv
     if not user.is_moderator():
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Only moderators can delete categories.')
@@ -191,6 +223,8 @@ async def delete_category(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='The category must have no subcategories '
                                                                             'and no topics before it can be deleted.')
 
+    caches.invalidate(CATEGORY_TREE_TAG)
+
     # returns to the parent, if one
     if cat.parent_cat is not None:
         return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/categories/{cat.parent_cat}')
@@ -214,7 +248,8 @@ async def patch_category(req: Request,
                          cat_id: int, name: Annotated[str, Form()], desc: Annotated[str, Form()],
                          parent: Annotated[int, Form()], csrf_token: Annotated[str, Form()],
                          user: User = Depends(current_user),
-                         cat_repo: CategoryRepository = Depends(get_category_repo)):
+                         cat_repo: CategoryRepository = Depends(get_category_repo),
+                         caches: Caches = Depends(get_caches)):
     # check priv
     if not user.is_moderator():
         return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER,
@@ -255,4 +290,6 @@ async def patch_category(req: Request,
                                     'error': 'the parent category is not valid'
                                 }))
 
+    caches.invalidate(CATEGORY_TREE_TAG)
+
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/categories/{cat.id}')
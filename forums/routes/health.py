@@ -0,0 +1,70 @@
+import asyncio
+
+from fastapi import APIRouter, Request
+from starlette import status
+from starlette.responses import JSONResponse, PlainTextResponse
+
+health_router = APIRouter()
+
+# How long the liveness check waits for a database connection
+_PING_TIMEOUT = 2.0
+
+
+def _answer(ok: bool, reason: str) -> PlainTextResponse:
+    return PlainTextResponse('ok' if ok else reason, headers={'Cache-Control': 'no-store'},
+                             status_code=status.HTTP_200_OK if ok else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+@health_router.get('/ready')
+async def ready(req: Request):
+    """
+    Whether this worker has finished warming up and should be sent traffic.
+    """
+    return _answer(getattr(req.app.state, 'ready', False), 'warming up')
+
+
+@health_router.get('/live')
+async def live(req: Request):
+    """
+    Whether this worker can still reach the database. An idle connection, or a new one if there is none, is checked
+    with a ping rather than a query; a worker whose connections are all in use is busy, not dead.
+    """
+    if req.app.state.cfg.backend != 'mysql':
+        return _answer(True, '')
+
+    pool = req.app.state.db
+    if pool.closed:
+        return _answer(False, 'database pool closed')
+    # broken connections are dropped from the pool, so an empty pool may well mean the database is down
+    if pool.freesize == 0 and pool.size >= pool.maxsize:
+        return _answer(True, '')
+
+    try:
+        async with asyncio.timeout(_PING_TIMEOUT):
+            async with pool.acquire() as conn:
+                await conn.ping(reconnect=True)
+    except Exception:
+        return _answer(False, 'database unreachable')
+    return _answer(True, '')
+
+
+@health_router.get('/jobs')
+async def jobs(req: Request):
+    """
+    The backlog of the job queue: how many jobs of each kind are due, scheduled for later and given up on, when the
+    oldest one still to run was queued, and how many this worker is running.
+    """
+    queue = req.app.state.jobs
+    running = queue.running()
+    return JSONResponse({'backlog': [{**entry.model_dump(mode='json'), 'running_here': running.get(entry.kind, 0)}
+                                     for entry in await queue.backlog()]},
+                        headers={'Cache-Control': 'no-store'})
+
+
+@health_router.get('/load')
+async def load(req: Request):
+    """
+    The adaptive concurrency limit of this worker, how many requests it is handling and has waiting, and how many it
+    has turned away since it started.
+    """
+    return JSONResponse(req.app.state.admission.stats(), headers={'Cache-Control': 'no-store'})
@@ -3,19 +3,23 @@ from urllib.parse import urlencode
 
 from fastapi import APIRouter, Depends, Request, HTTPException
 from starlette import status
-from starlette.responses import RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse
 from starlette.templating import Jinja2Templates
 
-from .auth import current_user, _assert_no_user, generate_csrf_token
+from .auth import current_user, _assert_no_user, generate_csrf_token, limit_by_user, extract_from_cookie
 from .categories import TOPICS_PER_PAGE
+from ..cache import Caches, SearchHits, SEARCH_TAG
 from ..db.categories import CategoryRepository
 from ..db.topics import TopicRepository
 from ..db.users import User
-from forums.utils import get_templates, get_category_repo, async_collect, get_topic_repo
+from forums.utils import get_templates, get_category_repo, async_collect, get_topic_repo, get_caches
 import re
 
 pages_router = APIRouter()
 
+# The most title suggestions returned at once
+MAX_SUGGESTIONS = 10
+
 
 @pages_router.get('/')
 async def index(req: Request, user: User = Depends(current_user),
@@ -115,15 +119,32 @@ async def search(
         page: int = 1,
         tpl: Jinja2Templates = Depends(get_templates),
         topic_repo: TopicRepository = Depends(get_topic_repo),
-        user: User = Depends(current_user)
+        caches: Caches = Depends(get_caches),
+        user: User = Depends(limit_by_user('search'))
 ):
     if page < 1:
         raise HTTPException(status_code=status.HTTP_303_SEE_OTHER, detail='page number must be greater than 0',
                             headers={'Location': '/'})
 
     offset = (page - 1) * TOPICS_PER_PAGE
-
-    (count, results) = await topic_repo.generate_search_result_data(q, limit=TOPICS_PER_PAGE, skip=offset, include_hidden=user.is_moderator())
+    include_hidden = user.is_moderator()
+    timeout = req.app.state.cfg.request.search_deadline
+
+    # the ids of the first pages of results are cached and shared by everyone searching for the same phrase (LIKE is
+    # case-insensitive), so paging through them only loads the topics shown
+    async def find() -> SearchHits:
+        total, topic_ids = await topic_repo.get_search_result_ids(q, req.app.state.cfg.cache.search_max_results,
+                                                                  include_hidden=include_hidden, timeout=timeout)
+        return SearchHits(total_results=total, topic_ids=topic_ids)
+
+    hits = await caches.search.get_or_render((q.casefold(), include_hidden), (SEARCH_TAG, ), find)
+    count = hits.total_results
+    if offset + TOPICS_PER_PAGE <= len(hits.topic_ids) or count <= len(hits.topic_ids):
+        results = await topic_repo.get_search_results(hits.topic_ids[offset:offset + TOPICS_PER_PAGE],
+                                                      include_hidden=include_hidden)
+    else:
+        (count, results) = await topic_repo.generate_search_result_data(q, limit=TOPICS_PER_PAGE, skip=offset, include_hidden=include_hidden,
+                                                                        timeout=timeout)
 
     ctx = {
         'user': user,
@@ -138,6 +159,26 @@ async def search(
     return tpl.TemplateResponse(req, name='search.html', context=ctx)
 
 
+@pages_router.get('/suggest')
+async def suggest(req: Request, q: str, limit: int = 8, caches: Caches = Depends(get_caches)):
+    """
+    The ids and titles of topics whose title, or one of its first words, starts with `q`, for typeahead. It is sent on
+    every keystroke, so it is answered from memory alone: the session cookie is verified, but the user isn't loaded.
+
+    Whether the user is a moderator, who is also suggested hidden topics, is taken from the moderators this worker
+    keeps for admission control. current_user keeps it up to date on every other request of the user, and the pages
+    the typeahead is on are such requests.
+    """
+    username, _ = extract_from_cookie(req)
+    if username is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='This route requires authentication.')
+
+    found = caches.titles.suggest(q[:200], max(1, min(limit, MAX_SUGGESTIONS)),
+                                  include_hidden=username in req.app.state.admission.moderators)
+    return JSONResponse([{'topic_id': topic_id, 'title': title} for topic_id, title in found],
+                        headers={'Cache-Control': 'private, max-age=10'})
+
+
 def format_error(err: str):
     """
     Add a period and capitalizes the error.
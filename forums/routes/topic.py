@@ -3,30 +3,40 @@ import os
 from urllib.parse import urlencode
 
 from fastapi import Form, APIRouter, Depends, HTTPException, Request, UploadFile, File
-from typing import Annotated, Optional, List
+from typing import Annotated, Optional, List, Tuple, Hashable, Callable, Awaitable
 
+from jinja2 import Environment
+from markupsafe import Markup
 from pydantic import BaseModel, Field
 from pymysql import IntegrityError
 from starlette import status
-from starlette.responses import RedirectResponse, Response, FileResponse
+from starlette.responses import RedirectResponse, Response
 from starlette.templating import Jinja2Templates
 
 from forums.blocking import spawn_blocking
+from forums.cache import Caches, ReplyListing, CSRF_PLACEHOLDER, CATEGORY_TREE_TAG, topic_tag, category_tag
+from forums.conditional import page_etag, etag_matches, not_modified, page_headers
+from forums.downloads import send_attachment, send_thumbnail
+from forums.db.blobs import Blob
 from forums.db.categories import CategoryRepository
 from forums.db.post_attachment import PostAttachment, PostAttachmentRepository
 from forums.db.posts import PostRepository, Post, POST_IS_HIDDEN
 from forums.db.topic_attachment import TopicAttachment, TopicAttachmentRepository
 from forums.db.topics import TOPIC_ALL_FLAGS, Topic, TopicRepository, TOPIC_IS_HIDDEN, TOPIC_IS_PINNED, TOPIC_IS_LOCKED
-from forums.db.users import User, IS_USER_RESTRICTED, IS_USER_MODERATOR, UserRepository, get_user_repo
-from forums.ioutil import escape_filename, create_next_file, is_allowed_type
+from forums.db.users import User, IS_USER_RESTRICTED, IS_USER_MODERATOR, UserRepository
+from forums.ioutil import escape_filename, is_allowed_type, stage_uploads, place_blobs, discard_uploads, blob_path, \
+    legacy_attachment_path, StoredUpload
+from forums.job_handlers import REMOVE_BLOB, REMOVE_LEGACY_FILE, RENDER_THUMBNAIL
+from forums.jobs import JobQueue
 from forums.models import UserAPI
-from forums.routes.auth import current_user, csrf_verify, generate_csrf_token
+from forums.routes.auth import current_user, csrf_verify, generate_csrf_token, limit_by_user
+from forums.templates import StreamingTemplateResponse
+from forums.thumbnails import Thumbnailer
 import regex  # use instead of re for more advanced regex support
 import logging
-from aiofiles.os import unlink as async_unlink
 
 from forums.utils import get_topic_repo, get_post_repo, get_category_repo, get_templates, get_topic_attach_repo, \
-    get_post_attach_repo
+    get_post_attach_repo, get_user_repo, get_caches, get_streaming_env
 
 topic_router = APIRouter()
 
@@ -45,9 +55,10 @@ async def create_topic(req: Request,
                        category: Annotated[int, Form()], create_flags: Annotated[int, Form()],
                        files: Annotated[List[UploadFile], File()],
                        csrf_token: Annotated[str, Form()],
-                       user: User = Depends(current_user),
+                       user: User = Depends(limit_by_user('post')),
                        topic_repo: TopicRepository = Depends(get_topic_repo),
-                       topic_attach_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo)):
+                       cat_repo: CategoryRepository = Depends(get_category_repo),
+                       caches: Caches = Depends(get_caches)):
     eparams = {'child_of': str(category)}
 
     if user.flags & IS_USER_RESTRICTED == IS_USER_RESTRICTED:
@@ -96,34 +107,72 @@ async def create_topic(req: Request,
     topic = Topic(topic_id=None, parent_cat=category, title=title.strip(),
                   content=content.strip(), flags=create_flags, author_id=user.user_id)
 
+    # store the attachments first, so that a bad one rejects the topic instead of leaving it without them
     try:
-        topic_id = await topic_repo.put_topic(topic)
-    except IntegrityError:
+        staged = await stage_attachments(req, files)
+    except Exception as e:
+        logging.error('file upload error', exc_info=e)
         return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER,
                                 url=f'/new_topic?%s' % urlencode({
-                                    'error': f'target category is not valid',
+                                    'error': f'attachment has a bad file name or bad file type',
                                     **eparams
                                 }))
 
-    # add the attachments
+    # the topic and its attachments are inserted in one transaction
     try:
-        for uploadf in files:
-            if uploadf.filename != "":
-                attach = await create_attachment(req, topic_id, uploadf.filename, uploadf, user.user_id)
-                await topic_attach_repo.put_attachment(attach)
-    except Exception as e:
-        logging.error('file upload error', exc_info=e)
+        await topic_repo.put_topic(topic, [(TopicAttachment(thread=0, filename=name, author=user.user_id), _blob(upload))
+                                           for name, upload in staged], place=_placer(req, staged))
+    except IntegrityError:
         return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER,
                                 url=f'/new_topic?%s' % urlencode({
-                                    'error': f'attachment has a bad file name or bad file type',
+                                    'error': f'target category is not valid',
                                     **eparams
                                 }))
+    finally:
+        await discard_staged(staged)
+
+    _log_uploads(user.user_id, topic.topic_id, None, staged)
+    await _schedule_thumbnails(req, staged)
+    caches.put_title(topic)
+    caches.invalidate(*await _topic_count_tags(cat_repo, topic.parent_cat))
 
     # Send the user to the topic they just created
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/topic/{topic.topic_id}',
                             headers={'Cache-Control': 'no-store'})
 
 
+async def cached_reply_listing(caches: Caches, posts_repo: PostRepository, post_attach_repo: PostAttachmentRepository,
+                               tpl: Jinja2Templates, topic: Topic, page: int, is_moderator: bool) -> ReplyListing:
+    """
+    Returns the replies shown on a page of a topic, rendering them if they aren't cached. The reply list is the same
+    for everyone with the same role, so it is shared between users.
+    """
+    async def render() -> ReplyListing:
+        # load posts
+        (count, posts) = await posts_repo.get_posts_of_topic(topic.topic_id, limit=REPLIES_PER_PAGE,
+                                                             skip=(page - 1) * REPLIES_PER_PAGE,
+                                                             include_hidden=is_moderator)
+
+        # load post attachments
+        post_attachments = {}
+        for atchs in await asyncio.gather(*[post_attach_repo.get_attachments_of_post(post.post_id) for post in posts]):
+            if len(atchs) > 0:
+                post_attachments[atchs[0].post] = atchs
+
+        html = tpl.get_template('_topic_replies.html').render({
+            'topic': topic,
+            'posts': posts,
+            'p_attachments': post_attachments,
+            'current_page': page,
+            'is_moderator': is_moderator,
+            'csrf_token': CSRF_PLACEHOLDER,
+        })
+        return ReplyListing.from_html(count, html)
+
+    return await caches.fragments.get_or_render(('topic', topic.topic_id, page, is_moderator),
+                                                (topic_tag(topic.topic_id),), render)
+
+
 @topic_router.get('/{topic_id}')
 async def get_topic(req: Request,
                     topic_id: int,
@@ -136,10 +185,17 @@ async def get_topic(req: Request,
                     tpl: Jinja2Templates = Depends(get_templates),
                     csrf_token: str = Depends(generate_csrf_token),
                     topic_attach_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo),
-                    post_attach_repo: PostAttachmentRepository = Depends(get_post_attach_repo)):
+                    post_attach_repo: PostAttachmentRepository = Depends(get_post_attach_repo),
+                    caches: Caches = Depends(get_caches),
+                    stream_env: Optional[Environment] = Depends(get_streaming_env)):
     if page < 1:
         raise HTTPException(status_code=400, detail='page must be greater than 0')
 
+    # answer revalidations from the version stamps alone, before loading anything
+    etag = page_etag(req, user, caches.versions.stamp(topic_tag(topic_id), CATEGORY_TREE_TAG))
+    if etag_matches(req, etag):
+        return not_modified(etag)
+
     # load the topic
     if topic_id < 0:
         raise HTTPException(status_code=403, detail='Invalid topic id')
@@ -149,8 +205,6 @@ async def get_topic(req: Request,
     if not topic:
         raise HTTPException(status_code=404, detail='No such topic')
 
-    offset = (page - 1) * REPLIES_PER_PAGE
-
     # load user obj for author
     author = await user_repo.get_user_by_id(topic.author_id)
     if not author:
@@ -164,49 +218,62 @@ async def get_topic(req: Request,
     if not category:
         raise HTTPException(status_code=404, detail='Category referenced by topic does not exist')
 
-    # load posts
-    (count, posts) = await posts_repo.get_posts_of_topic(topic_id, limit=REPLIES_PER_PAGE, skip=offset, include_hidden=user.is_moderator())
+    is_moderator = user.is_moderator()
 
-    # load post attachments
-    post_attachments = {}
-    for atchs in await asyncio.gather(*[post_attach_repo.get_attachments_of_post(post.post_id) for post in posts]):
-        if len(atchs) > 0:
-            post_attachments[atchs[0].post] = atchs
+    # the reply list is the slowest part of the page, so start loading it now; the queries below and sending the top
+    # of the page overlap with it.
+    replies_task = asyncio.create_task(
+        cached_reply_listing(caches, posts_repo, post_attach_repo, tpl, topic, page, is_moderator))
 
-    # generate the breadcrumb
-    bread = [(category.id, category.cat_name)]
-    j = category
-    while (j := j.parent_cat) is not None:
-        j = await cat_repo.get_category_by_id(j)
-        bread.append((j.id, j.cat_name))
-    bread.reverse()
+    async def load_replies() -> dict:
+        replies = await replies_task
+        return {
+            'html': Markup(replies.html(csrf_token)),
+            'total_results': replies.total_results,
+            'total_pages': (replies.total_results // REPLIES_PER_PAGE) + 1,
+        }
 
-    # load topic attachments
-    attachments = await topic_attach_repo.get_attachments_of_topic(topic.topic_id)
+    try:
+        # generate the breadcrumb
+        bread = [(category.id, category.cat_name)]
+        j = category
+        while (j := j.parent_cat) is not None:
+            j = await cat_repo.get_category_by_id(j)
+            bread.append((j.id, j.cat_name))
+        bread.reverse()
+
+        # load topic attachments
+        attachments = await topic_attach_repo.get_attachments_of_topic(topic.topic_id)
+    except BaseException:
+        replies_task.cancel()
+        raise
 
     ctx = {
         'user': user,
         'author': author,
         'topic': topic,
         'category': category,
-        'posts': posts,
+        'load_replies': load_replies,
         'current_page': page,
-        'total_pages': (count // REPLIES_PER_PAGE) + 1,
-        'total_results': count,
         'base_url': f'/topic/{topic.topic_id}/',
         'csrf_token': csrf_token,
         'bread': bread,
         't_attachments': attachments,
-        'p_attachments': post_attachments
     }
 
-    return tpl.TemplateResponse(request=req, name='topic.html', context=ctx)
+    if stream_env is not None:
+        return StreamingTemplateResponse(stream_env.get_template('topic.html'), ctx, headers=page_headers(etag))
 
+    replies_page = await load_replies()
+    return tpl.TemplateResponse(request=req, name='topic.html', context={**ctx, 'load_replies': lambda: replies_page},
+                                headers=page_headers(etag))
 
-@topic_router.get('/{topic_id}/attachments/{attachment_id}')
-async def download_attachment_of_topic(req: Request, topic_id: int, attachment_id: int, user: User = Depends(current_user),
-                              topic_attach_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo),
-                              topic_repo: TopicRepository = Depends(get_topic_repo)):
+
+async def _visible_topic_attachment(user: User, topic_id: int, attachment_id: int, topic_repo: TopicRepository,
+                                   topic_attach_repo: TopicAttachmentRepository) -> TopicAttachment:
+    """
+    Loads an attachment of a topic, raising 404 unless it exists and the user may see the topic.
+    """
     topic = await topic_repo.get_topic_by_id(topic_id)
     if topic is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such topic.')
@@ -216,13 +283,15 @@ async def download_attachment_of_topic(req: Request, topic_id: int, attachment_i
     topic_attachment = await topic_attach_repo.get_attachment(attachment_id)
     if topic_attachment is None or topic_attachment.thread != topic_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such attachment.')
-
-    fpath = os.path.join(req.app.state.cfg.storage.path, 'attachments', str(topic.topic_id), topic_attachment.filename)
-    return FileResponse(path=fpath, filename=topic_attachment.filename, content_disposition_type='attachment')
+    return topic_attachment
 
 
-@topic_router.get('/{topic_id}/{post_id}/attachments/{attachment_id}')
-async def download_attachment_of_post(req: Request, topic_id: int, post_id: int, attachment_id: int, user: User = Depends(current_user), post_attach_repo: PostAttachmentRepository = Depends(get_post_attach_repo), post_repo: PostRepository = Depends(get_post_repo)):
+async def _visible_post_attachment(user: User, topic_id: int, post_id: int, attachment_id: int,
+                                   post_repo: PostRepository,
+                                   post_attach_repo: PostAttachmentRepository) -> PostAttachment:
+    """
+    Loads an attachment of a post, raising 404 unless it exists and the user may see the post.
+    """
     post = await post_repo.get_post_by_id(post_id, include_hidden=user.is_moderator())
     if post is None or post.topic_id != topic_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such post.')
@@ -230,9 +299,61 @@ async def download_attachment_of_post(req: Request, topic_id: int, post_id: int,
     post_attachment = await post_attach_repo.get_attachment(attachment_id)
     if post_attachment is None or post_attachment.post != post_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such attachment.')
+    return post_attachment
+
+
+async def _send_thumbnail(req: Request, attachment: TopicAttachment | PostAttachment) -> Response:
+    """
+    Responds with the thumbnail of an image attachment, rendering it first if that hasn't happened yet.
+    """
+    thumbnails: Optional[Thumbnailer] = req.app.state.thumbnails
+    if thumbnails is None or attachment.sha256 is None or \
+            attachment.mime_type not in thumbnails.source_types:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such thumbnail.')
+
+    path = await thumbnails.get(attachment.sha256)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='There is no such thumbnail.')
+    return await send_thumbnail(req, path, thumbnails.media_type, os.path.basename(path))
+
+
+@topic_router.get('/{topic_id}/attachments/{attachment_id}')
+async def download_attachment_of_topic(req: Request, topic_id: int, attachment_id: int, user: User = Depends(current_user),
+                              topic_attach_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo),
+                              topic_repo: TopicRepository = Depends(get_topic_repo)):
+    topic_attachment = await _visible_topic_attachment(user, topic_id, attachment_id, topic_repo, topic_attach_repo)
+
+    fpath = _attachment_file(req, topic_attachment, topic_id)
+    return await send_attachment(req, fpath, topic_attachment.filename,
+                                 topic_attachment.sha256 or f't{attachment_id}')
+
+
+# must come before the downloads of post attachments, whose path it would otherwise match
+@topic_router.get('/{topic_id}/attachments/{attachment_id}/thumbnail')
+async def thumbnail_of_topic_attachment(req: Request, topic_id: int, attachment_id: int,
+                                        user: User = Depends(current_user),
+                                        topic_attach_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo),
+                                        topic_repo: TopicRepository = Depends(get_topic_repo)):
+    return await _send_thumbnail(req, await _visible_topic_attachment(user, topic_id, attachment_id, topic_repo,
+                                                                      topic_attach_repo))
+
+
+@topic_router.get('/{topic_id}/{post_id}/attachments/{attachment_id}')
+async def download_attachment_of_post(req: Request, topic_id: int, post_id: int, attachment_id: int, user: User = Depends(current_user), post_attach_repo: PostAttachmentRepository = Depends(get_post_attach_repo), post_repo: PostRepository = Depends(get_post_repo)):
+    post_attachment = await _visible_post_attachment(user, topic_id, post_id, attachment_id, post_repo,
+                                                     post_attach_repo)
+
+    fpath = _attachment_file(req, post_attachment, topic_id, post_id)
+    return await send_attachment(req, fpath, post_attachment.filename, post_attachment.sha256 or f'p{attachment_id}')
 
-    fpath = os.path.join(req.app.state.cfg.storage.path, 'attachments', str(post.topic_id), '.posts', str(post.post_id), post_attachment.filename)
-    return FileResponse(path=fpath, filename=post_attachment.filename, content_disposition_type='attachment')
+
+@topic_router.get('/{topic_id}/{post_id}/attachments/{attachment_id}/thumbnail')
+async def thumbnail_of_post_attachment(req: Request, topic_id: int, post_id: int, attachment_id: int,
+                                       user: User = Depends(current_user),
+                                       post_attach_repo: PostAttachmentRepository = Depends(get_post_attach_repo),
+                                       post_repo: PostRepository = Depends(get_post_repo)):
+    return await _send_thumbnail(req, await _visible_post_attachment(user, topic_id, post_id, attachment_id,
+                                                                     post_repo, post_attach_repo))
 
 
 class TopicPatchSpec(BaseModel):
@@ -264,7 +385,9 @@ async def update_topic(req: Request, topic_id: int, title: Annotated[str, Form()
                        hide: Annotated[bool, Form()] = None, pin: Annotated[bool, Form()] = None,
                        lock: Annotated[bool, Form()] = None, parent: Annotated[int, Form()] = None,
                        topic_repo: TopicRepository = Depends(get_topic_repo),
-                       user: User = Depends(current_user)):
+                       cat_repo: CategoryRepository = Depends(get_category_repo),
+                       user: User = Depends(current_user),
+                       caches: Caches = Depends(get_caches)):
     csrf_verify(req, csrf_token)
 
     # load topic
@@ -285,6 +408,8 @@ async def update_topic(req: Request, topic_id: int, title: Annotated[str, Form()
     if not (0 < len(title) <= MAX_TOPIC_TITLE_LEN) and __TOPIC_ALLOW_MOST_CHARS.match(title):
         raise HTTPException(status_code=400, detail='Invalid title.')
 
+    old_parent_cat = topic.parent_cat
+
     # Apply visibility change
     if user.is_moderator():
         if hide:
@@ -311,16 +436,20 @@ async def update_topic(req: Request, topic_id: int, title: Annotated[str, Form()
         raise HTTPException(status_code=400,
                             detail='Cannot set category of topic because the target category is not valid.')
 
+    caches.put_title(topic)
+    caches.invalidate(topic_tag(topic_id), *await _topic_count_tags(cat_repo, old_parent_cat),
+                      *await _topic_count_tags(cat_repo, topic.parent_cat))
+
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/topic/{topic_id}')
 
 
 @topic_router.post('/{topic_id}/reply')
 async def reply_to_topic(req: Request, topic_id: int, content: Annotated[str, Form()],
                          files: Annotated[List[UploadFile], File()],
-                         csrf_token: Annotated[str, Form()], user: User = Depends(current_user),
+                         csrf_token: Annotated[str, Form()], user: User = Depends(limit_by_user('post')),
                          topic_repo: TopicRepository = Depends(get_topic_repo),
                          post_repo: PostRepository = Depends(get_post_repo),
-                         post_attach_repo: PostAttachmentRepository = Depends(get_post_attach_repo)):
+                         caches: Caches = Depends(get_caches)):
     if user.is_restricted():
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You do not have permission to do this.')
 
@@ -341,7 +470,15 @@ async def reply_to_topic(req: Request, topic_id: int, content: Annotated[str, Fo
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail='Post content is too long or contains illegal characters.')
 
-    # commit
+    # store the attachments first, so that a bad one rejects the reply instead of leaving it without them
+    try:
+        staged = await stage_attachments(req, files)
+    except Exception as e:
+        logging.error('file upload error', exc_info=e)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='bad attachment.')
+
+    # commit the post and its attachments in one transaction
     post = Post(post_id=None,
                 topic_id=topic_id,
                 author_id=user.user_id,
@@ -349,19 +486,15 @@ async def reply_to_topic(req: Request, topic_id: int, content: Annotated[str, Fo
                 created_at=None,
                 flags=0)
 
-    await post_repo.put_post(post)
-
-    # add the attachments
     try:
-        for uploadf in files:
-            if uploadf.filename != "":
-                attach = await create_attachment(req, topic_id, uploadf.filename, uploadf, user.user_id,
-                                                 post=post.post_id)
-                await post_attach_repo.put_attachment(attach)
-    except Exception as e:
-        logging.error('file upload error', exc_info=e)
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail='bad attachment.')
+        await post_repo.put_post(post, [(PostAttachment(post=0, filename=name, author=user.user_id, createdAt=None),
+                                         _blob(upload)) for name, upload in staged], place=_placer(req, staged))
+    finally:
+        await discard_staged(staged)
+
+    _log_uploads(user.user_id, topic_id, post.post_id, staged)
+    await _schedule_thumbnails(req, staged)
+    caches.invalidate(topic_tag(topic_id), category_tag(topic.parent_cat))
 
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/topic/{topic_id}/')
 
@@ -448,7 +581,8 @@ async def edit_post(req: Request, topic_id: int, post_id: int,
                     csrf_token: Annotated[str, Form()], hide: Annotated[bool, Form()] = None,
                     user: User = Depends(current_user),
                     topic_repo: TopicRepository = Depends(get_topic_repo),
-                    post_repo: PostRepository = Depends(get_post_repo)):
+                    post_repo: PostRepository = Depends(get_post_repo),
+                    caches: Caches = Depends(get_caches)):
     csrf_verify(req, csrf_token)
 
     if user.is_restricted() and not user.is_moderator():
@@ -478,6 +612,8 @@ async def edit_post(req: Request, topic_id: int, post_id: int,
 
     await post_repo.put_post(post)
 
+    caches.invalidate(topic_tag(topic_id), category_tag(topic.parent_cat))
+
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/topic/{topic_id}?page={prev_page}')
 
 
@@ -485,7 +621,8 @@ async def edit_post(req: Request, topic_id: int, post_id: int,
 async def detach_file(req: Request, topic_id: Annotated[int, Form()], csrf_token: Annotated[str, Form()], attachment_id: Annotated[int, Form()],
                       post_id: Annotated[Optional[int], Form()] = None, user: User = Depends(current_user),
                       topic_repo: TopicRepository = Depends(get_topic_repo), post_repo: PostRepository = Depends(get_post_repo),
-                      topic_atch_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo), post_atch_repo: PostAttachmentRepository = Depends(get_post_attach_repo)):
+                      topic_atch_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo), post_atch_repo: PostAttachmentRepository = Depends(get_post_attach_repo),
+                      caches: Caches = Depends(get_caches)):
     csrf_verify(req, csrf_token)
 
     # load the item
@@ -504,6 +641,12 @@ async def detach_file(req: Request, topic_id: Annotated[int, Form()], csrf_token
     if not (ent.author_id == user.user_id or user.is_moderator()):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You do not have permission to do this.')
 
+    jobs: JobQueue = req.app.state.jobs
+
+    async def remove(sha256: str):
+        # the file is deleted by a job, after the attachment is gone
+        await jobs.enqueue(REMOVE_BLOB, {'sha256': sha256})
+
     # load the attachment spec
     if post_id is not None:
         atch = await post_atch_repo.get_attachment(attachment_id)
@@ -511,21 +654,21 @@ async def detach_file(req: Request, topic_id: Annotated[int, Form()], csrf_token
         if atch.post != post_id:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Attachment does not belong to the specified post.')
         # delete the attachment from the listing
-        await post_atch_repo.delete_attachment(attachment_id)
+        await post_atch_repo.delete_attachment(attachment_id, remove)
     else:
         atch = await topic_atch_repo.get_attachment(attachment_id)
         # verify atch is of topic
         if atch.thread != topic_id:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Attachment does not belong to the specified topic.')
         # delete the attachment from the listing
-        await topic_atch_repo.delete_attachment(attachment_id)
+        await topic_atch_repo.delete_attachment(attachment_id, remove)
 
-    # delete the attachment from the filesystem
-    path = os.path.join(req.app.state.cfg.storage.path, 'attachments', str(topic_id))
-    if post_id is not None:
-        path = os.path.join(path, '.posts', str(post_id))
-    path = os.path.join(path, atch.filename)
-    await async_unlink(path)
+    caches.invalidate(topic_tag(topic_id))
+
+    # delete the file of an attachment stored under its filename; blobs are removed once nothing references them
+    if atch.sha256 is None:
+        file_path = _attachment_file(req, atch, topic_id, post_id)
+        await jobs.enqueue(REMOVE_LEGACY_FILE, {'path': os.path.relpath(file_path, req.app.state.cfg.storage.path)})
 
     return RedirectResponse(status_code=status.HTTP_303_SEE_OTHER, url=f'/topic/{topic_id}')
 
@@ -562,10 +705,11 @@ async def attach_file_page(req: Request, topic_id: int, post_id: Optional[int] =
 @topic_router.post('/{topic_id}/add_attachment')
 async def attach_file(req: Request, topic_id: int, csrf_token: Annotated[str, Form()],
                       files: Annotated[List[UploadFile], File()], prev_page: Annotated[int, Form()],
-                      post_id: Annotated[int, Form()] = None, user: User = Depends(current_user),
+                      post_id: Annotated[int, Form()] = None, user: User = Depends(limit_by_user('post')),
                       topic_repo: TopicRepository = Depends(get_topic_repo), post_repo: PostRepository = Depends(get_post_repo),
                       topic_atch_repo: TopicAttachmentRepository = Depends(get_topic_attach_repo),
-                      post_atch_repo: PostAttachmentRepository = Depends(get_post_attach_repo)):
+                      post_atch_repo: PostAttachmentRepository = Depends(get_post_attach_repo),
+                      caches: Caches = Depends(get_caches)):
     if user.is_restricted() and not user.is_moderator():
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You do not have permission to do this.')
 
@@ -586,54 +730,113 @@ async def attach_file(req: Request, topic_id: int, csrf_token: Annotated[str, Fo
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You do not have permission to do this.')
 
     # add the attachments
+    staged = []
     try:
-        for uploadf in files:
-            if uploadf.filename != "":
-                attach = await create_attachment(req, topic_id, uploadf.filename, uploadf, user.user_id, post=post_id)
-                if post_id is not None:
-                    await post_atch_repo.put_attachment(attach)
-                else:
-                    await topic_atch_repo.put_attachment(attach)
+        staged = await stage_attachments(req, files)
+        if post_id is not None:
+            await post_atch_repo.put_attachments(
+                [(PostAttachment(post=post_id, filename=name, author=user.user_id, createdAt=None), _blob(upload))
+                 for name, upload in staged], place=_placer(req, staged))
+        else:
+            await topic_atch_repo.put_attachments(
+                [(TopicAttachment(thread=topic_id, filename=name, author=user.user_id), _blob(upload))
+                 for name, upload in staged], place=_placer(req, staged))
     except Exception as e:
         logging.error('file upload error', exc_info=e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='Error uploading file.')
+    finally:
+        await discard_staged(staged)
+
+    _log_uploads(user.user_id, topic_id, post_id, staged)
+    await _schedule_thumbnails(req, staged)
+    caches.invalidate(topic_tag(topic_id))
 
     return RedirectResponse(url=f'/topic/{topic_id}?page={prev_page}', status_code=status.HTTP_303_SEE_OTHER)
 
 
-async def create_attachment(req: Request, topic_id: int, filename: str, data: UploadFile, author: int,
-                                  post: Optional[int] = None):
+async def _topic_count_tags(cat_repo: CategoryRepository, cat_id: int) -> Tuple[Hashable, ...]:
+    """
+    Tags to invalidate when the set of topics in a category changes: the category itself and its parent, whose page
+    shows how many topics each subcategory has.
+    """
+    cat = await cat_repo.get_category_by_id(cat_id)
+    if cat is None or cat.parent_cat is None:
+        return category_tag(cat_id),
+    return category_tag(cat_id), category_tag(cat.parent_cat)
+
+
+def _attachment_file(req: Request, attachment: TopicAttachment | PostAttachment, topic_id: int,
+                     post_id: Optional[int] = None) -> str:
     """
+    The path of the file holding the contents of an attachment.
+    """
+    root = req.app.state.cfg.storage.path
+    if attachment.sha256 is not None:
+        return blob_path(root, attachment.sha256)
+    return legacy_attachment_path(root, topic_id, post_id, attachment.filename)
+
+
+async def stage_attachments(req: Request, files: List[UploadFile]) -> List[Tuple[str, StoredUpload]]:
+    """
+    Checks the names and types of uploaded files, then copies them into the blob store's staging directory a few at
+    a time. Returns the escaped name and staged upload of each file, skipping empty file inputs. The caller must
+    either put the uploads in place or call discard_staged.
+
     May raise the following exceptions:
       ValueError - Bad filename or file type
-      Exception - MAX_OPEN_ATTEMPTS exceeded
-      OSError - Problem opening the file for writing
+      OSError - Problem writing a file
     """
     sconf = req.app.state.cfg.storage
+    files = [f for f in files if f.filename != ""]
 
-    # check that the file type is allowed
-    if not is_allowed_type(sconf.allow_attach_types, data):
-        raise ValueError('content type not allowed')
-    await data.seek(0)
+    names = []
+    for f in files:
+        # check that the file type is allowed
+        if not is_allowed_type(sconf.allow_attach_types, f):
+            raise ValueError('content type not allowed')
+        names.append(escape_filename(f.filename))
 
-    fname = escape_filename(filename)
+    return list(zip(names, await stage_uploads(sconf.path, files, sconf.upload_concurrency)))
 
-    (fd, fname, fpath) = await create_next_file(sconf.path, topic_id, fname, post=post)
 
-    try:
-        while (b := await data.read(512)) != b'':
-            await fd.write(b)
-        await fd.close()
-    except Exception as e:
-        await fd.close()
-        await async_unlink(fpath)
-        raise e
+async def discard_staged(staged: List[Tuple[str, StoredUpload]]):
+    """
+    Deletes what is left of staged uploads, which is nothing once they have been put in place.
+    """
+    await discard_uploads([upload for _, upload in staged])
 
-    logging.info("file upload: author = %s, topic = %s, fpath = %s, size = %s, post = %s" % (
-        author, topic_id, fpath, data.size, post
-    ))
 
-    if post is None:
-        return TopicAttachment(id=None, thread=topic_id, filename=fname, author=author, createdAt=None)
-    else:
-        return PostAttachment(id=None, post=post, filename=fname, author=author, createdAt=None)
+def _blob(upload: StoredUpload) -> Blob:
+    return Blob(sha256=upload.sha256, size=upload.size, mime_type=upload.mime_type)
+
+
+def _placer(req: Request, staged: List[Tuple[str, StoredUpload]]) -> Callable[[], Awaitable[None]]:
+    """
+    The callback the repositories use to put staged uploads in place in the blob store.
+    """
+    path = req.app.state.cfg.storage.path
+    return lambda: place_blobs(path, [upload for _, upload in staged])
+
+
+async def _schedule_thumbnails(req: Request, staged: List[Tuple[str, StoredUpload]]):
+    """
+    Queues the rendering of the thumbnails of uploaded images, so that they are ready by the time the page showing
+    them is.
+    """
+    thumbnails: Optional[Thumbnailer] = req.app.state.thumbnails
+    if thumbnails is None:
+        return
+    jobs: JobQueue = req.app.state.jobs
+    for sha256 in {upload.sha256 for _, upload in staged if upload.mime_type in thumbnails.source_types}:
+        try:
+            await jobs.enqueue(RENDER_THUMBNAIL, {'sha256': sha256})
+        except Exception as e:
+            # rendered on the first request for it instead
+            logging.error('failed to queue the thumbnail of blob %s', sha256, exc_info=e)
+
+
+def _log_uploads(author: int, topic_id: int, post: Optional[int], staged: List[Tuple[str, StoredUpload]]):
+    for name, upload in staged:
+        logging.info("file upload: author = %s, topic = %s, name = %s, blob = %s, size = %s, type = %s, post = %s" % (
+            author, topic_id, name, upload.sha256, upload.size, upload.mime_type, post
+        ))
@@ -0,0 +1,168 @@
+"""
+Topic title suggestions for the search box and the new topic form, answered from memory.
+
+Each worker keeps a sorted list of keys made from the normalized titles of all topics: one for the start of the title
+and one for the start of each of its next few words, so that "exam" suggests "Final exam schedule" too. A suggestion
+is a binary search for the typed prefix followed by a walk over the keys that start with it, so it takes microseconds
+and never touches the database. Keys are cut to a fixed length to keep the index small; longer prefixes are checked
+against the title itself.
+
+The worker that creates or changes a topic updates the index right away, see Caches.put_title. Other workers learn
+about the change through the bus (see forums.bus) and reload the topic in the background; other writes, such as
+replies, don't concern the index.
+"""
+import asyncio
+import logging
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from forums.db.topics import Topic, TopicRepository, TOPIC_IS_HIDDEN
+
+# Topics loaded per query when the index is built
+_BATCH_SIZE = 10000
+# The number of words of a title that suggestions can start at
+_MAX_WORDS = 4
+# The length keys are cut to
+_KEY_LENGTH = 24
+_NON_WORD = re.compile(r'\W+')
+
+
+def normalize_title(title: str) -> str:
+    """
+    Folds case and compatibility characters, and turns every run of punctuation and whitespace into a single space.
+    """
+    return _NON_WORD.sub(' ', unicodedata.normalize('NFKC', title).casefold()).strip()
+
+
+def _keys(topic_id: int, title: str) -> List[str]:
+    norm = normalize_title(title)
+    starts = [0] + [m.end() for m in re.finditer(' ', norm)][:_MAX_WORDS - 1]
+    # NUL sorts before every character, so a key comes right after the keys it is a prefix of
+    return sorted({f'{norm[start:start + _KEY_LENGTH]}\x00{topic_id}' for start in starts})
+
+
+class TitleIndex:
+    def __init__(self, load: Callable[[int], Awaitable[Optional[Topic]]]):
+        """
+        :param load: loads a topic by id, hidden or not, when another worker reports a write to it
+        """
+        self._load = load
+        # sorted keys, each a cut normalized title (or title suffix) and a topic id
+        self._keys: List[str] = []
+        self._titles: Dict[int, str] = {}
+        self._hidden: Set[int] = set()
+        # topics written by other workers, to be reloaded
+        self._stale: Set[int] = set()
+        self._refresh: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    def load_all(self, topics: Sequence[Tuple[int, str, int]]):
+        """
+        Adds the (id, title, flags) of many topics at once, sorting only once.
+        """
+        for topic_id, title, flags in topics:
+            if topic_id in self._titles:
+                # put() while loading
+                continue
+            self._titles[topic_id] = title
+            if flags & TOPIC_IS_HIDDEN:
+                self._hidden.add(topic_id)
+            self._keys.extend(_keys(topic_id, title))
+        self._keys.sort()
+
+    def put(self, topic: Topic):
+        """
+        Adds a topic or updates its title and visibility.
+        """
+        if (old := self._titles.get(topic.topic_id)) != topic.title:
+            if old is not None:
+                self._remove_keys(topic.topic_id, old)
+            for key in _keys(topic.topic_id, topic.title):
+                insort(self._keys, key)
+            self._titles[topic.topic_id] = topic.title
+        if topic.is_hidden():
+            self._hidden.add(topic.topic_id)
+        else:
+            self._hidden.discard(topic.topic_id)
+
+    def remove(self, topic_id: int):
+        if (title := self._titles.pop(topic_id, None)) is not None:
+            self._remove_keys(topic_id, title)
+        self._hidden.discard(topic_id)
+
+    def _remove_keys(self, topic_id: int, title: str):
+        for key in _keys(topic_id, title):
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def suggest(self, prefix: str, limit: int, include_hidden=False) -> List[Tuple[int, str]]:
+        """
+        Returns the (id, title) of up to `limit` topics whose title, or one of its first words, starts with `prefix`,
+        in alphabetical order of the title from the matching word on.
+        """
+        norm = normalize_title(prefix)
+        if not norm:
+            return []
+
+        key_prefix = norm[:_KEY_LENGTH]
+        found: List[Tuple[int, str]] = []
+        seen: Set[int] = set()
+        for i in range(bisect_left(self._keys, key_prefix), len(self._keys)):
+            key = self._keys[i]
+            if not key.startswith(key_prefix):
+                break
+            topic_id = int(key[key.index('\x00') + 1:])
+            if topic_id in seen or (not include_hidden and topic_id in self._hidden):
+                continue
+            title = self._titles[topic_id]
+            if len(norm) > _KEY_LENGTH and not self._matches(norm, title):
+                continue
+            seen.add(topic_id)
+            found.append((topic_id, title))
+            if len(found) == limit:
+                break
+        return found
+
+    @staticmethod
+    def _matches(norm: str, title: str) -> bool:
+        title = normalize_title(title)
+        return title.startswith(norm) or any(title.startswith(norm, m.end())
+                                             for m in list(re.finditer(' ', title))[:_MAX_WORDS - 1])
+
+    def stale(self, topic_id: int):
+        """
+        Reloads a topic written by another worker, in the background.
+        """
+        self._stale.add(topic_id)
+        if self._refresh is None:
+            self._refresh = asyncio.create_task(self._reload())
+
+    async def _reload(self):
+        try:
+            while self._stale:
+                topic_id = self._stale.pop()
+                try:
+                    if (topic := await self._load(topic_id)) is None:
+                        self.remove(topic_id)
+                    else:
+                        self.put(topic)
+                except Exception as e:
+                    logging.error('failed to reload the title of topic %d', topic_id, exc_info=e)
+        finally:
+            self._refresh = None
+
+
+async def build_title_index(index: TitleIndex, topic_repo: TopicRepository) -> int:
+    """
+    Adds every topic to `index`, and returns how many topics it holds.
+    """
+    after = 0
+    while topics := await topic_repo.get_topic_titles(after, _BATCH_SIZE):
+        index.load_all(topics)
+        after = topics[-1][0]
+    return len(index)
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import AbstractSet, AsyncIterator, Mapping, Optional, Tuple
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, Template
+from starlette.responses import StreamingResponse
+from starlette.templating import Jinja2Templates
+
+from forums.assets import AssetManifest
+from forums.config import TemplateConfig
+
+
+def _create_env(conf: TemplateConfig, assets: Optional[AssetManifest], thumbnail_types: AbstractSet[str],
+                enable_async: bool) -> Environment:
+    bytecode_cache = None
+    if conf.production and conf.bytecode_cache_dir:
+        os.makedirs(conf.bytecode_cache_dir, exist_ok=True)
+        # templates compiled for async rendering are different code, so they must not share cache entries
+        pattern = '__jinja2_async_%s.cache' if enable_async else '__jinja2_%s.cache'
+        bytecode_cache = FileSystemBytecodeCache(conf.bytecode_cache_dir, pattern=pattern)
+
+    env = Environment(loader=FileSystemLoader(conf.directory),
+                      # Jinja2Templates' default
+                      autoescape=True,
+                      auto_reload=not conf.production,
+                      bytecode_cache=bytecode_cache,
+                      enable_async=enable_async)
+    env.globals['asset_url'] = (assets or AssetManifest()).url
+    env.globals['has_thumbnail'] = lambda attachment: attachment.mime_type in thumbnail_types
+    return env
+
+
+def create_templates(conf: TemplateConfig, assets: Optional[AssetManifest] = None,
+                     thumbnail_types: AbstractSet[str] = frozenset()) -> Jinja2Templates:
+    """
+    Creates the Jinja2Templates used to render every page.
+
+    In production mode, templates are never checked for changes on disk once loaded, and compiled templates are
+    stored in the bytecode cache directory (if one is configured) so that other workers and later restarts can
+    skip compilation.
+
+    Templates resolve static asset URLs with asset_url(name), using `assets` (or unhashed URLs if it is not given).
+    has_thumbnail(attachment) tells them whether an attachment is one of `thumbnail_types`, i.e. shown as a thumbnail.
+    """
+    return Jinja2Templates(env=_create_env(conf, assets, thumbnail_types, enable_async=False))
+
+
+def create_streaming_env(conf: TemplateConfig, assets: Optional[AssetManifest] = None,
+                         thumbnail_types: AbstractSet[str] = frozenset()) -> Environment:
+    """
+    Creates the environment used by StreamingTemplateResponse. It is configured like create_templates(), but renders
+    asynchronously so that templates can await data that is still loading.
+    """
+    return _create_env(conf, assets, thumbnail_types, enable_async=True)
+
+
+def precompile(env: Environment) -> Tuple[int, float]:
+    """
+    Loads (and so compiles) every template, so that syntax errors are raised at startup rather than on the first
+    request for a broken page, and that no request pays for compilation.
+
+    Returns the number of templates loaded and how long it took in seconds.
+
+    :raises: jinja2.TemplateSyntaxError if any template is invalid
+    """
+    start = time.perf_counter()
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+
+    return len(names), time.perf_counter() - start
+
+
+async def _render_chunks(template: Template, context: Mapping) -> AsyncIterator[bytes]:
+    """
+    Renders the template in a separate task and yields its output whenever that task has to wait for something,
+    e.g. a query the template awaits. Everything rendered up to that point reaches the client while it waits.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async for chunk in template.generate_async(context):
+                queue.put_nowait(chunk)
+        finally:
+            queue.put_nowait(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            parts = [await queue.get()]
+            while not queue.empty():
+                parts.append(queue.get_nowait())
+
+            finished = parts[-1] is done
+            if finished:
+                parts.pop()
+            if parts:
+                yield ''.join(parts).encode('utf-8')
+            if finished:
+                break
+
+        # raises whatever stopped the render
+        await producer
+    finally:
+        producer.cancel()
+
+
+class StreamingTemplateResponse(StreamingResponse):
+    """
+    Sends a page while it is being rendered by a template of the streaming environment. Context values that take a
+    while to compute should be passed as async functions for the template to call where their output belongs, so
+    that the part of the page above them is sent first.
+
+    The status and headers are sent before rendering starts, so anything that could turn the response into an error
+    must be checked beforehand. An error while rendering cuts the page short.
+    """
+
+    def __init__(self, template: Template, context: Mapping, headers: Optional[Mapping[str, str]] = None):
+        super().__init__(_render_chunks(template, context), media_type='text/html', headers=headers)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m forums.templates',
+                                     description='Compiles all templates into the bytecode cache directory. Run this '
+                                                 'at build time so that workers never compile templates themselves.')
+    parser.add_argument('--directory', default=TemplateConfig().directory, help='template directory')
+    parser.add_argument('bytecode_cache_dir', help='where to write the compiled templates')
+    args = parser.parse_args()
+
+    conf = TemplateConfig(directory=args.directory, production=True, bytecode_cache_dir=args.bytecode_cache_dir)
+    count, elapsed = precompile(create_templates(conf).env)
+    if conf.stream_pages:
+        elapsed += precompile(create_streaming_env(conf))[1]
+    logging.info('compiled %d templates into %s in %.1f ms', count, args.bytecode_cache_dir, elapsed * 1000)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
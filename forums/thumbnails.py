@@ -0,0 +1,144 @@
+"""
+Thumbnails of image attachments.
+
+Thumbnails are rendered by a pool of worker processes, so that decoding and encoding images neither blocks the event
+loop nor competes with it for the GIL. They are rendered by a job queued right after an upload, or on the first
+request for one that doesn't exist yet. Each thumbnail is stored next to the blob it was made from, named after the
+blob, so it never goes stale: the contents of a blob never change.
+
+Thumbnails require the Pillow package. Without it, image attachments are shown as links like any other attachment.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, FrozenSet, Optional, Set
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+from forums.blocking import spawn_blocking
+from forums.config import ThumbnailConfig
+from forums.ioutil import blob_path, thumbnail_path
+
+# format name -> (Pillow format, content type)
+_FORMATS = {'webp': ('WEBP', 'image/webp'), 'avif': ('AVIF', 'image/avif')}
+# The types of images thumbnails are made of, as sniffed when they were uploaded
+_SOURCE_TYPES = frozenset({'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'})
+# Blobs that could not be rendered are remembered, up to this many, so that they aren't tried on every request
+_MAX_FAILED = 1024
+
+
+def _supports(fmt: str) -> bool:
+    return features.check(_FORMATS[fmt][0].lower())
+
+
+def thumbnail_types(conf: ThumbnailConfig) -> FrozenSet[str]:
+    """
+    The types of attachments that are shown as thumbnails, which is none of them if thumbnails are disabled or
+    Pillow (or its support for the configured format) is missing.
+    """
+    if not conf.enabled or Image is None or not _supports(conf.format):
+        return frozenset()
+    return _SOURCE_TYPES | ({'image/avif'} if _supports('avif') else set())
+
+
+def _render(src: str, dst: str, size: int, fmt: str, quality: int):
+    """
+    Runs in a worker process. Writes a thumbnail of the image in `src` to `dst`, atomically.
+    """
+    with Image.open(src) as im:
+        # lets JPEG decode at a fraction of the full size
+        im.draft('RGB', (size, size))
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((size, size))
+        has_alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+        im = im.convert('RGBA' if has_alpha else 'RGB')
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                im.save(f, format=_FORMATS[fmt][0], quality=quality)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, dst)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class Thumbnailer:
+    """
+    Renders thumbnails of blobs in worker processes. Concurrent requests for the same thumbnail share one render.
+    """
+
+    def __init__(self, storage_path: str, conf: ThumbnailConfig):
+        self.storage_path = storage_path
+        self.conf = conf
+        self.media_type = _FORMATS[conf.format][1]
+        # the types of attachments this renders thumbnails of
+        self.source_types = thumbnail_types(conf)
+        # spawned rather than forked: forking a process that runs threads (the default executor) isn't safe
+        self._executor = ProcessPoolExecutor(max_workers=conf.workers, mp_context=multiprocessing.get_context('spawn'))
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._failed: Set[str] = set()
+
+    def path(self, sha256: str) -> str:
+        return thumbnail_path(self.storage_path, sha256, self.conf.size, self.conf.format)
+
+    async def get(self, sha256: str) -> Optional[str]:
+        """
+        Returns the path of the thumbnail of a blob, rendering it first if it doesn't exist yet, or None if the blob
+        can't be rendered.
+        """
+        if sha256 in self._failed:
+            return None
+
+        task = self._pending.get(sha256)
+        if task is None:
+            task = asyncio.create_task(self._render(sha256))
+            self._pending[sha256] = task
+            task.add_done_callback(lambda _: self._pending.pop(sha256, None))
+        # a client going away must not cancel the render for everyone else waiting for it
+        return await asyncio.shield(task)
+
+    async def _render(self, sha256: str) -> Optional[str]:
+        dst = self.path(sha256)
+        if await spawn_blocking(os.path.exists, dst):
+            return dst
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, _render, blob_path(self.storage_path, sha256), dst, self.conf.size, self.conf.format,
+                self.conf.quality)
+        except FileNotFoundError:
+            # the blob was deleted
+            return None
+        except Exception as e:
+            logging.warning('failed to render the thumbnail of blob %s: %s', sha256, e)
+            if len(self._failed) >= _MAX_FAILED:
+                self._failed.clear()
+            self._failed.add(sha256)
+            return None
+        return dst
+
+    async def close(self):
+        await spawn_blocking(self._executor.shutdown, wait=True, cancel_futures=True)
+
+
+def create_thumbnailer(storage_path: str, conf: ThumbnailConfig) -> Optional[Thumbnailer]:
+    """
+    Creates the Thumbnailer of this process, or returns None if thumbnails are disabled or can't be rendered.
+    """
+    if not conf.enabled:
+        return None
+    if Image is None:
+        logging.warning('thumbnails are enabled, but Pillow is not installed')
+        return None
+    if not _supports(conf.format):
+        logging.warning('thumbnails are enabled, but Pillow was built without %s support', conf.format)
+        return None
+    return Thumbnailer(storage_path, conf)
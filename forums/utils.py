@@ -1,38 +1,83 @@
-from typing import Optional, AsyncGenerator, Any, Tuple, Callable, Coroutine, Awaitable, AsyncIterable
+from typing import Optional, AsyncGenerator, Any, Tuple, Callable, Coroutine, Awaitable, AsyncIterable, Type
 
-from fastapi import Request
+from fastapi import FastAPI, Request
+from jinja2 import Environment
 from pydantic import BaseModel, Field
 
+from forums.cache import Caches
+from forums.db.blobs import BlobRepository
 from forums.db.categories import CategoryRepository
+from forums.db.jobs import JobRepository
+from forums.db.memory import MemoryCategoryRepository, MemoryPostAttachmentRepository, MemoryPostRepository, \
+    MemoryTopicAttachmentRepository, MemoryTopicRepository, MemoryUserRepository, MemoryBlobRepository, \
+    MemoryJobRepository
 from forums.db.post_attachment import PostAttachmentRepository
 from forums.db.topic_attachment import TopicAttachmentRepository
 from forums.db.topics import TopicRepository
 from forums.db.posts import PostRepository
-from forums.db.users import User
+from forums.db.users import User, UserRepository
 
 
 def get_templates(req: Request):
     return req.app.state.tpl
 
 
+def get_streaming_env(req: Request) -> Optional[Environment]:
+    """
+    The environment for StreamingTemplateResponse, or None if pages should not be streamed.
+    """
+    return req.app.state.stream_env
+
+
+def get_caches(req: Request) -> Caches:
+    return req.app.state.caches
+
+
+# The memory repository implementing the same methods as each SQL repository
+_MEMORY_REPOS = {
+    UserRepository: MemoryUserRepository,
+    TopicRepository: MemoryTopicRepository,
+    CategoryRepository: MemoryCategoryRepository,
+    PostRepository: MemoryPostRepository,
+    TopicAttachmentRepository: MemoryTopicAttachmentRepository,
+    PostAttachmentRepository: MemoryPostAttachmentRepository,
+    BlobRepository: MemoryBlobRepository,
+    JobRepository: MemoryJobRepository,
+}
+
+
+def repo_for[R](app: FastAPI, repo: Type[R]) -> R:
+    """
+    Returns the implementation of `repo` matching the configured backend. The memory repositories implement the same
+    methods as their SQL counterparts, so callers don't need to know which one they were given.
+    """
+    if app.state.cfg.backend == 'memory':
+        return _MEMORY_REPOS[repo](app.state.db)
+    return repo(app.state.db)
+
+
+def get_user_repo(req: Request) -> UserRepository:
+    return repo_for(req.app, UserRepository)
+
+
 def get_topic_repo(req: Request) -> TopicRepository:
-    return TopicRepository(req.app.state.db)
+    return repo_for(req.app, TopicRepository)
 
 
 def get_category_repo(req: Request) -> CategoryRepository:
-    return CategoryRepository(req.app.state.db)
+    return repo_for(req.app, CategoryRepository)
 
 
 def get_post_repo(req: Request) -> PostRepository:
-    return PostRepository(req.app.state.db)
+    return repo_for(req.app, PostRepository)
 
 
 def get_topic_attach_repo(req: Request) -> TopicAttachmentRepository:
-    return TopicAttachmentRepository(req.app.state.db)
+    return repo_for(req.app, TopicAttachmentRepository)
 
 
 def get_post_attach_repo(req: Request) -> PostAttachmentRepository:
-    return PostAttachmentRepository(req.app.state.db)
+    return repo_for(req.app, PostAttachmentRepository)
 
 
 async def async_collect[T](gen: AsyncGenerator[T, None]) -> Tuple[T, ...]:
@@ -0,0 +1,94 @@
+"""
+Work a worker does at startup so that the first requests it serves aren't slower than the rest.
+"""
+import asyncio
+import itertools
+import logging
+import time
+
+from aiomysql import Pool
+from fastapi import FastAPI
+
+from forums.db.categories import CategoryRepository
+from forums.db.post_attachment import PostAttachmentRepository
+from forums.db.posts import PostRepository
+from forums.db.topics import TopicRepository
+from forums.routes.categories import cached_category_listing
+from forums.routes.topic import cached_reply_listing
+from forums.suggest import build_title_index
+from forums.utils import repo_for
+
+
+async def open_connections(pool: Pool, count: int) -> int:
+    """
+    Opens up to `count` connections of `pool` and checks that each of them works, so that requests don't wait for
+    connections to be established. Returns how many connections were opened.
+    """
+    count = min(count, pool.maxsize)
+    conns = []
+    try:
+        for conn in await asyncio.gather(*[pool.acquire() for _ in range(count)], return_exceptions=True):
+            if isinstance(conn, BaseException):
+                raise conn
+            conns.append(conn)
+        await asyncio.gather(*[conn.ping(reconnect=False) for conn in conns])
+    finally:
+        for conn in conns:
+            pool.release(conn)
+    return len(conns)
+
+
+async def warm_caches(app: FastAPI, topic_count: int) -> None:
+    """
+    Renders what most visitors see first into the fragment cache: the first page of every category, and the first page
+    of replies of up to `topic_count` topics that were active most recently.
+    """
+    caches = app.state.caches
+    tpl = app.state.tpl
+    topic_repo = repo_for(app, TopicRepository)
+    posts_repo = repo_for(app, PostRepository)
+    post_attach_repo = repo_for(app, PostAttachmentRepository)
+
+    categories = await repo_for(app, CategoryRepository).get_all_categories()
+    listings = await asyncio.gather(*[cached_category_listing(caches, topic_repo, tpl, cat.id, 1, False)
+                                      for cat in categories])
+
+    # take the most recently active topics of each category in turn
+    hot = [topic_id for topic_id in itertools.chain.from_iterable(itertools.zip_longest(
+        *[listing.topic_ids for listing in listings])) if topic_id is not None][:topic_count]
+
+    async def warm_topic(topic_id: int):
+        if (topic := await topic_repo.get_topic_by_id(topic_id)) is not None:
+            await cached_reply_listing(caches, posts_repo, post_attach_repo, tpl, topic, 1, False)
+
+    await asyncio.gather(*[warm_topic(topic_id) for topic_id in hot])
+    logging.info('warmed %d categories and %d topics', len(categories), len(hot))
+
+
+async def warm_up(app: FastAPI) -> None:
+    """
+    Opens database connections, fills the caches and then marks the worker as ready. A database that can't be
+    reached fails startup. A failure to warm the caches is only logged, since cold caches just make the worker slower.
+    """
+    start = time.perf_counter()
+    cfg = app.state.cfg
+    if cfg.backend == 'mysql':
+        opened = await open_connections(app.state.db, cfg.server.warm_connections)
+        logging.info('opened %d database connections', opened)
+
+    try:
+        async with asyncio.timeout(cfg.server.warmup_timeout):
+            await warm_caches(app, cfg.cache.warm_topics)
+    except TimeoutError:
+        logging.warning('warming caches took longer than %.0f s, giving up', cfg.server.warmup_timeout)
+    except Exception as e:
+        logging.error('failed to warm caches', exc_info=e)
+
+    try:
+        count = await build_title_index(app.state.caches.titles, repo_for(app, TopicRepository))
+        logging.info('indexed the titles of %d topics', count)
+    except Exception as e:
+        logging.error('failed to index topic titles', exc_info=e)
+
+    app.state.ready = True
+    logging.info('ready after %.1f ms', (time.perf_counter() - start) * 1000)
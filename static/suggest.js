@@ -0,0 +1,38 @@
+// Suggests the titles of existing topics while typing into inputs with a data-suggest attribute, through the
+// <datalist> the input's list attribute names.
+(function () {
+    'use strict';
+
+    function attach(input) {
+        var list = document.getElementById(input.getAttribute('list'));
+        var timer = null;
+        var controller = null;
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+                var q = input.value.trim();
+                if (controller) {
+                    controller.abort();
+                }
+                if (q.length < 2) {
+                    list.replaceChildren();
+                    return;
+                }
+                controller = new AbortController();
+                fetch('/suggest?' + new URLSearchParams({q: q}), {signal: controller.signal, credentials: 'same-origin'})
+                    .then(function (r) { return r.ok ? r.json() : []; })
+                    .then(function (topics) {
+                        list.replaceChildren.apply(list, topics.map(function (topic) {
+                            var option = document.createElement('option');
+                            option.value = topic.title;
+                            return option;
+                        }));
+                    })
+                    .catch(function () {});
+            }, 150);
+        });
+    }
+
+    document.querySelectorAll('input[data-suggest][list]').forEach(attach);
+})();
@@ -0,0 +1,186 @@
+import asyncio
+import time
+
+from forums.admission import CRITICAL, READ, WRITE, ConcurrencyLimiter
+from forums.config import ConcurrencyConfig
+
+
+def make_limiter(**kwargs) -> ConcurrencyLimiter:
+    conf = dict(initial_limit=4, min_limit=1, max_limit=8, read_share=0.5, queue_timeout=1.0, max_queue=4)
+    conf.update(kwargs)
+    return ConcurrencyLimiter(ConcurrencyConfig(**conf))
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_reads_only_use_their_share():
+    async def run():
+        limiter = make_limiter(queue_timeout=0)
+        assert await limiter.acquire(READ)
+        assert await limiter.acquire(READ)
+        assert not await limiter.acquire(READ)
+        assert limiter.shed == 1
+
+        # the rest of the limit is kept for writes
+        assert await limiter.acquire(WRITE)
+        assert await limiter.acquire(WRITE)
+        assert not await limiter.acquire(WRITE)
+        assert limiter.inflight == 4 and limiter.shed == 2
+
+    asyncio.run(run())
+
+
+def test_critical_requests_are_never_turned_away():
+    async def run():
+        limiter = make_limiter(queue_timeout=0)
+        for _ in range(4):
+            assert await limiter.acquire(WRITE)
+        assert await limiter.acquire(CRITICAL)
+        assert limiter.inflight == 5 and limiter.shed == 0
+
+    asyncio.run(run())
+
+
+def test_waiting_writes_start_before_waiting_reads():
+    async def run():
+        limiter = make_limiter(read_share=1)
+        for _ in range(4):
+            assert await limiter.acquire(READ)
+
+        read = asyncio.create_task(limiter.acquire(READ))
+        await settle()
+        write = asyncio.create_task(limiter.acquire(WRITE))
+        await settle()
+        assert limiter.stats()['waiting'] == {'write': 1, 'read': 1}
+
+        limiter.release(None)
+        await settle()
+        assert write.done() and write.result()
+        assert not read.done()
+
+        limiter.release(None)
+        await settle()
+        assert read.done() and read.result()
+        assert limiter.inflight == 4
+
+    asyncio.run(run())
+
+
+def test_new_requests_do_not_overtake_waiting_ones():
+    async def run():
+        limiter = make_limiter()
+        for _ in range(4):
+            assert await limiter.acquire(WRITE)
+        waiting = asyncio.create_task(limiter.acquire(WRITE))
+        await settle()
+
+        # a slot frees up and goes to the waiting request, not to a newcomer
+        limiter.release(None)
+        newcomer = asyncio.create_task(limiter.acquire(WRITE))
+        await settle()
+        assert waiting.done() and waiting.result()
+        assert not newcomer.done()
+        newcomer.cancel()
+
+    asyncio.run(run())
+
+
+def test_full_queue_turns_requests_away():
+    async def run():
+        limiter = make_limiter(max_queue=1)
+        for _ in range(4):
+            assert await limiter.acquire(WRITE)
+        waiting = asyncio.create_task(limiter.acquire(WRITE))
+        await settle()
+        assert not await limiter.acquire(WRITE)
+        assert limiter.shed == 1
+        waiting.cancel()
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_turns_requests_away():
+    async def run():
+        limiter = make_limiter(queue_timeout=0.01)
+        for _ in range(4):
+            assert await limiter.acquire(WRITE)
+        assert not await limiter.acquire(WRITE)
+        assert limiter.shed == 1 and limiter.stats()['waiting']['write'] == 0
+
+        # the slot isn't handed to the request that gave up
+        limiter.release(None)
+        assert limiter.inflight == 3
+
+    asyncio.run(run())
+
+
+def test_wake_up_in_the_same_turn_as_the_timeout_starts_the_request():
+    async def run():
+        limiter = make_limiter(queue_timeout=0.01)
+        for _ in range(4):
+            assert await limiter.acquire(WRITE)
+        waiting = asyncio.create_task(limiter.acquire(WRITE))
+        await settle()
+
+        # let the timeout become due, then free a slot in the same loop iteration as the timeout fires: the slot is
+        # handed over before the waiting request sees its timeout
+        time.sleep(0.02)
+        asyncio.get_running_loop().call_soon(limiter.release, None)
+        assert await waiting
+        assert limiter.inflight == 4 and limiter.shed == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        limiter = make_limiter()
+        for _ in range(4):
+            assert await limiter.acquire(WRITE)
+        waiting = asyncio.create_task(limiter.acquire(WRITE))
+        await settle()
+        waiting.cancel()
+        await settle()
+        assert limiter.stats()['waiting']['write'] == 0
+
+        limiter.release(None)
+        assert limiter.inflight == 3 and limiter.shed == 0
+
+    asyncio.run(run())
+
+
+def test_limit_shrinks_once_per_interval_when_slow():
+    limiter = make_limiter(initial_limit=8, target_latency=10, backoff=0.5)
+    limiter.inflight = 1
+    limiter.release(11)
+    assert limiter.limit == 4
+    # the same burst of slow requests
+    limiter.inflight = 1
+    limiter.release(11)
+    assert limiter.limit == 4
+
+
+def test_limit_stays_within_bounds():
+    limiter = make_limiter(initial_limit=2, min_limit=2, max_limit=3, target_latency=0.001, backoff=0.5)
+    limiter.inflight = 1
+    limiter.release(1)
+    assert limiter.limit == 2
+
+    for _ in range(20):
+        limiter.inflight = 3
+        limiter.release(0)
+    assert limiter.limit == 3
+
+
+def test_limit_only_grows_while_used():
+    limiter = make_limiter(initial_limit=4)
+    limiter.inflight = 1
+    limiter.release(0)
+    assert limiter.limit == 4
+
+    limiter.inflight = 3
+    limiter.release(0)
+    assert limiter.limit == 4.25
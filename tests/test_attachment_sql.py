@@ -0,0 +1,151 @@
+"""
+Checks the order of the statements the MySQL repositories run to add or migrate attachments, against a fake
+connection that enforces the foreign keys from the attachment tables to attachmentBlobs the way InnoDB does: on every
+statement.
+"""
+import asyncio
+import re
+from contextlib import asynccontextmanager
+
+import pytest
+from pymysql import IntegrityError
+
+from forums.db.blobs import Blob
+from forums.db.post_attachment import PostAttachment, PostAttachmentRepository
+from forums.db.posts import Post, PostRepository
+from forums.db.topic_attachment import TopicAttachment, TopicAttachmentRepository
+from forums.db.topics import Topic, TopicRepository
+
+_ATTACHMENT_WRITE = re.compile(r'(?:INSERT INTO|UPDATE) (?:threadAttachments|postsAttachments)')
+
+
+class FakeCursor:
+    def __init__(self, conn: 'FakeConnection'):
+        self.conn = conn
+        self.lastrowid = None
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, query: str, args=None):
+        conn = self.conn
+        conn.log.append(query)
+        if query.startswith('INSERT INTO attachmentBlobs'):
+            conn.blobs.add(args[0])
+        elif _ATTACHMENT_WRITE.match(query):
+            sha256 = args[0] if query.startswith('UPDATE') else args[-1]
+            if sha256 not in conn.blobs:
+                raise IntegrityError(1452, 'Cannot add or update a child row: a foreign key constraint fails')
+        elif query.startswith('INSERT INTO'):
+            self.lastrowid = 1
+        elif query.startswith('SELECT sha256'):
+            # an attachment still stored under its filename
+            self._rows = [(None, )]
+        return 1
+
+    async def executemany(self, query: str, args):
+        for row in args:
+            await self.execute(query, row)
+
+    async def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+class FakeConnection:
+    def __init__(self):
+        self.blobs = set()
+        self.log = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        self.log.append('COMMIT')
+
+    async def rollback(self):
+        self.log.append('ROLLBACK')
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+
+def blob(digit: str) -> Blob:
+    return Blob(sha256=digit * 64, size=1, mime_type='text/plain')
+
+
+def run(write) -> FakeConnection:
+    pool = FakePool()
+
+    async def place():
+        pool.conn.log.append('place')
+
+    asyncio.run(write(pool, place))
+    return pool.conn
+
+
+def assert_in_order(conn: FakeConnection):
+    assert 'ROLLBACK' not in conn.log
+    # the files are put in place last, right before the commit
+    assert conn.log[-2:] == ['place', 'COMMIT']
+
+
+@pytest.mark.parametrize('blobs', [[blob('a')], [blob('b'), blob('a')]])
+def test_put_topic_adds_blobs_before_attachments(blobs):
+    async def write(pool, place):
+        topic = Topic(topic_id=None, parent_cat=1, author_id=1, title='t', content='c')
+        await TopicRepository(pool).put_topic(topic, [(TopicAttachment(thread=0, filename=f'{b.sha256[0]}.txt',
+                                                                       author=1), b) for b in blobs], place)
+
+    assert_in_order(run(write))
+
+
+def test_put_post_adds_blobs_before_attachments():
+    async def write(pool, place):
+        post = Post(post_id=None, topic_id=1, author_id=1, content='c', created_at=None, flags=0)
+        attachment = PostAttachment(post=0, filename='a.txt', author=1, createdAt=None)
+        await PostRepository(pool).put_post(post, [(attachment, blob('a'))], place)
+
+    assert_in_order(run(write))
+
+
+def test_put_topic_attachments_adds_blobs_before_attachments():
+    async def write(pool, place):
+        await TopicAttachmentRepository(pool).put_attachments(
+            [(TopicAttachment(thread=1, filename='a.txt', author=1), blob('a'))], place)
+
+    assert_in_order(run(write))
+
+
+def test_put_post_attachments_adds_blobs_before_attachments():
+    async def write(pool, place):
+        await PostAttachmentRepository(pool).put_attachments(
+            [(PostAttachment(post=1, filename='a.txt', author=1, createdAt=None), blob('a'))], place)
+
+    assert_in_order(run(write))
+
+
+def test_move_topic_attachment_to_blob_adds_blob_first():
+    async def write(pool, place):
+        assert await TopicAttachmentRepository(pool).move_to_blob(1, blob('a'), place)
+
+    assert_in_order(run(write))
+
+
+def test_move_post_attachment_to_blob_adds_blob_first():
+    async def write(pool, place):
+        assert await PostAttachmentRepository(pool).move_to_blob(1, blob('a'), place)
+
+    assert_in_order(run(write))
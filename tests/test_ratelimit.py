@@ -0,0 +1,64 @@
+import pytest
+from fastapi import HTTPException
+
+from forums.config import RateLimitConfig, RateLimitRule
+from forums.ratelimit import RateLimiter, RateLimits
+
+
+def test_burst_then_refill():
+    limiter = RateLimiter(RateLimitRule(per_minute=60, burst=3), max_keys=10)
+    assert [limiter.acquire('a', now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('a', now=0) == pytest.approx(1)
+    # a rejected request doesn't take a token
+    assert limiter.acquire('a', now=0.5) == pytest.approx(0.5)
+    assert limiter.acquire('a', now=1) == 0
+    assert limiter.acquire('a', now=1) == pytest.approx(1)
+
+
+def test_refill_is_capped_at_burst():
+    limiter = RateLimiter(RateLimitRule(per_minute=60, burst=2), max_keys=10)
+    assert limiter.acquire('a', now=0) == 0
+    assert [limiter.acquire('a', now=100) for _ in range(2)] == [0, 0]
+    assert limiter.acquire('a', now=100) > 0
+
+
+def test_keys_are_limited_separately():
+    limiter = RateLimiter(RateLimitRule(per_minute=1, burst=1), max_keys=10)
+    assert limiter.acquire('a', now=0) == 0
+    assert limiter.acquire('a', now=0) > 0
+    assert limiter.acquire('b', now=0) == 0
+
+
+def test_zero_rate_disables_the_limit():
+    limiter = RateLimiter(RateLimitRule(per_minute=0, burst=1), max_keys=10)
+    assert all(limiter.acquire('a', now=0) == 0 for _ in range(100))
+    assert len(limiter) == 0
+
+
+def test_least_recently_used_key_is_forgotten():
+    limiter = RateLimiter(RateLimitRule(per_minute=1, burst=1), max_keys=2)
+    limiter.acquire('a', now=0)
+    limiter.acquire('b', now=0)
+    # 'a' is now the most recently used
+    assert limiter.acquire('a', now=0) > 0
+    limiter.acquire('c', now=0)
+    assert len(limiter) == 2
+
+    # 'a' was kept, 'b' was forgotten and starts over with a full burst
+    assert limiter.acquire('a', now=0) > 0
+    assert limiter.acquire('b', now=0) == 0
+
+
+def test_check_rejects_with_retry_after():
+    limits = RateLimits(RateLimitConfig(search=RateLimitRule(per_minute=2, burst=1)))
+    limits.check('search', 'a')
+    with pytest.raises(HTTPException) as exc:
+        limits.check('search', 'a')
+    assert exc.value.status_code == 429
+    assert 1 <= int(exc.value.headers['Retry-After']) <= 30
+
+
+def test_check_does_nothing_when_disabled():
+    limits = RateLimits(RateLimitConfig(enabled=False, search=RateLimitRule(per_minute=1, burst=1)))
+    for _ in range(10):
+        limits.check('search', 'a')
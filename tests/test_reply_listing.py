@@ -0,0 +1,37 @@
+from forums.bench import fixtures
+from forums.cache import CSRF_PLACEHOLDER, ReplyListing
+from forums.config import TemplateConfig
+from forums.templates import create_templates
+
+TOKEN = 'viewer-token<&>'
+ESCAPED_TOKEN = 'viewer-token&lt;&amp;&gt;'
+
+
+def render_listing(moderator: bool, content: str) -> ReplyListing:
+    env = create_templates(TemplateConfig(directory=fixtures.TEMPLATE_DIR)).env
+    ctx = fixtures.topic_replies_context(moderator)
+    posts = ctx['posts']
+    ctx['posts'] = (posts[0].model_copy(update={'content': content}), *posts[1:])
+    return ReplyListing.from_html(len(posts), env.get_template('_topic_replies.html').render(ctx))
+
+
+def test_token_is_only_put_into_forms():
+    listing = render_listing(True, 'before @@CSRF_TOKEN@@ after')
+    html = listing.html(TOKEN)
+
+    forms = html.count('<form')
+    assert forms > 0
+    assert html.count(ESCAPED_TOKEN) == forms
+    assert html.count(f'name="csrf_token" value="{ESCAPED_TOKEN}"') == forms
+    assert 'before @@CSRF_TOKEN@@ after' in html
+    assert CSRF_PLACEHOLDER not in html
+
+
+def test_listing_without_forms_carries_no_token():
+    listing = render_listing(False, 'hello')
+    assert listing.html_parts == (listing.html(TOKEN), )
+    assert TOKEN not in listing.html(TOKEN)
+
+
+def test_placeholder_is_not_guessable():
+    assert CSRF_PLACEHOLDER != '@@CSRF_TOKEN@@' and len(CSRF_PLACEHOLDER) >= 32
@@ -0,0 +1,112 @@
+import asyncio
+
+from forums.db.topics import TOPIC_IS_HIDDEN, Topic
+from forums.suggest import _KEY_LENGTH, TitleIndex, normalize_title
+
+
+def topic(topic_id: int, title: str, flags: int = 0) -> Topic:
+    return Topic(topic_id=topic_id, parent_cat=1, author_id=1, title=title, content='', flags=flags)
+
+
+def make_index(*titles, load=None) -> TitleIndex:
+    index = TitleIndex(load)
+    index.load_all([(i, title, 0) for i, title in enumerate(titles, 1)])
+    return index
+
+
+def ids(found):
+    return [topic_id for topic_id, _ in found]
+
+
+def test_normalize_title():
+    assert normalize_title('  Final—EXAM: schedule!! ') == 'final exam schedule'
+    assert normalize_title('Ｆｉｎａｌ') == 'final'
+    assert normalize_title('STRASSE') == normalize_title('Straße')
+
+
+def test_matches_word_starts_in_alphabetical_order():
+    index = make_index('Final exam schedule', 'Exam tips', 'Examples', 'Re: the exam')
+    # ordered by the text from the matching word on
+    assert ids(index.suggest('exam', 10)) == [4, 1, 2, 3]
+    assert ids(index.suggest('exam t', 10)) == [2]
+    assert ids(index.suggest('exam', 2)) == [4, 1]
+    # only the start of words
+    assert index.suggest('xam', 10) == []
+    assert index.suggest(' !! ', 10) == []
+
+
+def test_only_the_first_words_are_indexed():
+    index = make_index('one two three four five')
+    assert ids(index.suggest('four', 10)) == [1]
+    assert index.suggest('five', 10) == []
+
+
+def test_topic_matching_several_ways_is_suggested_once():
+    index = make_index('tips tips tips', 'tips and tricks')
+    assert ids(index.suggest('tips', 10)) == [1, 2]
+
+
+def test_prefixes_longer_than_keys_are_checked_against_the_title():
+    long = 'a' * _KEY_LENGTH
+    index = make_index(f'{long} one', f'{long} two', f'x {long} one')
+    assert ids(index.suggest(long, 10)) == [1, 2, 3]
+    assert ids(index.suggest(f'{long} o', 10)) == [1, 3]
+    assert ids(index.suggest(f'{long} t', 10)) == [2]
+    assert index.suggest(f'{long} z', 10) == []
+
+
+def test_hidden_topics():
+    index = TitleIndex(None)
+    index.load_all([(1, 'Parking', TOPIC_IS_HIDDEN), (2, 'Party', 0)])
+    assert ids(index.suggest('par', 10)) == [2]
+    assert ids(index.suggest('par', 10, include_hidden=True)) == [1, 2]
+
+    index.put(topic(1, 'Parking'))
+    index.put(topic(2, 'Party', TOPIC_IS_HIDDEN))
+    assert ids(index.suggest('par', 10)) == [1]
+
+
+def test_put_replaces_the_keys_of_the_old_title():
+    index = make_index('Exam tips')
+    keys = len(index._keys)
+    index.put(topic(1, 'Study tips'))
+    assert index.suggest('exam', 10) == []
+    assert index.suggest('stud', 10) == [(1, 'Study tips')]
+    assert len(index._keys) == keys
+
+    index.put(topic(2, 'Exam dates'))
+    assert index.suggest('exam', 10) == [(2, 'Exam dates')] and len(index) == 2
+
+
+def test_remove():
+    index = make_index('Exam tips', 'Exam dates')
+    index.remove(1)
+    index.remove(3)
+    assert index.suggest('exam', 10) == [(2, 'Exam dates')] and len(index) == 1
+
+
+def test_load_all_keeps_topics_put_while_loading():
+    index = TitleIndex(None)
+    index.put(topic(1, 'New title'))
+    index.load_all([(1, 'Old title', 0), (2, 'Other', 0)])
+    assert index.suggest('old', 10) == []
+    assert index.suggest('new', 10) == [(1, 'New title')] and len(index) == 2
+
+
+def test_stale_topics_are_reloaded():
+    topics = {1: topic(1, 'Renamed')}
+
+    async def load(topic_id: int):
+        return topics.get(topic_id)
+
+    async def run():
+        index = make_index('Original', 'Deleted', load=load)
+        index.stale(1)
+        index.stale(2)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert index.suggest('orig', 10) == []
+        assert index.suggest('ren', 10) == [(1, 'Renamed')]
+        assert index.suggest('del', 10) == [] and len(index) == 1
+
+    asyncio.run(run())
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from forums.admission import ConcurrencyLimiter
+from forums.cache import Caches, FragmentCache, VersionTable
+from forums.config import ConcurrencyConfig, LoginConfig
+from forums.db.topics import TOPIC_IS_HIDDEN
+from forums.routes.auth import _create_login_jwt
+from forums.routes.system import pages_router
+from forums.suggest import TitleIndex
+
+LOGIN = LoginConfig(secret='x' * 32)
+
+
+class NoDatabase:
+    """
+    Fails every attempt to use the database.
+    """
+
+    def acquire(self):
+        raise AssertionError('/suggest used the database')
+
+
+@pytest.fixture
+def app() -> FastAPI:
+    async def load(topic_id: int):
+        raise AssertionError('/suggest loaded a topic')
+
+    titles = TitleIndex(load)
+    titles.load_all([(1, 'Exam tips', 0), (2, 'Exam answers', TOPIC_IS_HIDDEN)])
+
+    app = FastAPI()
+    app.include_router(pages_router)
+    app.state.cfg = SimpleNamespace(backend='mysql', login=LOGIN)
+    app.state.db = NoDatabase()
+    app.state.caches = Caches(FragmentCache(10, 10, 10), VersionTable(), FragmentCache(10, 10, 10), titles)
+    app.state.admission = ConcurrencyLimiter(ConcurrencyConfig())
+    return app
+
+
+def get(app: FastAPI, username=None):
+    headers = {}
+    if username is not None:
+        jwt = _create_login_jwt(LOGIN.secret, username, datetime.now(tz=timezone.utc) + timedelta(hours=1))
+        headers['Cookie'] = f'{LOGIN.cookie_name}={jwt}'
+    with TestClient(app) as client:
+        return client.get('/suggest', params={'q': 'exam'}, headers=headers, follow_redirects=False)
+
+
+def test_suggests_without_the_database(app):
+    r = get(app, 'jdoe')
+    assert r.status_code == 200
+    assert r.json() == [{'topic_id': 1, 'title': 'Exam tips'}]
+    assert r.headers['Cache-Control'] == 'private, max-age=10'
+
+
+def test_moderators_are_suggested_hidden_topics(app):
+    app.state.admission.moderators.add('mod')
+    assert [s['topic_id'] for s in get(app, 'mod').json()] == [2, 1]
+    assert [s['topic_id'] for s in get(app, 'jdoe').json()] == [1]
+
+
+def test_requires_a_valid_session(app):
+    assert get(app).status_code == 401
+    with TestClient(app) as client:
+        r = client.get('/suggest', params={'q': 'exam'}, headers={'Cookie': f'{LOGIN.cookie_name}=forged'})
+    assert r.status_code == 401
@@ -44,6 +44,20 @@ CREATE TABLE `threadsTable`
 
 CREATE INDEX idx_created_at ON `threadsTable` (`createdAt`);
 
+-- The contents of attachments, stored once per distinct SHA-256 under attachments/blobs/. refCount counts the
+-- attachment rows pointing at a blob.
+CREATE TABLE `attachmentBlobs`
+(
+    `sha256`    char(64)        NOT NULL,
+    `size`      bigint unsigned NOT NULL,
+    `mimeType`  varchar(128)    NOT NULL,
+    `refCount`  int unsigned    NOT NULL DEFAULT '0',
+    `createdAt` timestamp       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT `pk_attachment_blobs_sha256` PRIMARY KEY (`sha256`)
+) ENGINE = InnoDB
+  DEFAULT CHARSET = utf8mb4
+  COLLATE = utf8mb4_0900_ai_ci;
+
 CREATE TABLE `threadAttachments`
 (
     `id` int unsigned not null auto_increment,
@@ -51,9 +65,11 @@ CREATE TABLE `threadAttachments`
     `filename` varchar(128) not null,
     `author` int unsigned not null,
     `createdAt` timestamp not null default CURRENT_TIMESTAMP,
+    `sha256` char(64) null,
     constraint `pk_thread_attachments_id` primary key (`id`),
     constraint `fk_thread_attachments_thr` foreign key (`thread`) references `threadsTable` (`threadID`),
-    constraint `fk_thread_attachments_author` foreign key (`author`) references `loginTable` (`id`)
+    constraint `fk_thread_attachments_author` foreign key (`author`) references `loginTable` (`id`),
+    constraint `fk_thread_attachments_blob` foreign key (`sha256`) references `attachmentBlobs` (`sha256`)
 );
 
 -- SHOW CREATE TABLE postsTable (mostly jerron)
@@ -81,7 +97,42 @@ CREATE TABLE `postsAttachments`
     `filename` varchar(128) not null,
     `author` int unsigned not null,
     `createdAt` timestamp not null default CURRENT_TIMESTAMP,
+    `sha256` char(64) null,
     constraint `pk_posts_attachments_id` primary key (`id`),
     constraint `fk_posts_attachments_post` foreign key (`post`) references `postsTable` (`postID`),
-    constraint `fk_posts_attachments_author` foreign key (`author`) references `loginTable` (`id`)
-);
\ No newline at end of file
+    constraint `fk_posts_attachments_author` foreign key (`author`) references `loginTable` (`id`),
+    constraint `fk_posts_attachments_blob` foreign key (`sha256`) references `attachmentBlobs` (`sha256`)
+);
+
+-- Cache invalidations published by each worker for the others to apply. Rows are deleted after a while.
+CREATE TABLE `cacheInvalidations`
+(
+    `id`        bigint unsigned NOT NULL AUTO_INCREMENT,
+    `origin`    char(12)        NOT NULL,
+    `tag`       varchar(64)     NOT NULL,
+    `createdAt` timestamp       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT `pk_cache_invalidations_id` PRIMARY KEY (`id`)
+) ENGINE = InnoDB
+  DEFAULT CHARSET = utf8mb4
+  COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE INDEX idx_cache_invalidations_created_at ON `cacheInvalidations` (`createdAt`);
+
+-- Deferred work (see forums.jobs). A job is claimed by pushing its runAt past the lease, so that it becomes visible
+-- again if the worker running it dies. Jobs that ran out of attempts are kept, with failedAt set, for inspection.
+CREATE TABLE `jobs`
+(
+    `id`        bigint unsigned NOT NULL AUTO_INCREMENT,
+    `kind`      varchar(64)     NOT NULL,
+    `payload`   json            NOT NULL,
+    `attempts`  int unsigned    NOT NULL DEFAULT '0',
+    `runAt`     timestamp(3)    NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    `lastError` text            NULL,
+    `failedAt`  timestamp       NULL,
+    `createdAt` timestamp       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT `pk_jobs_id` PRIMARY KEY (`id`)
+) ENGINE = InnoDB
+  DEFAULT CHARSET = utf8mb4
+  COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE INDEX idx_jobs_claim ON `jobs` (`kind`, `failedAt`, `runAt`);
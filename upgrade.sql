@@ -0,0 +1,61 @@
+-- Upgrades a database created with an earlier up.sql, from before the blob store, the job queue and the cache
+-- invalidation bus, to the current schema. Run it once, before starting the new version of the application or running
+-- python -m forums.migrate_attachments:
+--
+--     mysql forums < upgrade.sql
+
+-- The contents of attachments, stored once per distinct SHA-256 under attachments/blobs/. refCount counts the
+-- attachment rows pointing at a blob.
+CREATE TABLE `attachmentBlobs`
+(
+    `sha256`    char(64)        NOT NULL,
+    `size`      bigint unsigned NOT NULL,
+    `mimeType`  varchar(128)    NOT NULL,
+    `refCount`  int unsigned    NOT NULL DEFAULT '0',
+    `createdAt` timestamp       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT `pk_attachment_blobs_sha256` PRIMARY KEY (`sha256`)
+) ENGINE = InnoDB
+  DEFAULT CHARSET = utf8mb4
+  COLLATE = utf8mb4_0900_ai_ci;
+
+-- Attachments stored before the blob store have no sha256 until forums.migrate_attachments moves their files
+ALTER TABLE `threadAttachments`
+    ADD COLUMN `sha256` char(64) null,
+    ADD CONSTRAINT `fk_thread_attachments_blob` FOREIGN KEY (`sha256`) REFERENCES `attachmentBlobs` (`sha256`);
+
+ALTER TABLE `postsAttachments`
+    ADD COLUMN `sha256` char(64) null,
+    ADD CONSTRAINT `fk_posts_attachments_blob` FOREIGN KEY (`sha256`) REFERENCES `attachmentBlobs` (`sha256`);
+
+-- Cache invalidations published by each worker for the others to apply. Rows are deleted after a while.
+CREATE TABLE `cacheInvalidations`
+(
+    `id`        bigint unsigned NOT NULL AUTO_INCREMENT,
+    `origin`    char(12)        NOT NULL,
+    `tag`       varchar(64)     NOT NULL,
+    `createdAt` timestamp       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT `pk_cache_invalidations_id` PRIMARY KEY (`id`)
+) ENGINE = InnoDB
+  DEFAULT CHARSET = utf8mb4
+  COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE INDEX idx_cache_invalidations_created_at ON `cacheInvalidations` (`createdAt`);
+
+-- Deferred work (see forums.jobs). A job is claimed by pushing its runAt past the lease, so that it becomes visible
+-- again if the worker running it dies. Jobs that ran out of attempts are kept, with failedAt set, for inspection.
+CREATE TABLE `jobs`
+(
+    `id`        bigint unsigned NOT NULL AUTO_INCREMENT,
+    `kind`      varchar(64)     NOT NULL,
+    `payload`   json            NOT NULL,
+    `attempts`  int unsigned    NOT NULL DEFAULT '0',
+    `runAt`     timestamp(3)    NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    `lastError` text            NULL,
+    `failedAt`  timestamp       NULL,
+    `createdAt` timestamp       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT `pk_jobs_id` PRIMARY KEY (`id`)
+) ENGINE = InnoDB
+  DEFAULT CHARSET = utf8mb4
+  COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE INDEX idx_jobs_claim ON `jobs` (`kind`, `failedAt`, `runAt`);